@@ -0,0 +1,251 @@
+'''Measure the performance of the compiler on generated programs.
+
+Each benchmark generates its input programs from a fixed random seed, so results
+are comparable between runs.
+'''
+import os
+import random
+import shutil
+import StringIO
+import subprocess
+import tempfile
+import time
+
+from ececompiler import scanner
+from ececompiler import parser
+from ececompiler import typechecker
+from ececompiler import optimizer
+from ececompiler import codegenerator
+from ececompiler import syntaxtree
+
+INT_OPERATORS = ('+', '-', '*', '/', '&', '|')
+FLOAT_OPERATORS = ('+', '-', '*', '/')
+COMPARISON_OPERATORS = ('<', '<=', '>', '>=', '==', '!=')
+
+def constant_expression(rng, depth, expression_type):
+    '''Return the source of a random constant expression of the given type.'''
+    if depth == 0:
+        if expression_type == 'int':
+            return str(rng.randint(1, 100000))
+        if expression_type == 'float':
+            return '%d.%d' % (rng.randint(0, 1000), rng.randint(1, 999))
+        return rng.choice(('true', 'false'))
+
+    if expression_type == 'bool':
+        # Comparisons take the type of their operands, so only int comparisons
+        # can be used where a bool is expected.
+        if rng.random() < 0.5:
+            operand_type = 'int'
+            op = rng.choice(COMPARISON_OPERATORS)
+        else:
+            operand_type = 'bool'
+            op = rng.choice(('&', '|'))
+    elif expression_type == 'float':
+        operand_type = 'float'
+        op = rng.choice(FLOAT_OPERATORS)
+    else:
+        operand_type = 'int'
+        op = rng.choice(INT_OPERATORS)
+
+    if rng.random() < 0.1:
+        if expression_type == 'bool':
+            return 'not (%s)' % constant_expression(rng, depth - 1, 'bool')
+        return '-(%s)' % constant_expression(rng, depth - 1, expression_type)
+    return '(%s %s %s)' % (constant_expression(rng, depth - 1, operand_type), op,
+                           constant_expression(rng, depth - 1, operand_type))
+
+def constant_program(rng, statements, depth):
+    '''Return the source of a program made up of constant assignments.'''
+    lines = ['program benchmark is',
+             '    int i;',
+             '    float f;',
+             '    bool b;',
+             'begin']
+    for _ in xrange(statements):
+        name, expression_type = rng.choice((('i', 'int'), ('f', 'float'), ('b', 'bool')))
+        lines.append('    %s := %s;' % (name, constant_expression(rng, depth, expression_type)))
+    lines.append('end program')
+    return '\n'.join(lines)
+
+def count_nodes(node):
+    return 1 + sum(count_nodes(child) if isinstance(child, syntaxtree.Node) else
+                   sum(count_nodes(c) for c in child) if isinstance(child, list) else 0
+                   for child in node)
+
+def benchmark_folding(args):
+    rng = random.Random(args.seed)
+    sources = [constant_program(rng, args.statements, args.depth)
+               for _ in xrange(args.programs)]
+
+    elapsed = 0.0
+    nodes = 0
+    for _ in xrange(args.repeat):
+        for src in sources:
+            ast = parser.parse_tokens(scanner.tokenize_string(src))
+            assert typechecker.tree_is_valid(ast)
+            nodes += count_nodes(ast)
+            start = time.clock()
+            optimizer.ConstantFolder().walk(ast)
+            elapsed += time.clock() - start
+
+    expressions = args.repeat * args.programs * args.statements
+    print 'Folded %d expressions (%d nodes) in %.3f seconds' % (expressions, nodes, elapsed)
+    print '    %.0f expressions/second' % (expressions / elapsed)
+    print '    %.0f nodes/second' % (nodes / elapsed)
+
+# Loops over arrays, formatted with an array name, its length, and a loop
+# counter. The last two index the array with a bound that isn't known at compile
+# time, so their checks can't be removed.
+ARRAY_LOOPS = (
+    '''
+    i := 0;
+    for (i := i + 1; i < {length})
+        {array}[i] := {array}[i] + i;
+    end for;''',
+    '''
+    i := {length} - 1;
+    for (i := i - 1; i >= 1)
+        {array}[i - 1] := {array}[i] - {array}[i - 1];
+    end for;''',
+    '''
+    i := 0;
+    for (i := i + 1; i < {length} & i < n)
+        {array}[i] := {array}[i] * 2;
+    end for;''',
+    '''
+    i := 0;
+    for (i := i + 1; i < n)
+        {array}[i] := {array}[i] + 1;
+    end for;''',
+    '''
+    i := 0;
+    for (i := i + 1; i < n)
+        {array}[i / 2] := {array}[i];
+    end for;''',
+)
+
+def array_program(rng, loops, length, repeat):
+    '''Return the source of a program that runs random loops over arrays repeatedly.
+
+    The program reads the number of elements that some of the loops use from
+    its input.'''
+    arrays = ['a%d' % i for i in xrange(max(1, loops / 2))]
+    lines = ['program benchmark is',
+             '    int i;',
+             '    int n;',
+             '    int r;']
+    lines.extend('    int %s[%d];' % (name, length) for name in arrays)
+    lines.extend(['begin',
+                  '    getInteger(n);',
+                  '    r := 0;',
+                  '    for (r := r + 1; r < %d)' % repeat])
+    for _ in xrange(loops):
+        loop = rng.choice(ARRAY_LOOPS).format(array=rng.choice(arrays), length=length)
+        lines.extend('    ' + line for line in loop.splitlines() if line.strip())
+    lines.append('    end for;')
+    lines.extend('    putInteger(%s[1]);' % name for name in arrays)
+    lines.append('end program')
+    return '\n'.join(lines)
+
+def run_program(c_source, directory, name, input_text):
+    '''Build a generated C file with gcc, run it, and return the number of seconds it took.'''
+    root = os.path.dirname(os.path.abspath(__file__))
+    c_filename = os.path.join(directory, name + '.c')
+    executable = os.path.join(directory, name)
+    with open(c_filename, 'w') as f:
+        f.write(c_source)
+    subprocess.check_call(['gcc', '-m32', '-I', root, '-o', executable,
+                           os.path.join(root, 'runtime.c'), c_filename])
+    start = time.time()
+    process = subprocess.Popen([executable], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    process.communicate(input_text)
+    return time.time() - start
+
+def benchmark_bounds(args):
+    rng = random.Random(args.seed)
+    sources = [array_program(rng, args.loops, args.length, args.repeat)
+               for _ in xrange(args.programs)]
+    input_text = '%d\n' % args.length
+
+    subscripts = 0
+    written = 0
+    removed = 0
+    unchecked_time = 0.0
+    checked_time = 0.0
+    directory = tempfile.mkdtemp() if args.run else None
+    try:
+        for i, src in enumerate(sources):
+            ast = parser.parse_tokens(scanner.tokenize_string(src), include_runtime=True)
+            assert typechecker.tree_is_valid(ast)
+            optimizer.optimize_tree(ast, args.level)
+
+            code = {}
+            for check_bounds in (False, True):
+                output = StringIO.StringIO()
+                generator = codegenerator.CodeGenerator(output, check_bounds=check_bounds)
+                generator.walk(ast)
+                code[check_bounds] = output.getvalue()
+            subscripts += generator.written_bounds_checks + generator.removed_bounds_checks
+            written += generator.written_bounds_checks
+            removed += generator.removed_bounds_checks
+
+            if args.run:
+                unchecked_time += run_program(code[False], directory, 'unchecked%d' % i,
+                                              input_text)
+                checked_time += run_program(code[True], directory, 'checked%d' % i,
+                                            input_text)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    print 'Generated %d array accesses in %d programs at -O%d' % (subscripts, args.programs,
+                                                                   args.level)
+    print '    %d bounds checks removed statically (%.1f%%)' % (
+        removed, 100.0 * removed / max(subscripts, 1))
+    print '    %d bounds checks left in the code' % written
+    if args.run:
+        print 'Ran the programs in %.3f seconds without checks and %.3f seconds with them' % (
+            unchecked_time, checked_time)
+        print '    %.1f%% runtime overhead' % (100.0 * (checked_time - unchecked_time) /
+                                               unchecked_time)
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser(description=
+                                        'Measure the performance of the compiler.')
+    argparser.add_argument('--seed', type=int, default=6083,
+                           help='seed for the program generator')
+    subparsers = argparser.add_subparsers(title='benchmarks')
+
+    folding = subparsers.add_parser('folding', help='constant folding throughput')
+    folding.add_argument('-p', '--programs', type=int, default=20,
+                         help='number of programs to generate')
+    folding.add_argument('-s', '--statements', type=int, default=200,
+                         help='number of assignments in each program')
+    folding.add_argument('-d', '--depth', type=int, default=4,
+                         help='depth of each constant expression')
+    folding.add_argument('-r', '--repeat', type=int, default=3,
+                         help='number of times to fold each program')
+    folding.set_defaults(function=benchmark_folding)
+
+    bounds = subparsers.add_parser('bounds', help='overhead of array bounds checks')
+    bounds.add_argument('-p', '--programs', type=int, default=10,
+                        help='number of programs to generate')
+    bounds.add_argument('-l', '--loops', type=int, default=8,
+                        help='number of loops in each program')
+    bounds.add_argument('-n', '--length', type=int, default=1000,
+                        help='length of each array')
+    bounds.add_argument('-r', '--repeat', type=int, default=1000,
+                        help='number of times each program runs its loops')
+    bounds.add_argument('-O', '--level', type=int, choices=xrange(3), default=2,
+                        help='optimization level to compile the programs at')
+    bounds.add_argument('--run', action='store_true',
+                        help='build the programs with gcc and measure the runtime overhead')
+    bounds.set_defaults(function=benchmark_bounds)
+
+    args = argparser.parse_args()
+    args.function(args)
+
+if __name__ == '__main__':
+    main()
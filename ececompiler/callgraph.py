@@ -0,0 +1,417 @@
+'''Find the procedures of a program and the calls between them.
+
+The CallGraph class is built from a semantically valid AST. Each procedure
+declaration and the program itself are nodes in the graph, and each Call
+statement in their bodies is an edge to the declaration that it resolves to.
+
+AST nodes are not hashable, so the graph identifies procedures by the id() of
+their declaration nodes. Since procedures are mutated in place by the optimizer,
+those ids are stable for the life of the tree.
+
+The graph also summarizes the side effects of each procedure: the global
+variables and parameters that it might read or write, either directly or
+through the procedures it calls. Recursive procedures are summarized together
+by finding the strongly connected components of the graph.
+'''
+
+import collections
+
+import syntaxtree
+import tokens
+import parser
+
+# Runtime procedures are implemented in C, so their empty bodies don't describe
+# what they do.
+RUNTIME_PROCEDURES = frozenset(d.name.id for d in parser.RUNTIME_DEFINITIONS)
+
+# The side effects of a procedure. Global variables are identified by their
+# names, including global arrays, and parameters by their indexes. Out
+# parameters can't be read and in parameters are passed by value, so only array
+# parameters are ever in param_reads, and only out and array parameters are in
+# param_writes.
+Effects = collections.namedtuple('Effects', ['global_reads', 'global_writes',
+                                             'param_reads', 'param_writes'])
+
+def is_by_reference(param):
+    '''Return whether a parameter is passed by reference: out parameters and arrays.'''
+    return param.direction == tokens.OUT or param.var_decl.array_length is not None
+
+def iter_calls(statements):
+    '''Yield every Call in a list of statements.'''
+    for statement in syntaxtree.iter_statements(statements):
+        if isinstance(statement, syntaxtree.Call):
+            yield statement
+
+def iter_tail_calls(statements, at_end=True):
+    '''Yield the Calls in a procedure body that are in tail position.
+
+    A call is in tail position if it's followed by a Return, or if it's the
+    last statement that runs before the end of the body, including at the end
+    of a branch of an If that's in tail position. The end of a loop's body
+    isn't the end of the procedure.'''
+    for i, statement in enumerate(statements):
+        if i + 1 < len(statements):
+            at_tail = isinstance(statements[i + 1], syntaxtree.Return)
+        else:
+            at_tail = at_end
+        if isinstance(statement, syntaxtree.Call) and at_tail:
+            yield statement
+        elif isinstance(statement, syntaxtree.If):
+            for call in iter_tail_calls(statement.body, at_tail):
+                yield call
+            for call in iter_tail_calls(statement.orelse, at_tail):
+                yield call
+        elif isinstance(statement, syntaxtree.For):
+            for call in iter_tail_calls(statement.body, False):
+                yield call
+
+class CallGraph(object):
+    def __init__(self, program):
+        self.program = program
+
+        # All procedures in the program, with each procedure listed before the
+        # procedures nested inside of it. The program is always first.
+        self.procedures = []
+        self.global_procedures = {}
+
+        self._parents = {}
+        self._scopes = {}
+        self._calls = {}
+        self._callees = {}
+        self._callers = {}
+        # The effects of each procedure's own statements, not including the
+        # procedures it calls. See _find_local_effects.
+        self._local_effects = {}
+        # The effects of each procedure and its callees, which are found when
+        # they're needed after the graph changes.
+        self._effects = None
+
+        self.global_variables = set()
+        for procedure in syntaxtree.iter_procedures(program):
+            for decl in procedure.decls:
+                if isinstance(decl, syntaxtree.VarDecl) and decl.is_global:
+                    self.global_variables.add(decl.name)
+        for decl in program.decls:
+            if isinstance(decl, syntaxtree.ProcDecl) and decl.is_global:
+                self.global_procedures[decl.name] = decl
+        self._add_procedure(program, None)
+        for procedure in self.procedures:
+            self._callers[id(procedure)] = []
+        for procedure in self.procedures:
+            self.update(procedure)
+
+    def _add_procedure(self, node, parent):
+        self.procedures.append(node)
+        self._parents[id(node)] = parent
+
+        # Procedures can call themselves, their direct children, and global
+        # procedures, with local names taking precedence.
+        scope = dict(self.global_procedures)
+        if isinstance(node, syntaxtree.ProcDecl):
+            scope[node.name] = node
+        children = [d for d in node.decls if isinstance(d, syntaxtree.ProcDecl)]
+        for child in children:
+            scope[child.name] = child
+        self._scopes[id(node)] = scope
+
+        for child in children:
+            self._add_procedure(child, node)
+
+    def __contains__(self, procedure):
+        return id(procedure) in self._scopes
+
+    def parent(self, procedure):
+        '''Return the node that declares a procedure, or None for the program.'''
+        return self._parents[id(procedure)]
+
+    def resolve(self, procedure, name):
+        '''Return the declaration that a name refers to when called from a procedure.'''
+        return self._scopes[id(procedure)][name]
+
+    def calls(self, procedure):
+        '''Return a list of (Call, declaration) tuples for the calls in a procedure's body.'''
+        return self._calls[id(procedure)]
+
+    def callees(self, procedure):
+        '''Return a list of the procedures called by a procedure, without duplicates.'''
+        return self._callees[id(procedure)]
+
+    def callers(self, procedure):
+        '''Return a list of the procedures that call a procedure, without duplicates.'''
+        return self._callers[id(procedure)]
+
+    def written_params(self, procedure):
+        '''Return a set of the indexes of the out parameters and arrays that a procedure might write to.'''
+        return self.effects(procedure).param_writes
+
+    def may_write_param(self, procedure, index):
+        '''Return whether a call to a procedure might write to the parameter at an index.
+
+        Procedures that aren't in the graph are assumed to write to all of their
+        parameters.'''
+        if procedure not in self:
+            return True
+        return index in self.effects(procedure).param_writes
+
+    def may_write_global(self, procedure, name):
+        '''Return whether a call to a procedure might write to a global variable.
+
+        Procedures that aren't in the graph are assumed to write to every
+        global.'''
+        if procedure not in self:
+            return True
+        return name in self.effects(procedure).global_writes
+
+    def effects(self, procedure):
+        '''Return the Effects of calling a procedure, including the effects of the procedures it calls.'''
+        if self._effects is None:
+            self._effects = self._find_effects()
+        return self._effects[id(procedure)]
+
+    def update(self, procedure):
+        '''Recompute the calls made by a procedure after its body has changed.
+
+        Returns a list of the procedures that are no longer called by it.'''
+        old_callees = self._callees.get(id(procedure), [])
+        for callee in old_callees:
+            callers = self._callers[id(callee)]
+            callers[:] = [c for c in callers if c is not procedure]
+
+        calls = []
+        callees = []
+        seen = set()
+        for call in iter_calls(procedure.body):
+            decl = self.resolve(procedure, call.func)
+            calls.append((call, decl))
+            if id(decl) not in seen:
+                seen.add(id(decl))
+                callees.append(decl)
+                self._callers[id(decl)].append(procedure)
+        self._calls[id(procedure)] = calls
+        self._callees[id(procedure)] = callees
+        self._local_effects[id(procedure)] = self._find_local_effects(procedure)
+        self._effects = None
+
+        return [c for c in old_callees if id(c) not in seen]
+
+    def _variables(self, procedure):
+        '''Return a dict mapping the names used in a procedure to the index of the parameter they refer to, or to None for globals.
+
+        Local variables aren't included.'''
+        variables = {}
+        if isinstance(procedure, syntaxtree.ProcDecl):
+            variables.update((p.var_decl.name, i) for i, p in enumerate(procedure.params))
+        local_names = set(d.name for d in procedure.decls
+                          if isinstance(d, syntaxtree.VarDecl) and not d.is_global)
+        variables.update((name, None) for name in self.global_variables
+                         if name not in variables and name not in local_names)
+        return variables
+
+    def _find_local_effects(self, procedure):
+        if (isinstance(procedure, syntaxtree.ProcDecl) and procedure.is_global and
+            procedure.name.id in RUNTIME_PROCEDURES):
+            # Runtime procedures always write to their out parameters.
+            return Effects(frozenset(), frozenset(), frozenset(),
+                           frozenset(i for i, p in enumerate(procedure.params)
+                                     if p.direction == tokens.OUT))
+
+        variables = self._variables(procedure)
+        reads = set()
+        writes = set()
+        for statement in syntaxtree.iter_statements(procedure.body):
+            if isinstance(statement, syntaxtree.Assign):
+                target = statement.target
+                if isinstance(target, syntaxtree.Subscript):
+                    writes.add(target.name)
+                    reads.update(syntaxtree.iter_names(target.index))
+                else:
+                    writes.add(target)
+                reads.update(syntaxtree.iter_names(statement.value))
+            elif isinstance(statement, syntaxtree.Call):
+                # Out and array arguments are handled in _find_effects, since
+                # they depend on what the callee does with them.
+                decl = self.resolve(procedure, statement.func)
+                for arg, param in zip(statement.args, decl.params):
+                    if (param.direction == tokens.IN and
+                        param.var_decl.array_length is None):
+                        reads.update(syntaxtree.iter_names(arg))
+            elif isinstance(statement, (syntaxtree.If, syntaxtree.For)):
+                reads.update(syntaxtree.iter_names(statement.test))
+
+        def split(names):
+            global_names = frozenset(n for n in names if n in variables and variables[n] is None)
+            indexes = frozenset(variables[n] for n in names if variables.get(n) is not None)
+            return global_names, indexes
+        global_reads, param_reads = split(reads)
+        global_writes, param_writes = split(writes)
+        if isinstance(procedure, syntaxtree.ProcDecl):
+            param_reads = frozenset(i for i in param_reads
+                                    if procedure.params[i].var_decl.array_length is not None)
+            param_writes = frozenset(i for i in param_writes
+                                     if is_by_reference(procedure.params[i]))
+        return Effects(global_reads, global_writes, param_reads, param_writes)
+
+    def _find_effects(self):
+        '''Return a dict mapping the ids of every procedure to its Effects.
+
+        Callees are summarized before their callers. The procedures in each
+        strongly connected component are summarized together until none of
+        their effects change, starting from their local effects.'''
+        effects = {}
+        for component in self.strongly_connected_components():
+            for procedure in component:
+                effects[id(procedure)] = self._local_effects[id(procedure)]
+            changed = True
+            while changed:
+                changed = False
+                for procedure in component:
+                    new_effects = self._add_call_effects(procedure, effects)
+                    if new_effects != effects[id(procedure)]:
+                        effects[id(procedure)] = new_effects
+                        changed = True
+        return effects
+
+    def _add_call_effects(self, procedure, effects):
+        variables = self._variables(procedure)
+        global_reads, global_writes, param_reads, param_writes = (
+            set(s) for s in effects[id(procedure)])
+
+        def add(arg, global_names, indexes):
+            # Only variables can be passed by reference.
+            if not isinstance(arg, syntaxtree.Name):
+                return
+            if arg in variables:
+                if variables[arg] is None:
+                    global_names.add(arg)
+                else:
+                    indexes.add(variables[arg])
+
+        for call, decl in self.calls(procedure):
+            callee = effects[id(decl)]
+            global_reads.update(callee.global_reads)
+            global_writes.update(callee.global_writes)
+            for i, arg in enumerate(call.args):
+                if i in callee.param_reads:
+                    add(arg, global_reads, param_reads)
+                if i in callee.param_writes:
+                    add(arg, global_writes, param_writes)
+        if isinstance(procedure, syntaxtree.ProcDecl):
+            # Only arrays count as reads of a procedure's parameters, and
+            # writes to in parameters only change the procedure's copy.
+            param_reads = set(i for i in param_reads
+                              if procedure.params[i].var_decl.array_length is not None)
+            param_writes = set(i for i in param_writes
+                               if is_by_reference(procedure.params[i]))
+        return Effects(frozenset(global_reads), frozenset(global_writes),
+                       frozenset(param_reads), frozenset(param_writes))
+
+    def reachable(self):
+        '''Return a list of the procedures that can be called from the program body.'''
+        found = set([id(self.program)])
+        stack = [self.program]
+        result = []
+        while stack:
+            procedure = stack.pop()
+            result.append(procedure)
+            for callee in self.callees(procedure):
+                if id(callee) not in found:
+                    found.add(id(callee))
+                    stack.append(callee)
+        return result
+
+    def remove(self, procedure):
+        '''Remove a procedure and everything nested in it from the graph and its parent's declarations.
+
+        The procedure must not be called by any procedure outside of it.'''
+        parent = self.parent(procedure)
+        parent.decls[:] = [d for d in parent.decls if d is not procedure]
+        if procedure.is_global:
+            del self.global_procedures[procedure.name]
+
+        removed = []
+        stack = [procedure]
+        while stack:
+            node = stack.pop()
+            removed.append(node)
+            stack.extend(d for d in node.decls if isinstance(d, syntaxtree.ProcDecl))
+        removed_ids = set(id(p) for p in removed)
+
+        for node in removed:
+            for callee in self.callees(node):
+                # Callees may have already been removed if they were unreachable
+                # too.
+                if id(callee) not in removed_ids and callee in self:
+                    callers = self._callers[id(callee)]
+                    callers[:] = [c for c in callers if c is not node]
+            for table in (self._parents, self._scopes, self._calls,
+                          self._callees, self._callers, self._local_effects):
+                table.pop(id(node), None)
+        self.procedures = [p for p in self.procedures if id(p) not in removed_ids]
+        self._effects = None
+        return removed
+
+    def postorder(self):
+        '''Return the procedures ordered so that callees come before their callers where possible.'''
+        visited = set()
+        order = []
+        for root in self.procedures:
+            if id(root) in visited:
+                continue
+            visited.add(id(root))
+            stack = [(root, iter(self.callees(root)))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if id(child) not in visited:
+                        visited.add(id(child))
+                        stack.append((child, iter(self.callees(child))))
+                        break
+                else:
+                    stack.pop()
+                    order.append(node)
+        return order
+
+    def strongly_connected_components(self):
+        '''Return a list of lists of procedures that can call each other, with callees' lists before their callers'.
+
+        Every procedure is in exactly one list, and a procedure that doesn't
+        call itself is in a list by itself.'''
+        # Tarjan's algorithm, with an explicit stack instead of recursion.
+        indexes = {}
+        lowlinks = {}
+        on_stack = set()
+        stack = []
+        components = []
+        for root in self.procedures:
+            if id(root) in indexes:
+                continue
+            indexes[id(root)] = lowlinks[id(root)] = len(indexes)
+            stack.append(root)
+            on_stack.add(id(root))
+            work = [(root, iter(self.callees(root)))]
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if id(child) not in indexes:
+                        indexes[id(child)] = lowlinks[id(child)] = len(indexes)
+                        stack.append(child)
+                        on_stack.add(id(child))
+                        work.append((child, iter(self.callees(child))))
+                        break
+                    elif id(child) in on_stack:
+                        lowlinks[id(node)] = min(lowlinks[id(node)], indexes[id(child)])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlinks[id(parent)] = min(lowlinks[id(parent)], lowlinks[id(node)])
+                    if lowlinks[id(node)] == indexes[id(node)]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(id(member))
+                            component.append(member)
+                            if member is node:
+                                break
+                        components.append(component)
+        return components
@@ -1,9 +1,12 @@
 import sys
-import heapq
 import collections
 
 import syntaxtree
 import tokens
+import callgraph
+import profiling
+import ranges
+import regalloc
 
 # The code generator generates code using four types of memory addressing:
 # Absolute, Register, Register Offset, and Memory Indirect.
@@ -28,6 +31,31 @@ import tokens
 #    .
 # ---------------------
 # 
+# A call in tail position replaces the caller's frame with the callee's, and
+# passes on the caller's return address and FP, so the callee returns straight
+# to the caller's caller.
+#
+# The code of each procedure is generated with virtual registers, one for each
+# variable the procedure keeps in a register and one for each temporary value,
+# and then the regalloc module allocates a fixed number of physical registers to
+# them, which are local variables of main shared by all procedures. R0 holds
+# return addresses. Before a call, the caller stores the variables whose memory
+# the callee might read, and it reloads the ones it might write afterward. The
+# register allocator keeps the values that are live across the call out of the
+# registers that the callee might overwrite, or stores and reloads them too.
+#
+# Boolean operators check that their operands are 0 or 1 by calling
+# validateBooleanOp, unless the ranges module can prove that they always are.
+# Out of bounds array indexes would silently overwrite other variables or the
+# stack, so with check_bounds, each subscript compares its index to the length
+# of the array and calls indexOutOfBounds if it isn't in range, unless the
+# ranges module can prove that it always is.
+#
+# With a profile file, the code counts how often its procedures, branches,
+# loops, and calls run in PROFILE_COUNTS, which is outside of MM so that the
+# program's memory layout doesn't change, and writes the counts to the file at
+# exit (see the profiling module). With a Profile from an earlier run, the body
+# of an If that usually isn't taken is moved off of the fall-through path.
 
 PROLOG = '''
 #include "string.h"
@@ -36,7 +64,7 @@ PROLOG = '''
 #define MM_SIZE 32768
 #define INPUT_BUFFER_SIZE 1024
 
-extern int R[];
+extern int S[];
 int MM[MM_SIZE];
 char INPUT_BUFFER[INPUT_BUFFER_SIZE];
 float FLOAT_REG_1; 
@@ -48,94 +76,74 @@ int HP = MM_SIZE - 1; /* heap pointer */
 int main() {
 '''.strip()
 
+PROFILE_PROLOG = '''
+#include "stdio.h"
+#include "stdlib.h"
+extern long long PROFILE_COUNTS[];
+void writeProfile(void);
+'''.strip()
+
 runtime_functions = {
 'getBool':'''
-    R[0] = getBool();
-    MM[MM[SP + 1]] = R[0]; 
-    R[0] = MM[SP + 3];
-    goto *(void *)R[0];
+    R0 = getBool();
+    MM[MM[SP + 1]] = R0; 
+    R0 = MM[SP + 3];
+    goto *(void *)R0;
 '''.strip(),
 'getInteger':'''
-    R[0] = getInteger();
-    MM[MM[SP + 1]] = R[0]; 
-    R[0] = MM[SP + 3];
-    goto *(void *)R[0];
+    R0 = getInteger();
+    MM[MM[SP + 1]] = R0; 
+    R0 = MM[SP + 3];
+    goto *(void *)R0;
 '''.strip(),
 'getFloat':'''
     FLOAT_REG_1 = getFloat();
-    memcpy(&R[0], &FLOAT_REG_1, sizeof(float));
-    MM[MM[SP + 1]] = R[0]; 
-    R[0] = MM[SP + 3];
-    goto *(void *)R[0];
+    memcpy(&R0, &FLOAT_REG_1, sizeof(float));
+    MM[MM[SP + 1]] = R0; 
+    R0 = MM[SP + 3];
+    goto *(void *)R0;
 '''.strip(),
 'getString':'''
-    R[0] = getString(INPUT_BUFFER);
-    HP = HP - R[0];
-    memcpy(&MM[HP], &INPUT_BUFFER, R[0]);
+    R0 = getString(INPUT_BUFFER);
+    HP = HP - R0;
+    memcpy(&MM[HP], &INPUT_BUFFER, R0);
     MM[MM[SP + 1]] = (int)((char *)&MM[HP]); 
-    R[0] = MM[SP + 3];
-    goto *(void *)R[0];
+    R0 = MM[SP + 3];
+    goto *(void *)R0;
 '''.strip(),
 'putBool':'''
-    R[0] = MM[SP + 1];
-    putBool(R[0]);
-    R[0] = MM[SP + 3];
-    goto *(void *)R[0];
+    R0 = MM[SP + 1];
+    putBool(R0);
+    R0 = MM[SP + 3];
+    goto *(void *)R0;
 '''.strip(),
 'putInteger':'''
-    R[0] = MM[SP + 1];
-    putInteger(R[0]);
-    R[0] = MM[SP + 3];
-    goto *(void *)R[0];
+    R0 = MM[SP + 1];
+    putInteger(R0);
+    R0 = MM[SP + 3];
+    goto *(void *)R0;
 '''.strip(),
 'putFloat':'''
     memcpy(&FLOAT_REG_1, &MM[SP + 1], sizeof(float));
     putFloat(FLOAT_REG_1);
-    R[0] = MM[SP + 3];
-    goto *(void *)R[0];
+    R0 = MM[SP + 3];
+    goto *(void *)R0;
 '''.strip(),
 'putString':'''
-    R[0] = MM[SP + 1];
-    putString((char *)R[0]);
-    R[0] = MM[SP + 3];
-    goto *(void *)R[0];
+    R0 = MM[SP + 1];
+    putString((char *)R0);
+    R0 = MM[SP + 3];
+    goto *(void *)R0;
 '''.strip()
 }
 
-class Heap(object):
-    def __init__(self, items):
-        self.queue = items
-        heapq.heapify(self.queue)
-        
-    def put(self, item):
-        heapq.heappush(self.queue, item)
-        
-    def get(self):
-        return heapq.heappop(self.queue)
-    
-class Register(int):
+class VirtualRegister(int):
     def __str__(self):
-        return 'R[%d]' % self
-    
-class RegisterHeap(Heap):
-    def __init__(self):
-        super(RegisterHeap, self).__init__([])
-        self.size = 0
-        self.max_size = 0
-        
-    def get(self):
-        if self.queue:
-            return super(RegisterHeap, self).get()
-        self.size += 1
-        self.max_size = max((self.size, self.max_size))
-        return Register(self.size - 1)
-    
-    def clear(self):
-        self.queue = []
-        self.size = 0
+        return '$%d' % self
 
 class CodeGenerator(syntaxtree.TreeWalker):
-    def __init__(self, output_file=sys.stdout, generate_comments=False):
+    def __init__(self, output_file=sys.stdout, generate_comments=False, check_bounds=False,
+                 profile_file=None, profile=None, register_count=regalloc.REGISTER_COUNT):
         super(CodeGenerator, self).__init__()
         self.visit_functions = {
             syntaxtree.ProcDecl: self.visit_procdecl,
@@ -150,13 +158,32 @@ class CodeGenerator(syntaxtree.TreeWalker):
             syntaxtree.Program: self.visit_program,
             syntaxtree.Call: self.visit_call,
             syntaxtree.Subscript: self.visit_subscript,
+            syntaxtree.Select: self.visit_select,
             syntaxtree.Return: self.visit_return,
         }
         
         self.output_file = output_file
         self.generate_comments = generate_comments
+        self.check_bounds = check_bounds
+        self.profile_file = profile_file
+        self.profile = profile
+        self.register_count = register_count
         self.register_assignements = {}
-        self.free_registers = RegisterHeap()
+        self.register_total = 0
+        
+        # The lines of the procedure being generated and the loop depth of
+        # each one, which are written once its registers are allocated, the
+        # number of registers that the callee of each call that returns to one
+        # of its labels clobbers, and the index of the line that allocates its
+        # stack frame, and the size of the frame. See write_procedure_code.
+        self.procedure_code = None
+        self.loop_depth = 0
+        self.call_clobbers = {}
+        self.frame_line = None
+        self.frame_size = 0
+        
+        # The most slots of S that any procedure uses.
+        self.shared_slots = 0
         
         self.global_memory_locations = {}
         self.fp_offsets = [{}]
@@ -164,14 +191,38 @@ class CodeGenerator(syntaxtree.TreeWalker):
         self.procedure_names = ['']
         self.global_proc_decls = {}
         self.label_counts = collections.defaultdict(int)
-        self.last_subscript_address = None
         
-    @staticmethod
-    def allocated_register(node):
-        '''Return whether or not a node allocates a register in its visit function.'''
-        return (isinstance(node, syntaxtree.BinaryOp) or
-                isinstance(node, syntaxtree.UnaryOp) or
-                isinstance(node, syntaxtree.Subscript))
+        # The ids of the calls in tail position in the procedure being
+        # generated.
+        self.tail_calls = set()
+        
+        # Summaries of the globals and parameters that procedures use, and the
+        # number of registers that calls to the procedures that have been
+        # generated might overwrite, by the ids of their declarations. See
+        # spilled_variables and record_clobbered_registers.
+        self.call_graph = None
+        self.clobbered_registers = {}
+        
+        # The ids of the boolean operators in the procedure being generated
+        # whose operands are always 0 or 1 and of the subscripts whose indexes
+        # are always in bounds, and the number of checks of each kind that have
+        # been left out of the code because of them.
+        self.redundant_checks = set()
+        self.removed_checks = 0
+        self.removed_bounds_checks = 0
+        self.written_bounds_checks = 0
+        
+        # The lengths of the arrays that the procedure being generated can
+        # use, by name.
+        self.array_lengths = {}
+        
+        # The (kind, token) of each profile counter, by its index in
+        # PROFILE_COUNTS.
+        self.counters = []
+        
+        # The (label, If, return label, loop depth) of the If bodies in the
+        # procedure being generated that are placed after its end.
+        self.deferred_blocks = []
         
     @property
     def current_fp_offset(self):
@@ -207,10 +258,51 @@ class CodeGenerator(syntaxtree.TreeWalker):
         self.proc_decls.pop()
         self.procedure_names.pop()
         self.register_assignements = {}
-        self.free_registers.clear()
+        
+    def new_register(self):
+        self.register_total += 1
+        return VirtualRegister(self.register_total)
         
     def write(self, text, indent='    '):
-        print >> self.output_file, indent + text
+        if self.procedure_code is not None:
+            self.procedure_code.append((indent + text, self.loop_depth))
+        else:
+            print >> self.output_file, indent + text
+            
+    def start_procedure_code(self):
+        '''Hold the lines written from now on until write_procedure_code.'''
+        self.procedure_code = []
+        self.register_total = 0
+        self.call_clobbers = {}
+        self.frame_line = None
+        
+    def write_frame_allocation(self, size):
+        '''Write the line that allocates the stack frame, which grows by the slots that the register allocator needs.'''
+        self.frame_line = len(self.procedure_code)
+        self.frame_size = size
+        self.write('SP = SP + %d;' % size)
+        
+    def write_procedure_code(self, locals_size):
+        '''Allocate the registers of the lines held since start_procedure_code, and write them.
+        
+        The frame slots that the allocator needs go after the locals_size
+        words of local variables. Returns the allocator.'''
+        lines = [line for line, depth in self.procedure_code]
+        depths = [depth for line, depth in self.procedure_code]
+        self.procedure_code = None
+        allocator = regalloc.RegisterAllocator(lines, depths, self.call_clobbers,
+                                               self.register_count)
+        allocator.allocate()
+        self.shared_slots = max(self.shared_slots, allocator.shared_slots)
+
+        frame_size = self.frame_size + allocator.frame_slots
+        if frame_size:
+            allocator.lines[self.frame_line] = '    SP = SP + %d;' % frame_size
+        else:
+            allocator.removed.add(self.frame_line)
+        for line in allocator.render(locals_size + 1):
+            self.write(line, indent='')
+        return allocator
         
     def create_call_label(self, title):
         label = '%s_%d' % (title, self.label_counts[title])
@@ -252,8 +344,9 @@ class CodeGenerator(syntaxtree.TreeWalker):
         try:
             return self.register_assignements[node]
         except KeyError:
-            reg = self.free_registers.get()
-            # TODO: this will load outparams unnecessarily
+            reg = self.new_register()
+            # Loads of variables that are assigned before they're read, like
+            # out parameters, are removed by the register allocator.
             value = 'MM[%s]' % self.get_memory_location(node)
             if self.generate_comments:
                 self.write('%s = %s; /* %s */' % (reg, value, node.id))
@@ -283,6 +376,50 @@ class CodeGenerator(syntaxtree.TreeWalker):
                 self.visit(decl)
         return sp_offset
     
+    def iter_register_names(self, node):
+        '''Yield the variables in an expression that are kept in registers.'''
+        if isinstance(node, syntaxtree.Name):
+            yield node
+        elif isinstance(node, syntaxtree.Subscript):
+            # Arrays are accessed through memory.
+            for name in self.iter_register_names(node.index):
+                yield name
+        elif isinstance(node, syntaxtree.BinaryOp):
+            for name in self.iter_register_names(node.left):
+                yield name
+            for name in self.iter_register_names(node.right):
+                yield name
+        elif isinstance(node, syntaxtree.UnaryOp):
+            for name in self.iter_register_names(node.operand):
+                yield name
+        elif isinstance(node, syntaxtree.Select):
+            for field in node:
+                for name in self.iter_register_names(field):
+                    yield name
+        
+    def load_variables(self, node):
+        '''Load every variable used in a procedure body into a register.
+        
+        Registers are assigned to variables the first time they appear in the
+        code. If that happens in a branch that isn't taken, the register would
+        be used uninitialized afterward, so all of the loads are done at the
+        start of the procedure.'''
+        for statement in syntaxtree.iter_statements(node.body):
+            if isinstance(statement, syntaxtree.Assign):
+                expressions = [statement.target, statement.value]
+            elif isinstance(statement, syntaxtree.Call):
+                decl = self.get_proc_decl(statement.func)
+                expressions = [arg for arg, param in zip(statement.args, decl.params)
+                               if param.direction == tokens.IN and
+                               param.var_decl.array_length is None]
+            elif isinstance(statement, (syntaxtree.If, syntaxtree.For)):
+                expressions = [statement.test]
+            else:
+                expressions = []
+            for expression in expressions:
+                for name in self.iter_register_names(expression):
+                    self.get_register(name)
+        
     def store_variables(self, names):
         for name in names:
             reg = self.get_register(name)
@@ -301,6 +438,8 @@ class CodeGenerator(syntaxtree.TreeWalker):
         if node.name.id in runtime_functions:
             self.write('\n%s:' % node.name.id, indent='')
             self.write(runtime_functions[node.name.id])
+            # They only use R0.
+            self.clobbered_registers[id(node)] = 1
             return
 
         self.enter_scope()
@@ -318,52 +457,94 @@ class CodeGenerator(syntaxtree.TreeWalker):
                 
         # calc_local_var_stack_size visits children decls for us.
         sp_offset = self.calc_local_var_stack_size(node)
+        self.start_procedure_code()
         self.write('\n%s:' % self.get_label(node.name), indent='')
         
         # Add to the offsets to account for the return address and the previous
         # FP.
         self.write('FP = SP + %d;' % (fp_offset))
-        self.write('SP = SP + %d;' % (sp_offset + fp_offset))
+        self.write_frame_allocation(sp_offset + fp_offset)
+        self.write_counter(profiling.PROCEDURE, node.name.token)
+        self.load_variables(node)
+        self.tail_calls = set(id(c) for c in callgraph.iter_tail_calls(node.body))
+        self.redundant_checks = ranges.find_redundant_checks(node, self.call_graph)
+        self.array_lengths = ranges.array_lengths(node, self.call_graph.program)
         
         for statement in node.body:
             self.visit(statement)
             
         self.write('\n%s:' % self.get_end_label(self.current_procedure))
-        
-        outparams = [p.var_decl.name for p in node.params
-                        if p.direction == tokens.OUT]
-        # Store live global variables and out parameters.
-        live_vars = (r for r in self.register_assignements if
-                r in outparams or r in self.global_memory_locations)
-        self.store_variables(live_vars)
+        self.store_live_variables(node)
             
         if self.generate_comments:
             self.write('/* Unwind the stack. */')
             
         self.write('SP = FP - %d;' % (fp_offset))
-        self.write('R[0] = MM[FP];')
+        self.write('R0 = MM[FP];')
         self.write('FP = MM[FP-1];')
-        self.write('goto *(void *)R[0];')
+        self.write('goto *(void *)R0;')
+        self.write_deferred_blocks()
+        allocator = self.write_procedure_code(sp_offset)
         
+        self.record_clobbered_registers(node, allocator)
         self.leave_scope()
         
+    def record_clobbered_registers(self, node, allocator):
+        '''Record the number of registers that a call to a procedure that was just generated might overwrite.
+        
+        The allocator prefers the lowest registers, so that's the number of
+        registers up to the highest one the procedure used, or the most that
+        any procedure it calls might overwrite, if that's more. Every procedure
+        returns through R0, so that's always overwritten. Procedures that can't be summarized aren't
+        recorded.'''
+        if self.call_graph is None or node not in self.call_graph:
+            return
+        clobbered = allocator.used_registers
+        for callee in self.call_graph.callees(node):
+            if callee is not node:
+                if id(callee) not in self.clobbered_registers:
+                    return
+                clobbered = max(clobbered, self.clobbered_registers[id(callee)])
+        self.clobbered_registers[id(node)] = clobbered
+        
+    def store_live_variables(self, node):
+        '''Store the global variables and out parameters that a procedure has in registers.'''
+        outparams = [p.var_decl.name for p in node.params
+                        if p.direction == tokens.OUT]
+        live_vars = (r for r in self.register_assignements if
+                r in outparams or r in self.global_memory_locations)
+        self.store_variables(live_vars)
+        
     def visit_program(self, node):
         # Only include the runtime header if we actually use any runtime
         # functions.
-        if set(runtime_functions) & set(d.name.id for d in node.decls):
+        if self.check_bounds or set(runtime_functions) & set(d.name.id for d in node.decls):
             self.write('#include "runtime.h"', indent='')
+        if self.profile_file is not None:
+            self.write(PROFILE_PROLOG, indent='')
         self.write(PROLOG, indent='')
+        # The physical registers are local variables, so that the C compiler
+        # can keep them in machine registers.
+        self.write('int %s;' % ', '.join('R%d' % r for r in xrange(self.register_count + 1)))
+        if self.profile_file is not None:
+            self.write('atexit(writeProfile);')
         self.write('goto %s;' % node.name.id)
         
         self.current_procedure = node.name
+        self.call_graph = callgraph.CallGraph(node)
        
         # calc_local_var_stack_size visits children decls for us.
         sp_offset = self.calc_local_var_stack_size(node)
         
+        self.start_procedure_code()
         self.write('\n%s:' % node.name.id, indent='')
+        # The program body has no caller to return to.
+        self.tail_calls = set()
+        self.redundant_checks = ranges.find_redundant_checks(node, self.call_graph)
+        self.array_lengths = ranges.array_lengths(node, node)
 
-        if sp_offset > 0:
-            self.write('SP = SP + %d;' % sp_offset )
+        self.write_frame_allocation(sp_offset)
+        self.load_variables(node)
         
         for statement in node.body:
             self.visit(statement)
@@ -372,10 +553,21 @@ class CodeGenerator(syntaxtree.TreeWalker):
         # The main function will be the last one generated. It can't return a
         # value, so we don't have to unwind the stack.
         self.write('return 0;')
+        self.write_deferred_blocks()
+        self.write_procedure_code(sp_offset)
         self.write('}\n', indent='')
         
-        # Define the register size here now that we know how big it will get.
-        self.write('int R[%d];' % (self.free_registers.max_size), indent='')
+        # Define the spill slots here now that we know how many there are.
+        self.write('int S[%d];' % max(self.shared_slots, 1), indent='')
+        if self.profile_file is not None:
+            self.write_profile_writer()
+        if self.generate_comments:
+            self.write('/* Removed %d checks of boolean operands. */' % self.removed_checks,
+                       indent='')
+            if self.check_bounds:
+                self.write('/* Removed %d of %d array bounds checks. */' %
+                           (self.removed_bounds_checks,
+                            self.removed_bounds_checks + self.written_bounds_checks), indent='')
 
     def visit_num(self, node):
         return node.n
@@ -386,11 +578,37 @@ class CodeGenerator(syntaxtree.TreeWalker):
     def visit_name(self, node):
         return self.get_register(node)
     
-    def visit_subscript(self, node):
+    def subscript_address(self, node):
+        '''Return the C expression for the address of an array element.
+        
+        The base and the offset are added where the address is used, instead
+        of in a register first, so an element is read or written in a single
+        statement.'''
         base = self.get_memory_location(node.name)
         offset = self.visit(node.index)
-        address_reg = self.free_registers.get()
-        value_reg = self.free_registers.get()
+        if self.check_bounds:
+            self.write_bounds_check(node, offset)
+        if isinstance(offset, VirtualRegister) or offset != '0':
+            return '%s + %s' % (base, offset)
+        return base
+    
+    def write_bounds_check(self, node, index):
+        '''Check that the index of a subscript is in bounds, unless it always is.'''
+        if id(node) in self.redundant_checks:
+            self.removed_bounds_checks += 1
+            return
+        self.written_bounds_checks += 1
+        length = self.array_lengths[node.name]
+        # Assignment targets don't have tokens of their own.
+        token = node.token or node.name.token
+        lineno = token.lineno if token else 0
+        # Negative indexes are compared as large unsigned values.
+        self.write('if ((unsigned)%s >= %d) indexOutOfBounds(%s, %d, %d);' %
+                   (index, length, index, length, lineno))
+        
+    def visit_subscript(self, node):
+        address = self.subscript_address(node)
+        value_reg = self.new_register()
         
         if self.generate_comments:
             line = node.name.token.line
@@ -402,20 +620,12 @@ class CodeGenerator(syntaxtree.TreeWalker):
         else:
             comment = ''
             
-        self.write('R[%d] = %s;%s' % (address_reg, base, comment))
-        if isinstance(offset, Register) or offset > 0:
-            self.write('R[%d] = R[%d] + %s;' % (address_reg, address_reg, offset))
-        self.last_subscript_address = address_reg
-        self.write('R[%d] = MM[R[%d]];' % (value_reg, address_reg))
+        self.write('%s = MM[%s];%s' % (value_reg, address, comment))
         return value_reg
     
     def visit_unaryop(self, node):
         value = self.visit(node.operand)
-        
-        if self.allocated_register(node.operand):
-            self.free_registers.put(value)
-            
-        outreg = self.free_registers.get()
+        outreg = self.new_register()
         
         # Translate the not operator into the C equivalent, which is dependent
         # on the data type.
@@ -423,25 +633,20 @@ class CodeGenerator(syntaxtree.TreeWalker):
         if op == tokens.NOT:
             if node.node_type == tokens.BOOL:
                 op = '!'
-                self.write("validateBooleanOp(%s, '%s', %s, %d);" %
-                           (0, op, value, node.token.lineno))
+                self.write_boolean_check(node, 0, op, value)
             else:
                 op = '~'
-                
+        
+        # Folded literals can be negative, and C would read --1 as a decrement.
+        if isinstance(node.operand, syntaxtree.Num) and node.operand.n.startswith('-'):
+            value = '(%s)' % value
         self.write('%s = %s%s;' % (outreg, op, value))
         return outreg
         
     def visit_binop(self, node):
         left = self.visit(node.left)
         right = self.visit(node.right)
-        
-        # Free temporary registers.
-        if self.allocated_register(node.right):
-            self.free_registers.put(right)
-        if self.allocated_register(node.left):
-            self.free_registers.put(left)
-        
-        outreg = self.free_registers.get()
+        outreg = self.new_register()
         
         if node.node_type == tokens.FLOAT:
             if isinstance(node.left, syntaxtree.Num):
@@ -456,11 +661,60 @@ class CodeGenerator(syntaxtree.TreeWalker):
             self.write('memcpy(&%s, &FLOAT_REG_1, sizeof(float));' % outreg)
         else:    
             if node.node_type == tokens.BOOL:
-                self.write("validateBooleanOp(%s, '%s', %s, %s);" %
-                           (left, node.op, right, node.token.lineno))
+                self.write_boolean_check(node, left, node.op, right)
             self.write('%s = %s %s %s;' % (outreg, left, node.op, right))
         return outreg
     
+    def visit_select(self, node):
+        '''Write a conditional expression, which C compilers compile to a conditional move instead of a branch.'''
+        values = [self.visit(field) for field in node]
+        outreg = self.new_register()
+        self.write('%s = %s ? %s : %s;' % ((outreg,) + tuple(values)))
+        return outreg
+    
+    def write_counter(self, kind, token):
+        '''Count the times that the code being generated runs, if the program is instrumented.
+        
+        Statements without tokens, which only the optimizer creates, aren't
+        counted.'''
+        if self.profile_file is None or token is None:
+            return
+        self.write('PROFILE_COUNTS[%d]++;' % len(self.counters))
+        self.counters.append((kind, token))
+        
+    def write_profile_writer(self):
+        '''Write the definitions of the profile counters, and of the function that writes them to the profile file.'''
+        filename = self.profile_file.replace('\\', '\\\\').replace('"', '\\"')
+        self.write('long long PROFILE_COUNTS[%d];' % max(len(self.counters), 1), indent='')
+        self.write('\nvoid writeProfile(void) {', indent='')
+        self.write('FILE *profile = fopen("%s", "a");' % filename)
+        self.write('if (!profile) return;')
+        for i, (kind, token) in enumerate(self.counters):
+            line, column = profiling.location(token)
+            self.write('fprintf(profile, "%s %d %d %%lld\\n", PROFILE_COUNTS[%d]);' %
+                       (kind, line, column, i))
+        self.write('fclose(profile);')
+        self.write('}', indent='')
+        
+    def write_deferred_blocks(self):
+        '''Write the If bodies that were moved out of the procedure that was just generated.'''
+        while self.deferred_blocks:
+            label, node, return_label, self.loop_depth = self.deferred_blocks.pop(0)
+            self.write('\n%s:' % label, indent='')
+            self.write_counter(profiling.THEN, node.token)
+            for statement in node.body:
+                self.visit(statement)
+            self.write('goto %s;' % return_label)
+        self.loop_depth = 0
+        
+    def write_boolean_check(self, node, left, op, right):
+        '''Check that the operands of a boolean operator are 0 or 1, unless they always are.'''
+        if id(node) in self.redundant_checks:
+            self.removed_checks += 1
+        else:
+            self.write("validateBooleanOp(%s, '%s', %s, %s);" %
+                       (left, op, right, node.token.lineno))
+        
     def visit_assign(self, node):
         if node.token:
             t = node.token
@@ -468,7 +722,11 @@ class CodeGenerator(syntaxtree.TreeWalker):
                 self.write('/* %s */' % t.line[t.start:t.end+1])
         
         value = self.visit(node.value)
-        outreg = self.visit(node.target)
+        if isinstance(node.target, syntaxtree.Subscript):
+            # Store array assignments immediately to save registers
+            outreg = 'MM[%s]' % self.subscript_address(node.target)
+        else:
+            outreg = self.visit(node.target)
         
         if (isinstance(node.value, syntaxtree.Num) and '.' in node.value.n or
             node.target.node_type == tokens.FLOAT):
@@ -477,14 +735,6 @@ class CodeGenerator(syntaxtree.TreeWalker):
         else:
             self.write('%s = %s;' % (outreg, value))
         
-        # Store array assignments immediately to save registers
-        if isinstance(node.target, syntaxtree.Subscript):
-            self.write('MM[%s] = %s;' % (self.last_subscript_address, outreg))
-            self.free_registers.put(self.last_subscript_address)
-        
-        if self.allocated_register(node.value):
-            self.free_registers.put(value)
-        
     def visit_call(self, node):
         call_label = self.get_label(node.func)
         return_label = self.create_call_label('return_from_%s' % call_label)
@@ -494,37 +744,149 @@ class CodeGenerator(syntaxtree.TreeWalker):
             startpos = node.func.token.start
             endpos = line.index(';', startpos)
             self.write('/* %s */' % line[startpos:endpos])
+        self.write_counter(profiling.CALL, node.func.token)
         
-        self.store_variables(self.register_assignements)
+        decl = self.get_proc_decl(node.func)
+        if id(node) in self.tail_calls and self.can_reuse_frame(node, decl):
+            self.write_tail_call(node, decl, call_label)
+            return
         
+        stored, reloaded = self.spilled_variables(node, decl)
+        self.store_variables(stored)
         
         # Push arguments right-to-left.
-        reg = self.free_registers.get()
-        decl = self.get_proc_decl(node.func)
         for i, (arg, param) in enumerate(reversed(zip(node.args, decl.params))):
             if (param.direction == tokens.OUT or
                 param.var_decl.array_length is not None):
-                self.write('%s = %s;' % (reg, self.get_memory_location(arg)))
-                valuereg = reg
+                valuereg = self.new_register()
+                self.write('%s = %s;' % (valuereg, self.get_memory_location(arg)))
             else:
                 valuereg = self.visit(arg)
-            self.write('MM[SP + %d] = %s;' % (i + 1, valuereg))
+            if isinstance(arg, syntaxtree.Num) and '.' in arg.n:
+                # Float literals have to be stored by their bit pattern.
+                self.write('FLOAT_REG_1 = %s;' % valuereg)
+                self.write('memcpy(&MM[SP + %d], &FLOAT_REG_1, sizeof(float));' % (i + 1))
+            else:
+                self.write('MM[SP + %d] = %s;' % (i + 1, valuereg))
         
         # Python loop variables are leaked into their surrounding scope (by design).
         self.write('MM[SP + %d] = FP;' % (i + 2))
         self.write('MM[SP + %d] = (int)&&%s;' % (i + 3, return_label))
         
+        # The register allocator saves the registers that the callee might
+        # overwrite around the call.
+        self.call_clobbers[return_label] = self.clobbered_registers.get(id(decl))
         self.write('goto %s;' % call_label)
         self.write('\n%s:' % return_label, indent='')
             
         # Reload stored variables.
-        for name, reg in self.register_assignements.iteritems():
+        for name in reloaded:
+            reg = self.register_assignements[name]
             value = 'MM[%s]' % self.get_memory_location(name)
             if self.generate_comments:
                 self.write('%s = %s; /* %s */' % (reg, value, name.id))
             else:
                 self.write('%s = %s;' % (reg, value))
         
+    def spilled_variables(self, node, decl):
+        '''Return lists of the variables in registers that have to be stored before a call, and reloaded after it.
+        
+        Registers are saved around calls by the register allocator, so
+        variables only have to be if the callee might read or write their
+        memory: the globals in its summary, and the out arguments it might
+        write to. Out parameters of the current procedure might be
+        aliases of globals, so if there are any, all of them and all globals
+        are spilled around calls that use globals or write to one of them.'''
+        if self.call_graph is None or decl not in self.call_graph:
+            names = list(self.register_assignements)
+            return names, names
+        effects = self.call_graph.effects(decl)
+        written_args = set(arg for i, (arg, param) in enumerate(zip(node.args, decl.params))
+                           if param.direction == tokens.OUT and i in effects.param_writes)
+        if self.current_procedure == self.procedure_names[0]:
+            out_params = set()
+        else:
+            out_params = set(p.var_decl.name for p in
+                             self.get_proc_decl(self.current_procedure).params
+                             if p.direction == tokens.OUT)
+        writes_shared = (bool(effects.global_writes) or
+                         any(a in out_params or a in self.global_memory_locations
+                             for a in written_args))
+        reads_shared = writes_shared or bool(effects.global_reads)
+        
+        stored = []
+        reloaded = []
+        for name in self.register_assignements:
+            if name in written_args:
+                read = written = True
+            elif name in out_params or (out_params and name in self.global_memory_locations):
+                read, written = reads_shared, writes_shared
+            elif name in self.global_memory_locations:
+                written = name in effects.global_writes
+                read = written or name in effects.global_reads
+            else:
+                read = written = False
+            # The callee might not write to the variable, so its memory has to
+            # be up to date before the call for it to be reloaded.
+            if read or written:
+                stored.append(name)
+            if written:
+                reloaded.append(name)
+        return stored, reloaded
+        
+    def can_reuse_frame(self, node, decl):
+        '''Return whether a call in tail position can replace the current procedure's stack frame.
+        
+        Runtime procedures return with the caller's FP, and references to the
+        current procedure's own variables would point into the replaced frame.'''
+        if decl.is_global and decl.name.id in runtime_functions:
+            return False
+        for arg, param in zip(node.args, decl.params):
+            if ((param.direction == tokens.OUT or param.var_decl.array_length is not None) and
+                arg not in self.global_memory_locations and
+                not self.get_memory_location(arg).startswith('MM[')):
+                return False
+        return True
+        
+    def write_tail_call(self, node, decl, call_label):
+        '''Jump to a procedure in place of returning from the current one.
+        
+        The callee's frame starts where the current procedure's did, and it
+        returns straight to the current procedure's caller. All of the
+        arguments are computed before the frame is overwritten, and variables
+        are copied to temporaries, since the register allocator might keep
+        them in the frame.'''
+        procedure = self.get_proc_decl(self.current_procedure)
+        self.store_live_variables(procedure)
+        
+        values = []
+        for arg, param in reversed(zip(node.args, decl.params)):
+            if (param.direction == tokens.OUT or
+                param.var_decl.array_length is not None):
+                value = self.new_register()
+                self.write('%s = %s;' % (value, self.get_memory_location(arg)))
+            elif isinstance(arg, syntaxtree.Name):
+                value = self.new_register()
+                self.write('%s = %s;' % (value, self.visit(arg)))
+            else:
+                value = self.visit(arg)
+            values.append((arg, value))
+        return_reg = self.new_register()
+        fp_reg = self.new_register()
+        self.write('%s = MM[FP];' % return_reg)
+        self.write('%s = MM[FP-1];' % fp_reg)
+        self.write('SP = FP - %d;' % (len(procedure.params) + 2))
+        
+        for i, (arg, value) in enumerate(values):
+            if isinstance(arg, syntaxtree.Num) and '.' in arg.n:
+                self.write('FLOAT_REG_1 = %s;' % value)
+                self.write('memcpy(&MM[SP + %d], &FLOAT_REG_1, sizeof(float));' % (i + 1))
+            else:
+                self.write('MM[SP + %d] = %s;' % (i + 1, value))
+        self.write('MM[SP + %d] = %s;' % (len(values) + 1, fp_reg))
+        self.write('MM[SP + %d] = %s;' % (len(values) + 2, return_reg))
+        self.write('goto %s;' % call_label)
+        
     def visit_if(self, node):
         if self.generate_comments and node.token:
             startpos = node.token.start
@@ -534,15 +896,37 @@ class CodeGenerator(syntaxtree.TreeWalker):
             else:
                 endpos = len(node.token.line.rstrip())
             self.write('/* %s */' % node.token.line[startpos:endpos])
+        self.write_counter(profiling.IF, node.token)
         test_reg = self.visit(node.test)
         endif_label = self.create_call_label('__endif')
         
+        counts = self.profile and self.profile.branch_counts(node)
+        if counts is not None and counts[0] < counts[1]:
+            # The body usually isn't taken, so it's moved out of the way of
+            # the orelse, or of the code after the If if there's no orelse.
+            then_label = self.create_call_label('__then')
+            self.write('if (%s) goto %s;' % (test_reg, then_label))
+            if node.orelse:
+                for statement in node.orelse:
+                    self.visit(statement)
+                self.write('goto %s;' % endif_label)
+                self.write('\n%s:' % then_label, indent='')
+                self.write_counter(profiling.THEN, node.token)
+                for statement in node.body:
+                    self.visit(statement)
+            else:
+                self.deferred_blocks.append((then_label, node, endif_label,
+                                             self.loop_depth))
+            self.write('\n%s:' % endif_label, indent='')
+            return
+        
         if node.orelse:
             target_label = self.create_call_label('__else')
         else:
             target_label = endif_label
         
         self.write('if (!%s) goto %s;' % (test_reg, target_label)) 
+        self.write_counter(profiling.THEN, node.token)
         for statement in node.body:
             self.visit(statement)
             
@@ -557,7 +941,6 @@ class CodeGenerator(syntaxtree.TreeWalker):
     def visit_for(self, node):
         start_label = self.create_call_label('__for')
         end_label = self.create_call_label('__endfor')
-        self.write('\n%s:' % start_label)
 
         if self.generate_comments and node.token:
             startpos = node.token.start
@@ -568,28 +951,42 @@ class CodeGenerator(syntaxtree.TreeWalker):
                 endpos = len(node.token.line.rstrip())
             self.write('/* %s */' % node.token.line[startpos:endpos])
         
-        # XXX: Putting the test blindly inside the label will cause the program
-        # to load the variable from memory at the start of the loop, with
-        # results in an infinite loop if the test variable is unreferenced
-        # before the loop. Programs testing uninitialized variables are
-        # ill formed anyway. A workaround would be to load all variables at the
-        # start of a function.
-        test_reg = self.visit(node.test)
-        self.write('if (!%s) goto %s;' % (test_reg, end_label))
+        # The loop is rotated into a guarded do-while: the test is evaluated
+        # once before entering, and again at the bottom of the body where it
+        # jumps back to the start. That's one branch per iteration instead of
+        # a test at the top and a goto back to it. Variables are loaded into
+        # registers at the start of the procedure, so the values in registers
+        # at the end of the body are still live at the start label.
+        self.write_counter(profiling.LOOP, node.token)
+        self.write_loop_test(node.test, '!', end_label)
+        self.loop_depth += 1
+        self.write('\n%s:' % start_label, indent='')
+        self.write_counter(profiling.ITERATION, node.token)
         
         for statement in node.body:
             self.visit(statement)
             
         self.visit(node.assignment)
-        self.write('goto %s;' % start_label)
+        self.write_loop_test(node.test, '', start_label)
+        self.loop_depth -= 1
             
-        self.write('\n%s:' % end_label)
+        self.write('\n%s:' % end_label, indent='')
+    
+    def write_loop_test(self, test, negation, label):
+        test_reg = self.visit(test)
+        self.write('if (%s%s) goto %s;' % (negation, test_reg, label))
         
     def visit_return(self, node):
         self.write('goto %s;' % self.get_end_label(self.current_procedure))
         
-def output_code(ast, output_file=sys.stdout, generate_comments=False):
-    CodeGenerator(output_file=output_file, generate_comments=generate_comments).walk(ast)
+def output_code(ast, output_file=sys.stdout, generate_comments=False, check_bounds=False,
+                profile_file=None, profile=None, register_count=regalloc.REGISTER_COUNT):
+    '''Generate the code for a program, and return the number of boolean operand checks that were left out.'''
+    generator = CodeGenerator(output_file=output_file, generate_comments=generate_comments,
+                              check_bounds=check_bounds, profile_file=profile_file,
+                              profile=profile, register_count=register_count)
+    generator.walk(ast)
+    return generator.removed_checks
         
 if __name__ == '__main__':
     import argparse
@@ -602,9 +999,14 @@ if __name__ == '__main__':
     argparser.add_argument('filename', help='the file to parse')
     argparser.add_argument('-r', '--include-runtime', action='store_true',
                             help='include definitions of the runtime functions')
+    argparser.add_argument('-b', '--check-bounds', action='store_true',
+                            help='check that array indexes are in bounds')
+    argparser.add_argument('-p', '--profile-generate', metavar='PROFILE',
+                            help='count how often the code runs, and write the counts to PROFILE')
     args = argparser.parse_args()
 
     ast = parser.parse_tokens(scanner.tokenize_file(args.filename),
                               include_runtime=args.include_runtime)
     if typechecker.tree_is_valid(ast):
-        CodeGenerator(generate_comments=True).walk(ast)
+        CodeGenerator(generate_comments=True, check_bounds=args.check_bounds,
+                      profile_file=args.profile_generate).walk(ast)
@@ -0,0 +1,389 @@
+'''Build control flow graphs for the procedures of a program.
+
+A ControlFlowGraph lowers the body of a single ProcDecl or Program into basic
+blocks. Blocks hold the original Assign and Call nodes from the AST rather than
+copies, so passes that work on the graph can update the tree directly.
+
+A block that ends in a conditional jump stores the test expression and the If
+or For node it came from. Its first successor is taken when the test is true,
+and its second when it is false. The graph mirrors the code generated for each
+statement:
+
+    If:  the test block jumps to the body or the orelse (or the join block if
+         there is no orelse), and both fall through to the join block.
+    For: the block before the loop falls through to a header that holds the
+         test. The header jumps to the body or to the block after the loop. The
+         last block of the body holds the loop's assignment and jumps back to
+         the header. (The generated code duplicates the test before the loop
+         and at the end of the body, which doesn't change the values it reads.)
+    Return: jumps to the exit block.
+
+Every graph has a single entry and a single, empty exit block. Blocks that can't
+be reached from the entry, like code after a return, are not included.
+
+Statements can be added on the edges into If joins and loop headers with
+insert_on_edge, which finds the place in the AST that is only executed when
+control flows along that edge.
+'''
+
+import sys
+
+import syntaxtree
+
+class BasicBlock(object):
+    def __init__(self, index):
+        # The position of the block in the graph's list of blocks.
+        self.index = index
+
+        # Assign and Call statements, in the order they are executed.
+        self.statements = []
+
+        # The test of a conditional jump at the end of the block, and the If or
+        # For node that it belongs to.
+        self.test = None
+        self.branch = None
+
+        self.successors = []
+        self.predecessors = []
+
+    def __repr__(self):
+        return '<BasicBlock %d>' % self.index
+
+class Loop(object):
+    '''A natural loop, made up of a header and the blocks that can reach one of
+    its back edges without passing through the header.'''
+    def __init__(self, header):
+        self.header = header
+        self.blocks = set([header])
+
+        # The sources of the back edges to the header.
+        self.latches = []
+
+        # The For statement that created the loop, if there is one.
+        self.node = header.branch if isinstance(header.branch, syntaxtree.For) else None
+
+        self.parent = None
+        self.children = []
+
+    @property
+    def depth(self):
+        '''The number of loops that contain this loop, including itself.'''
+        depth = 0
+        loop = self
+        while loop is not None:
+            depth += 1
+            loop = loop.parent
+        return depth
+
+    def exits(self):
+        '''Return a list of (block, successor) edges that leave the loop.'''
+        return [(block, successor) for block in self.blocks
+                for successor in block.successors
+                if successor not in self.blocks]
+
+    def __repr__(self):
+        return '<Loop header=%d blocks=%s>' % (self.header.index,
+                                               sorted(b.index for b in self.blocks))
+
+class ControlFlowGraph(object):
+    def __init__(self, procedure):
+        self.procedure = procedure
+        self.blocks = []
+
+        # Maps (source, target) edges to where statements on that edge go in
+        # the AST. See insert_on_edge.
+        self.edge_locations = {}
+
+        self.entry = self.new_block()
+        self.exit = BasicBlock(None)
+        end = self.build_body(procedure.body, self.entry)
+        if end is not None:
+            self.add_edge(end, self.exit)
+        self.remove_unreachable_blocks()
+        self.exit.index = len(self.blocks)
+        self.blocks.append(self.exit)
+
+        self._idom = None
+        self._loops = None
+
+    def new_block(self):
+        block = BasicBlock(len(self.blocks))
+        self.blocks.append(block)
+        return block
+
+    def add_edge(self, source, target):
+        source.successors.append(target)
+        target.predecessors.append(source)
+
+    def build_body(self, statements, block):
+        '''Add a list of statements to the graph, starting in a block.
+
+        Returns the block that control falls through to after the statements, or
+        None if they always return.'''
+        for statement in statements:
+            if block is None:
+                # Statements after a return are unreachable, but they still get
+                # a block so that the rest of the graph is built normally.
+                block = self.new_block()
+
+            if isinstance(statement, syntaxtree.If):
+                block.test = statement.test
+                block.branch = statement
+                body = self.new_block()
+                self.add_edge(block, body)
+                if statement.orelse:
+                    orelse = self.new_block()
+                    self.add_edge(block, orelse)
+                join = self.new_block()
+                if not statement.orelse:
+                    self.add_edge(block, join)
+                    # Statements on the edge for a false test go in the orelse.
+                    self.edge_locations[block, join] = (statement.orelse, None)
+
+                end = self.build_body(statement.body, body)
+                if end is not None:
+                    self.add_edge(end, join)
+                    self.edge_locations[end, join] = (statement.body, None)
+                if statement.orelse:
+                    end = self.build_body(statement.orelse, orelse)
+                    if end is not None:
+                        self.add_edge(end, join)
+                        self.edge_locations[end, join] = (statement.orelse, None)
+                block = join
+
+            elif isinstance(statement, syntaxtree.For):
+                header = self.new_block()
+                self.add_edge(block, header)
+                self.edge_locations[block, header] = (statements, statement)
+                header.test = statement.test
+                header.branch = statement
+                body = self.new_block()
+                after = self.new_block()
+                self.add_edge(header, body)
+                self.add_edge(header, after)
+
+                end = self.build_body(statement.body, body)
+                if end is not None:
+                    end.statements.append(statement.assignment)
+                    self.add_edge(end, header)
+                    self.edge_locations[end, header] = (None, statement)
+                block = after
+
+            elif isinstance(statement, syntaxtree.Return):
+                self.add_edge(block, self.exit)
+                block = None
+
+            else:
+                block.statements.append(statement)
+        return block
+
+    def insert_on_edge(self, source, target, statements):
+        '''Add statements to the AST that run only when control flows from source to target.
+
+        This is supported for edges into the join block of an If and into the
+        header of a For. Only the AST is changed, so the graph should be rebuilt
+        afterwards.'''
+        if not statements:
+            return
+        body, before = self.edge_locations[source, target]
+        if body is None:
+            # This is the back edge of a loop. The statements have to run after
+            # the loop's assignment, so it's moved to the end of the body and
+            # the last statement takes its place.
+            body = before.body
+            body.append(before.assignment)
+            body.extend(statements[:-1])
+            before.assignment = statements[-1]
+        elif before is None:
+            body.extend(statements)
+        else:
+            index = next(i for i, s in enumerate(body) if s is before)
+            body[index:index] = statements
+
+    def remove_unreachable_blocks(self):
+        reachable = set(self.postorder(self.entry))
+        for block in self.blocks:
+            if block not in reachable:
+                for successor in block.successors:
+                    successor.predecessors.remove(block)
+        self.blocks = [b for b in self.blocks if b in reachable]
+        for i, block in enumerate(self.blocks):
+            block.index = i
+
+    def postorder(self, start=None):
+        '''Return the blocks reachable from a block (the entry by default) in postorder.'''
+        if start is None:
+            start = self.entry
+        visited = set([start])
+        order = []
+        stack = [(start, iter(start.successors))]
+        while stack:
+            block, successors = stack[-1]
+            for successor in successors:
+                if successor not in visited:
+                    visited.add(successor)
+                    stack.append((successor, iter(successor.successors)))
+                    break
+            else:
+                stack.pop()
+                order.append(block)
+        return order
+
+    def reverse_postorder(self):
+        return self.postorder()[::-1]
+
+    def immediate_dominator(self, block):
+        '''Return the immediate dominator of a block, or None for the entry.'''
+        if self._idom is None:
+            self._idom = self.compute_dominators()
+        return self._idom[block]
+
+    def compute_dominators(self):
+        # This is the iterative algorithm from "A Simple, Fast Dominance
+        # Algorithm" by Cooper, Harvey, and Kennedy.
+        order = self.reverse_postorder()
+        position = dict((block, i) for i, block in enumerate(order))
+        idom = {self.entry: self.entry}
+
+        def intersect(a, b):
+            while a is not b:
+                while position[a] > position[b]:
+                    a = idom[a]
+                while position[b] > position[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for block in order[1:]:
+                new_idom = None
+                for predecessor in block.predecessors:
+                    if predecessor in idom:
+                        if new_idom is None:
+                            new_idom = predecessor
+                        else:
+                            new_idom = intersect(predecessor, new_idom)
+                if idom.get(block) is not new_idom:
+                    idom[block] = new_idom
+                    changed = True
+
+        idom[self.entry] = None
+        # The exit block is unreachable if the procedure never terminates.
+        idom.setdefault(self.exit, None)
+        return idom
+
+    def dominates(self, a, b):
+        '''Return whether every path from the entry to block b passes through block a.'''
+        while b is not None:
+            if b is a:
+                return True
+            b = self.immediate_dominator(b)
+        return False
+
+    def dominator_tree(self):
+        '''Return a dict mapping each block to a list of the blocks it immediately dominates.'''
+        children = dict((block, []) for block in self.blocks)
+        for block in self.blocks:
+            parent = self.immediate_dominator(block)
+            if parent is not None:
+                children[parent].append(block)
+        return children
+
+    def dominance_frontiers(self):
+        '''Return a dict mapping each block to the set of blocks in its dominance frontier.'''
+        frontiers = dict((block, set()) for block in self.blocks)
+        for block in self.blocks:
+            if len(block.predecessors) < 2:
+                continue
+            idom = self.immediate_dominator(block)
+            for predecessor in block.predecessors:
+                runner = predecessor
+                while runner is not idom and runner is not None:
+                    frontiers[runner].add(block)
+                    runner = self.immediate_dominator(runner)
+        return frontiers
+
+    def loops(self):
+        '''Return a list of the natural loops in the graph, with outer loops before inner loops.'''
+        if self._loops is None:
+            self._loops = self.find_loops()
+        return self._loops
+
+    def find_loops(self):
+        loops = {}
+        for block in self.reverse_postorder():
+            for successor in block.successors:
+                if self.dominates(successor, block):
+                    # Back edges to the same header belong to the same loop.
+                    loop = loops.get(successor)
+                    if loop is None:
+                        loop = loops[successor] = Loop(successor)
+                    loop.latches.append(block)
+                    stack = [block]
+                    while stack:
+                        member = stack.pop()
+                        if member not in loop.blocks:
+                            loop.blocks.add(member)
+                            stack.extend(member.predecessors)
+
+        # Sort from the largest loop to the smallest, so that the innermost
+        # loop containing each header is found last.
+        ordered = sorted(loops.itervalues(), key=lambda l: -len(l.blocks))
+        for i, loop in enumerate(ordered):
+            for outer in reversed(ordered[:i]):
+                if loop.header in outer.blocks:
+                    loop.parent = outer
+                    outer.children.append(loop)
+                    break
+        return ordered
+
+    def innermost_loop(self, block):
+        '''Return the innermost loop containing a block, or None if it isn't in a loop.'''
+        for loop in reversed(self.loops()):
+            if block in loop.blocks:
+                return loop
+        return None
+
+    def loop_depth(self, block):
+        '''Return the number of loops containing a block.'''
+        loop = self.innermost_loop(block)
+        return 0 if loop is None else loop.depth
+
+def build_graphs(program):
+    '''Return a list of the control flow graphs of the program and each procedure in it.'''
+    return [ControlFlowGraph(p) for p in syntaxtree.iter_procedures(program)]
+
+def dump_graph(graph, output=sys.stdout.write):
+    output('%s:\n' % graph.procedure.name.id)
+    for block in graph.blocks:
+        if block is graph.exit:
+            output('  exit %d\n' % block.index)
+            continue
+        output('  block %d (preds %s, idom %s)\n' % (
+            block.index, [p.index for p in block.predecessors],
+            getattr(graph.immediate_dominator(block), 'index', None)))
+        for statement in block.statements:
+            output('    %r\n' % statement)
+        if block.test is not None:
+            output('    if %r goto %d else %d\n' % (block.test, block.successors[0].index,
+                                                  block.successors[1].index))
+        elif block.successors:
+            output('    goto %d\n' % block.successors[0].index)
+    for loop in graph.loops():
+        output('  %r depth %d\n' % (loop, loop.depth))
+
+if __name__ == '__main__':
+    import argparse
+    import scanner
+    import parser
+    import typechecker
+
+    argparser = argparse.ArgumentParser(description='Print the control flow graph of each procedure in a program.')
+
+    argparser.add_argument('filename', help='the file to parse')
+    args = argparser.parse_args()
+    ast = parser.parse_tokens(scanner.tokenize_file(args.filename))
+    if typechecker.tree_is_valid(ast):
+        for graph in build_graphs(ast):
+            dump_graph(graph)
@@ -0,0 +1,191 @@
+'''Cache the results of optimizing procedures on disk between builds.
+
+Each procedure is stored under a key that hashes everything its optimization
+can depend on: the source of the compiler, the optimization options, the
+procedure's own tree, the trees of every procedure it calls directly or
+indirectly (which inlining copies and whose effects the other passes use), and
+the global variable declarations. A procedure whose key is in the cache gets
+its optimized body and local variables from it instead of being optimized
+again (see PassManager). The program body and the runtime procedures aren't
+cached.
+
+Trees are hashed by their structure and types, and by the positions of their
+tokens relative to the first line of the procedure, so that a procedure that
+only moved to a different line is still found, and the tokens of its cached
+tree are moved by the same number of lines when it's loaded. With a profile,
+tokens are hashed by their absolute positions, since that's how the profile
+finds their counts.
+
+The cache is a directory with one file per procedure. Files are touched when
+they're read, and once the directory grows past its maximum size, the files
+that were used least recently are removed.
+'''
+
+import cPickle
+import hashlib
+import os
+import tempfile
+
+import syntaxtree
+import callgraph
+
+# Change this to invalidate every entry written by older versions of the cache.
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+ENTRY_SUFFIX = '.proc'
+
+def compiler_fingerprint():
+    '''Return a hash of the source of the compiler, so that entries from other versions of it aren't used.'''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.py'):
+            with open(os.path.join(directory, filename), 'rb') as f:
+                digest.update(filename)
+                digest.update(f.read())
+    return digest.hexdigest()
+
+def base_line(procedure, absolute_lines=False):
+    '''Return the line that the positions of a procedure's tokens are relative to.'''
+    if absolute_lines or procedure.name.token is None:
+        return 0
+    return procedure.name.token.lineno
+
+def is_cacheable(procedure):
+    return (isinstance(procedure, syntaxtree.ProcDecl) and
+            not (procedure.is_global and procedure.name.id in callgraph.RUNTIME_PROCEDURES))
+
+def serialize(node, base):
+    '''Return a nested tuple of the fields, types, and token positions of a tree.'''
+    if isinstance(node, list):
+        return tuple(serialize(child, base) for child in node)
+    if not isinstance(node, syntaxtree.Node):
+        return node
+    token = node.token
+    if token is not None:
+        token = (token.lineno - base, token.start, token.line)
+    return ((type(node).__name__, node.node_type, token) +
+            tuple(serialize(field, base) for field in node))
+
+def procedure_closure(procedure, graph):
+    '''Return a list of a procedure and every procedure it calls directly or indirectly.'''
+    closure = []
+    seen = set()
+    stack = [procedure]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        closure.append(node)
+        stack.extend(reversed(graph.callees(node)))
+    return closure
+
+def procedure_key(procedure, graph, options, absolute_lines=False):
+    '''Return the cache key of a procedure, given a hashable tuple of the optimization options.
+
+    The number of call sites of each procedure in the closure is included too,
+    since the inliner uses it to decide what to inline.'''
+    base = base_line(procedure, absolute_lines)
+    global_decls = [d for d in graph.program.decls
+                    if isinstance(d, syntaxtree.VarDecl) and d.is_global]
+    parts = [CACHE_VERSION, options, serialize(global_decls, base)]
+    for node in procedure_closure(procedure, graph):
+        call_sites = sum(1 for caller in graph.callers(node)
+                         for call, decl in graph.calls(caller) if decl is node)
+        parts.append((serialize(node, base), call_sites))
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def move_tokens(node, lines):
+    '''Add a number of lines to the line numbers of the tokens in a tree.'''
+    if isinstance(node, list):
+        for child in node:
+            move_tokens(child, lines)
+    elif isinstance(node, syntaxtree.Node):
+        if node.token is not None:
+            node.token = node.token._replace(lineno=node.token.lineno + lines)
+        for field in node:
+            move_tokens(field, lines)
+
+class OptimizationCache(object):
+    '''A directory of optimized procedures, limited to max_size bytes.'''
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.fingerprint = compiler_fingerprint()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def key(self, procedure, graph, options, absolute_lines=False):
+        return procedure_key(procedure, graph, (self.fingerprint, options), absolute_lines)
+
+    def load(self, key, procedure, absolute_lines=False):
+        '''Replace the body and local variables of a procedure with its cached ones, and return whether there were any.
+
+        Entries that can't be read are treated as missing.'''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                base, body, variables = cPickle.load(f)
+            os.utime(path, None)
+        except Exception:
+            # Unpickling a damaged entry can raise almost anything.
+            self.misses += 1
+            return False
+
+        move_tokens(body, base_line(procedure, absolute_lines) - base)
+        move_tokens(variables, base_line(procedure, absolute_lines) - base)
+        procedure.body = body
+        procedure.decls = variables + [d for d in procedure.decls
+                                       if isinstance(d, syntaxtree.ProcDecl)]
+        self.hits += 1
+        return True
+
+    def store(self, key, procedure, absolute_lines=False):
+        '''Write the body and local variables of an optimized procedure to the cache.'''
+        variables = [d for d in procedure.decls if isinstance(d, syntaxtree.VarDecl)]
+        entry = (base_line(procedure, absolute_lines), procedure.body, variables)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Entries are written to a temporary file first, so that other
+            # builds never read a partial entry.
+            fd, temporary = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+                os.rename(temporary, self.path(key))
+            except:
+                os.remove(temporary)
+                raise
+        except (IOError, OSError):
+            # The cache is only an optimization, so builds don't fail because
+            # it can't be written.
+            return
+        self.evict()
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache is at most max_size bytes.'''
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(ENTRY_SUFFIX):
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
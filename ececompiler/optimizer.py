@@ -8,73 +8,464 @@ Level 1: Minimal optimization is performed.
 Level 2: More extensive optimization is performed that may produce code that is
 not equivalent to the original code.
 
+Instead of a level, a pipeline of passes can be given by name, like
+'sccp,propagate,dce'. The passes are registered with register_pass, and the
+analyses they use, like the call graph, liveness, and SSA form, with
+register_analysis.
+
+With a Profile from an instrumented run of the program (see the profiling
+module), inlining and unrolling spend more code on the calls and loops that
+ran often, and none on the ones that never ran.
+
 The optimizer assumes the AST is both syntactically and semantically valid.
 '''
 
+import collections
 import itertools
+import operator
+import struct
 
 import tokens
 import syntaxtree
+import callgraph
+import controlflow
+import optcache
+import profiling
+import ranges
+import ssa
+
+# The folding tables below evaluate operators with the same semantics as the
+# generated C code: ints are 32-bit two's complement values that wrap on
+# overflow, division truncates toward zero, floats are rounded to single
+# precision after every operation, and boolean operators are subject to the
+# domain check performed by validateBooleanOp in the runtime.
+
+INT_MIN = -2**31
+
+def to_int32(value):
+    '''Wrap an integer to a signed 32-bit value.'''
+    value &= 0xffffffff
+    if value & 0x80000000:
+        return value - 0x100000000
+    return value
+
+def to_float32(value):
+    '''Round a number to the nearest single precision float.'''
+    try:
+        return struct.unpack('f', struct.pack('f', value))[0]
+    except OverflowError:
+        return float('inf') if value > 0 else float('-inf')
+
+def c_divide(a, b):
+    '''Divide two ints, truncating toward zero like C.'''
+    quotient = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        return -quotient
+    return quotient
+
+INT_BINARY_OPERATORS = {
+    tokens.PLUS: operator.add,
+    tokens.MINUS: operator.sub,
+    tokens.MULTIPLY: operator.mul,
+    tokens.DIVIDE: c_divide,
+    tokens.AND: operator.and_,
+    tokens.OR: operator.or_,
+    tokens.LT: operator.lt,
+    tokens.LTE: operator.le,
+    tokens.GT: operator.gt,
+    tokens.GTE: operator.ge,
+    tokens.EQUAL: operator.eq,
+    tokens.NOTEQUAL: operator.ne,
+}
+
+FLOAT_BINARY_OPERATORS = {
+    tokens.PLUS: operator.add,
+    tokens.MINUS: operator.sub,
+    tokens.MULTIPLY: operator.mul,
+    tokens.DIVIDE: operator.truediv,
+    tokens.LT: operator.lt,
+    tokens.LTE: operator.le,
+    tokens.GT: operator.gt,
+    tokens.GTE: operator.ge,
+    tokens.EQUAL: operator.eq,
+    tokens.NOTEQUAL: operator.ne,
+}
+
+# The bitwise operators produce bools rather than ints when applied to bools.
+BOOL_RESULT_OPERATORS = frozenset((tokens.AND, tokens.OR))
+
+def literal_value(n):
+    '''Return the Python value of the string in a Num node.'''
+    if n == tokens.TRUE:
+        return 1
+    if n == tokens.FALSE:
+        return 0
+    if '.' in n:
+        return float(n)
+    return int(n, 10)
+
+def format_float(value):
+    '''Return the Num string for a float, or None if it has no literal form.'''
+    if value != value or value in (float('inf'), float('-inf')):
+        return None
+    n = repr(value)
+    if '.' not in n:
+        # The type checker and code generator identify floats by their decimal
+        # point, so exponent forms like 1e+20 need one added.
+        mantissa, _, exponent = n.partition('e')
+        n = '%s.0e%s' % (mantissa, exponent)
+    return n
+
+def make_literal(value):
+    '''Return a Num node for a folded value, or None if it has no literal form.'''
+    if value is True:
+        return syntaxtree.Num(tokens.TRUE)
+    if value is False:
+        return syntaxtree.Num(tokens.FALSE)
+    if isinstance(value, float):
+        n = format_float(value)
+        if n is None:
+            return None
+        return syntaxtree.Num(n)
+    return syntaxtree.Num(str(value))
+
+def fold_binary(op, node_type, left, right):
+    '''Evaluate a binary operator on the strings of two Num nodes.
+
+    Returns a Num node with the result, or None if the operation can't be folded
+    because it would fail or is undefined at runtime.'''
+    a = literal_value(left)
+    b = literal_value(right)
+
+    if node_type == tokens.FLOAT:
+        function = FLOAT_BINARY_OPERATORS.get(op)
+        if function is None:
+            return None
+        a = to_float32(a)
+        b = to_float32(b)
+        if op == tokens.DIVIDE and b == 0:
+            return None
+        result = function(a, b)
+        if isinstance(result, bool):
+            return make_literal(result)
+        return make_literal(to_float32(result))
+
+    function = INT_BINARY_OPERATORS.get(op)
+    if function is None:
+        return None
+    if node_type == tokens.BOOL and (a not in (0, 1) or b not in (0, 1)):
+        # validateBooleanOp aborts the program on these operands, so the
+        # operation has to stay in the code.
+        return None
+    a = to_int32(a)
+    b = to_int32(b)
+    if op == tokens.DIVIDE and (b == 0 or (a == INT_MIN and b == -1)):
+        return None
+    result = function(a, b)
+    if isinstance(result, bool):
+        return make_literal(result)
+    if node_type == tokens.BOOL and op in BOOL_RESULT_OPERATORS:
+        return make_literal(bool(result))
+    return make_literal(to_int32(result))
+
+def fold_unary(op, node_type, operand):
+    '''Evaluate a unary operator on the string of a Num node.
+
+    Returns a Num node with the result, or None if the operation can't be
+    folded.'''
+    a = literal_value(operand)
+    if op == tokens.MINUS:
+        if node_type == tokens.FLOAT:
+            return make_literal(-to_float32(a))
+        return make_literal(to_int32(-a))
+    if op == tokens.NOT:
+        if node_type == tokens.BOOL:
+            if a not in (0, 1):
+                return None
+            return make_literal(not a)
+        return make_literal(to_int32(~a))
+    return None
 
 class ConstantFolder(syntaxtree.TreeMutator):
     '''Optimizer that performs constant folding within single expressions.'''
     def __init__(self):
         super(ConstantFolder, self).__init__()
-        
+
         self.visit_functions = {
             syntaxtree.BinaryOp: self.visit_binary_op,
             syntaxtree.UnaryOp: self.visit_unary_op,
         }
-        
+
     def get_const(self, node):
-        '''Return the value of a constant AST node, or None if the node is not a number.'''
+        '''Return the string of a constant AST node, or None if the node is not a number.'''
         if isinstance(node, syntaxtree.Num):
-            if node.n == tokens.TRUE:
-                return 'True'
-            if node.n == tokens.FALSE:
-                return 'False'
             return node.n
         return None
-    
+
     def visit_binary_op(self, node):
         # Fold children first so that we can fold parts of an expression even if
         # the entire expression is not constant.
         self.visit_children(node)
-        
+
         left = self.get_const(node.left)
         if left is not None:
             right = self.get_const(node.right)
             if right is not None:
-                op = node.op
-                if node.node_type == tokens.BOOL:
-                    if op == tokens.AND:
-                        op = 'and'
-                    elif op == tokens.OR:
-                        op = 'or'
-                result = eval('%s %s %s' % (left, op, right))
-                if result is True:
-                    return syntaxtree.Num('true')
-                if result is False:
-                    return syntaxtree.Num('false')
-                return syntaxtree.Num(str(result))
+                result = fold_binary(node.op, node.node_type, left, right)
+                if result is not None:
+                    return result
         return node
-    
+
     def visit_unary_op(self, node):
         self.visit_children(node)
-        
+
         operand = self.get_const(node.operand)
         if operand is not None:
-            op = node.op
-            if op == tokens.NOT and node.node_type == tokens.INT:
-                # 32-bit NOT
-                return syntaxtree.Num(str(eval('(~%s) & 0xffffffff' % operand)))
-            result = eval('%s %s' % (node.op, operand))
-            if result is True:
-                return syntaxtree.Num('true')
-            if result is False:
-                return syntaxtree.Num('false')
-            return syntaxtree.Num(str(result))
+            result = fold_unary(node.op, node.node_type, operand)
+            if result is not None:
+                return result
+        return node
+
+def constant_value(node):
+    '''Return the value of a numeric literal, or None if the node isn't one.'''
+    if isinstance(node, syntaxtree.Num) and node.n not in (tokens.TRUE, tokens.FALSE):
+        return literal_value(node.n)
+    return None
+
+def split_constant(node, ops):
+    '''Return the other operand and the value of the constant of an int operator in ops with a literal operand.
+
+    A constant that's subtracted is negated. Returns None if the node isn't
+    like that.'''
+    if (not isinstance(node, syntaxtree.BinaryOp) or node.op not in ops or
+        node.node_type != tokens.INT):
+        return None
+    right = constant_value(node.right)
+    if right is not None:
+        if node.op == tokens.MINUS:
+            return node.left, to_int32(-right)
+        return node.left, right
+    left = constant_value(node.left)
+    if left is not None and node.op != tokens.MINUS:
+        return node.right, left
+    return None
+
+def make_operator(op, left, right, node):
+    '''Return a new BinaryOp of the same type and token as an existing node.'''
+    new_node = syntaxtree.BinaryOp(op, left, right, token=node.token)
+    new_node.node_type = node.node_type
+    return new_node
+
+def make_negation(operand, node):
+    new_node = syntaxtree.UnaryOp(tokens.MINUS, operand, token=node.token)
+    new_node.node_type = node.node_type
+    return new_node
+
+def power_of_two(value):
+    '''Return k if a value is 2**k for some k from 1 to 30, otherwise None.'''
+    if value is None or isinstance(value, float) or value < 2 or value & (value - 1):
+        return None
+    k = value.bit_length() - 1
+    return k if k <= 30 else None
+
+def identity_operand(node, op, identity):
+    '''Return the operand of an operator that's combined with its identity element, or None.
+
+    The operand has to have the operator's type, so that replacing the operator
+    with it doesn't change how the value is stored.'''
+    if node.op != op:
+        return None
+    operands = [(node.left, node.right)]
+    if op in COMMUTATIVE_OPERATORS:
+        operands.append((node.right, node.left))
+    for operand, other in operands:
+        if constant_value(other) == identity and operand.node_type == node.node_type:
+            return operand
+    return None
+
+# The rules below take a BinaryOp or UnaryOp whose operands have already been
+# simplified, and return the node that replaces it, or None if they don't apply.
+# They follow the semantics of the generated C code: ints wrap, division
+# truncates toward zero, float identities have to hold for negative zero,
+# infinities, and NaNs, and a boolean operator can only be removed when its
+# operands are always 0 or 1, since it checks them at runtime.
+
+def simplify_add_zero(node):
+    '''x + 0 => x'''
+    if isinstance(node, syntaxtree.BinaryOp) and node.node_type == tokens.INT:
+        return identity_operand(node, tokens.PLUS, 0)
+
+def simplify_subtract_zero(node):
+    '''x - 0 => x, for ints and floats'''
+    if isinstance(node, syntaxtree.BinaryOp) and node.node_type in (tokens.INT, tokens.FLOAT):
+        return identity_operand(node, tokens.MINUS, 0)
+
+def simplify_subtract_self(node):
+    '''x - x => 0'''
+    if (isinstance(node, syntaxtree.BinaryOp) and node.op == tokens.MINUS and
+        node.node_type == tokens.INT and node.left == node.right):
+        return syntaxtree.Num('0')
+
+def simplify_subtract_from_zero(node):
+    '''0 - x => -x'''
+    if (isinstance(node, syntaxtree.BinaryOp) and node.op == tokens.MINUS and
+        node.node_type == tokens.INT and constant_value(node.left) == 0):
+        return make_negation(node.right, node)
+
+def simplify_multiply_one(node):
+    '''x * 1 => x and x / 1 => x, for ints and floats'''
+    if isinstance(node, syntaxtree.BinaryOp) and node.node_type in (tokens.INT, tokens.FLOAT):
+        return (identity_operand(node, tokens.MULTIPLY, 1) or
+                identity_operand(node, tokens.DIVIDE, 1))
+
+def simplify_multiply_zero(node):
+    '''x * 0 => 0'''
+    if (isinstance(node, syntaxtree.BinaryOp) and node.op == tokens.MULTIPLY and
+        node.node_type == tokens.INT and 0 in (constant_value(node.left),
+                                               constant_value(node.right))):
+        return syntaxtree.Num('0')
+
+def simplify_multiply_minus_one(node):
+    '''x * -1 => -x'''
+    if (isinstance(node, syntaxtree.BinaryOp) and node.op == tokens.MULTIPLY and
+        node.node_type == tokens.INT):
+        if constant_value(node.right) == -1:
+            return make_negation(node.left, node)
+        if constant_value(node.left) == -1:
+            return make_negation(node.right, node)
+
+def simplify_masks(node):
+    '''x & -1 => x, x | 0 => x, x & 0 => 0, x | -1 => -1, and x & x => x | x => x'''
+    if (not isinstance(node, syntaxtree.BinaryOp) or node.node_type != tokens.INT or
+        node.op not in (tokens.AND, tokens.OR)):
+        return None
+    if node.left == node.right:
+        return node.left
+    operand = identity_operand(node, tokens.AND, -1) or identity_operand(node, tokens.OR, 0)
+    if operand is not None:
+        return operand
+    absorbing = 0 if node.op == tokens.AND else -1
+    if absorbing in (constant_value(node.left), constant_value(node.right)):
+        return syntaxtree.Num(str(absorbing))
+
+def simplify_double_negation(node):
+    '''-(-x) => x and not (not x) => x'''
+    if (not isinstance(node, syntaxtree.UnaryOp) or
+        not isinstance(node.operand, syntaxtree.UnaryOp) or
+        node.op != node.operand.op):
+        return None
+    operand = node.operand.operand
+    if operand.node_type != node.node_type:
+        return None
+    if (node.op == tokens.NOT and node.node_type == tokens.BOOL and
+        not ranges.is_boolean(ranges.expression_range(operand, {}))):
+        return None
+    return operand
+
+def simplify_reassociate(node):
+    '''(x + c1) + c2 => x + (c1 + c2), and likewise for -, *, &, and |'''
+    for ops in ((tokens.PLUS, tokens.MINUS), (tokens.MULTIPLY,), (tokens.AND,), (tokens.OR,)):
+        outer = split_constant(node, ops)
+        if outer is None:
+            continue
+        inner = split_constant(outer[0], ops)
+        if inner is None:
+            return None
+        operand, constant = inner[0], outer[1]
+        if ops[0] == tokens.PLUS:
+            constant = to_int32(inner[1] + constant)
+            if constant < 0 and constant != INT_MIN:
+                return make_operator(tokens.MINUS, operand, syntaxtree.Num(str(-constant)), node)
+            return make_operator(tokens.PLUS, operand, syntaxtree.Num(str(constant)), node)
+        constant = to_int32(INT_BINARY_OPERATORS[ops[0]](inner[1], constant))
+        return make_operator(ops[0], operand, syntaxtree.Num(str(constant)), node)
+    return None
+
+def reduce_multiply(node):
+    '''x * 2**k => x << k'''
+    if (isinstance(node, syntaxtree.BinaryOp) and node.op == tokens.MULTIPLY and
+        node.node_type == tokens.INT):
+        for operand, other in ((node.left, node.right), (node.right, node.left)):
+            k = power_of_two(constant_value(other))
+            if k is not None:
+                return make_operator(tokens.LSHIFT, operand, syntaxtree.Num(str(k)), node)
+
+def reduce_divide(node):
+    '''x / 2**k => (x + ((x >> 31) & (2**k - 1))) >> k
+
+    Division truncates toward zero, but shifts round down, so negative
+    dividends are rounded up first by adding the divisor minus one. x is read
+    twice, so this is only done when it's a variable.'''
+    if (isinstance(node, syntaxtree.BinaryOp) and node.op == tokens.DIVIDE and
+        node.node_type == tokens.INT and isinstance(node.left, syntaxtree.Name)):
+        k = power_of_two(constant_value(node.right))
+        if k is not None:
+            sign = make_operator(tokens.RSHIFT, node.left, syntaxtree.Num('31'), node)
+            bias = make_operator(tokens.AND, sign, syntaxtree.Num(str((1 << k) - 1)), node)
+            dividend = make_operator(tokens.PLUS, node.left, bias, node)
+            return make_operator(tokens.RSHIFT, dividend, syntaxtree.Num(str(k)), node)
+
+# Tables of (name, rule) pairs, in the order the rules are tried. The
+# simplification rules leave expressions in forms that the other passes
+# recognize. The strength reduction rules replace multiplication and division
+# with shifts, so they're applied after everything else at -O2.
+SIMPLIFICATION_RULES = [
+    ('add-zero', simplify_add_zero),
+    ('subtract-zero', simplify_subtract_zero),
+    ('subtract-self', simplify_subtract_self),
+    ('subtract-from-zero', simplify_subtract_from_zero),
+    ('multiply-one', simplify_multiply_one),
+    ('multiply-zero', simplify_multiply_zero),
+    ('multiply-minus-one', simplify_multiply_minus_one),
+    ('masks', simplify_masks),
+    ('double-negation', simplify_double_negation),
+    ('reassociate', simplify_reassociate),
+]
+
+STRENGTH_REDUCTION_RULES = [
+    ('multiply-power-of-two', reduce_multiply),
+    ('divide-power-of-two', reduce_divide),
+]
+
+class AlgebraicSimplifier(ConstantFolder):
+    '''Optimizer that folds constants and rewrites expressions with a table of rules.
+    
+    The rules are tried in order on each operator once its operands have been
+    simplified. When one applies, the rules are tried again on the node that
+    replaced it. The number of times each rule applied is counted in hits,
+    by the names in the table.'''
+    def __init__(self, rules=SIMPLIFICATION_RULES, hits=None):
+        super(AlgebraicSimplifier, self).__init__()
+        self.rules = rules
+        self.hits = collections.Counter() if hits is None else hits
+        
+    def walk_procedure(self, node, program):
+        '''Simplify the expressions in the body of a single procedure or program.'''
+        for statement in node.body:
+            self.visit(statement)
+        return node
+        
+    def simplify(self, node):
+        while isinstance(node, (syntaxtree.BinaryOp, syntaxtree.UnaryOp)):
+            for name, rule in self.rules:
+                result = rule(node)
+                if result is not None:
+                    self.hits[name] += 1
+                    node = result
+                    break
+            else:
+                break
         return node
+        
+    def visit_binary_op(self, node):
+        return self.simplify(super(AlgebraicSimplifier, self).visit_binary_op(node))
+    
+    def visit_unary_op(self, node):
+        return self.simplify(super(AlgebraicSimplifier, self).visit_unary_op(node))
+
+# Local arrays with at most this many elements are replaced by scalars, and
+# the values of at most this many array elements are tracked at a time.
+DEFAULT_ARRAY_BUDGET = 16
 
 class ConstantPropagator(ConstantFolder):
     '''Optimize that performs both constant folding and propagation.
@@ -91,16 +482,42 @@ class ConstantPropagator(ConstantFolder):
     symbol table and invalidate that value if we reach a non-constant
     assignment. Since we do the propagation inline with folding, and the walk is
     in program order, this will produce correct code as long as we don't miss
-    any invalidations.'''
-    def __init__(self, print_errors=False):
+    any invalidations.
+    
+    Global variables are invalidated at every call, since the callee might
+    assign to them. If a call graph is given, only the globals and out
+    arguments that the callee might write to are invalidated. Arrays are
+    passed by reference whatever their direction, and the callee can pass an
+    in array on to an out parameter of another procedure, so any array
+    argument that the callee might write to is invalidated too. Out and array
+    parameters might be aliases of globals, so passing one to a call that
+    writes to it invalidates every global.
+    
+    The values of array elements that are assigned with constant indexes are
+    tracked too, but only up to array_budget elements at a time, since large
+    arrays could take up too much memory. Assigning to an element with an index
+    that isn't known invalidates every element of the array.'''
+    def __init__(self, print_errors=False, call_graph=None, array_budget=DEFAULT_ARRAY_BUDGET):
         super(ConstantFolder, self).__init__()
         
         self.print_errors = print_errors
+        self.call_graph = call_graph
+        self.array_budget = array_budget
+        
+        # When set, only this procedure is optimized, and nested procedures are
+        # left alone. See walk_procedure.
+        self.unit = None
         
         # Scopes store the value of variables known to be constant, and the
         # declarations of procedures, so that we can tell which parameters are in/out
         self.global_scope = {}
         self.scopes = [{}]
+        self.global_variables = set()
+        self.reference_params = set()
+        
+        # Each scope has a dict mapping the names of arrays to dicts of the
+        # known values of their elements by index.
+        self.elements = [{}]
         
         self.visit_functions = {
             syntaxtree.Program: self.visit_program,
@@ -108,6 +525,7 @@ class ConstantPropagator(ConstantFolder):
             syntaxtree.Assign: self.visit_assign,
             syntaxtree.BinaryOp: self.visit_binary_op,
             syntaxtree.UnaryOp: self.visit_unary_op,
+            syntaxtree.Subscript: self.visit_subscript,
             syntaxtree.If: self.visit_jump,
             syntaxtree.For: self.visit_jump,
             syntaxtree.Call: self.visit_call,
@@ -123,19 +541,65 @@ class ConstantPropagator(ConstantFolder):
     def is_literal(self, node):
         return isinstance(node, (syntaxtree.Num, syntaxtree.Str))
         
+    def walk_procedure(self, node, program):
+        '''Optimize the body of a single procedure or program.
+        
+        Procedures nested inside the node are not visited. The program is needed
+        to find the global declarations that are visible inside the node.'''
+        self.unit = node
+        if isinstance(node, syntaxtree.ProcDecl):
+            self.reference_params = set(p.var_decl.name for p in node.params
+                                        if callgraph.is_by_reference(p))
+        for decl in program.decls:
+            if decl.is_global:
+                if isinstance(decl, syntaxtree.ProcDecl):
+                    self.define_variable(decl.name, decl, is_global=True)
+                    continue
+                self.global_variables.add(decl.name)
+                if node is not program:
+                    # Global variables can be changed by any call, so their
+                    # values are never known inside of procedures.
+                    self.define_variable(decl.name, None, is_global=True)
+        return self.walk(node)
+        
     def enter_scope(self):
         self.scopes.append({})
+        self.elements.append({})
 
     def leave_scope(self):
         self.scopes.pop()
+        self.elements.pop()
 
     def define_variable(self, name, value, is_global=False):
         if isinstance(name, syntaxtree.Subscript):
-            name = name.name
+            # Don't propagate arrays, only their elements.
+            self.define_element(name, value)
+            return
+        # If it's an array, the whole array was written to.
+        self.elements[-1].pop(name, None)
         if is_global:
             self.global_scope[name] = value
         else:
             self.scopes[-1][name] = value
+            
+    def define_element(self, node, value):
+        '''Record the value of an array element, or forget the values of every element if the index isn't known.'''
+        elements = self.elements[-1]
+        index = constant_value(node.index)
+        if index is None:
+            elements.pop(node.name, None)
+            return
+        known = elements.setdefault(node.name, {})
+        known.pop(index, None)
+        if value is not None and sum(map(len, elements.itervalues())) < self.array_budget:
+            known[index] = value
+            
+    def get_element(self, node):
+        '''Return the known value of an array element, or None.'''
+        index = constant_value(node.index)
+        if index is None:
+            return None
+        return self.elements[-1].get(node.name, {}).get(index)
 
     def get_var(self, name):
         if isinstance(name, syntaxtree.Name):
@@ -176,17 +640,26 @@ class ConstantPropagator(ConstantFolder):
             value = self.get_var(node)
             if isinstance(value, syntaxtree.Num):
                     return value.n
+        elif isinstance(node, syntaxtree.Subscript):
+            value = self.get_element(node)
+            if isinstance(value, syntaxtree.Num):
+                return value.n
         return None
     
     def visit_program(self, node):
         for decl in node.decls:
             if isinstance(decl, syntaxtree.ProcDecl):
                 self.define_variable(decl.name, decl, decl.is_global)
+            elif decl.is_global:
+                self.global_variables.add(decl.name)
                 
         self.visit_children(node)
         return node
 
     def visit_procdecl(self, node):
+        if self.unit is not None and node is not self.unit:
+            return node
+        
         self.enter_scope()
         
         # Add this declaration to its own scope to allow recursion.
@@ -209,44 +682,194 @@ class ConstantPropagator(ConstantFolder):
         # self.visit_children will fold the value if possible
         if not self.stop_propagation:
             self.visit_children(node)
-        # Don't propagate arrays, since that could take up too much memory.
-        #if isinstance(node.target, syntaxtree.Name):
-        if self.stop_propagation or isinstance(node.target, syntaxtree.Subscript):
+        if self.stop_propagation:
             # Unset any variables we find if we're in a loop or branch
             self.define_variable(node.target, None)
         else:
-            if self.is_literal(node.value):
-                self.define_variable(node.target, node.value)
-            # Expressions consisting of a single variable don't get picked
-            # up by the constant folder.
-            if isinstance(node.value, syntaxtree.Name):
+            # Expressions consisting of a single variable or array element
+            # don't get picked up by the constant folder.
+            if isinstance(node.value, (syntaxtree.Name, syntaxtree.Subscript)):
                 const = self.get_const(node.value)
                 if const is not None:
-                    
-                    return syntaxtree.Assign(node.target, syntaxtree.Num(const),
+                    node = syntaxtree.Assign(node.target, syntaxtree.Num(const),
                                              token=node.token)
+            if self.is_literal(node.value):
+                self.define_variable(node.target, node.value)
+            else:
+                self.define_variable(node.target, None)
+        return node
+    
+    def visit_subscript(self, node):
+        # Replacing the index with its value lets the element's value be
+        # tracked. The element itself is replaced where it's read, like a Name.
+        self.visit_children(node)
+        const = self.get_const(node.index)
+        if const is not None and not isinstance(node.index, syntaxtree.Num):
+            node.index = syntaxtree.Num(const)
+            node.index.node_type = tokens.INT
+            self.modified_tree = True
         return node
     
     def visit_jump(self, node):
+        if isinstance(node, syntaxtree.For):
+            # The test and the start of the body are reached again after the
+            # end of the body, so anything assigned in the loop has to be
+            # invalidated before we get there.
+            for statement in syntaxtree.iter_statements([node]):
+                if isinstance(statement, syntaxtree.Assign):
+                    self.define_variable(statement.target, None)
+                elif isinstance(statement, syntaxtree.Call):
+                    self.invalidate_out_args(statement)
         self.stop_propagation.append(True)
         self.visit_children(node)
         self.stop_propagation.pop()
         return node
     
-    def visit_call(self, node):
+    def writes_param(self, decl, index):
+        if self.call_graph is None:
+            return True
+        return self.call_graph.may_write_param(decl, index)
+    
+    def writes_global(self, decl, name):
+        if self.call_graph is None:
+            return True
+        return self.call_graph.may_write_global(decl, name)
+    
+    def invalidate_out_args(self, node):
         decl = self.get_var(node.func)
         for i, (param, arg) in enumerate(itertools.izip(decl.params, node.args)):
-            # Unset variables sent as out parameters
-            if param.direction == tokens.OUT:
+            if callgraph.is_by_reference(param) and self.writes_param(decl, i):
                 self.define_variable(arg, None)
+        self.invalidate_globals(node)
+                
+    def invalidate_globals(self, node):
+        '''Invalidate the global variables that a call might write to.'''
+        decl = self.get_var(node.func)
+        writes_alias = any(callgraph.is_by_reference(param) and arg in self.reference_params and
+                           self.writes_param(decl, i)
+                           for i, (param, arg) in enumerate(itertools.izip(decl.params, node.args)))
+        for name in self.global_variables:
+            if writes_alias or self.writes_global(decl, name):
+                self.elements[-1].pop(name, None)
+                if name in self.scopes[-1]:
+                    self.scopes[-1][name] = None
+    
+    def visit_call(self, node):
+        decl = self.get_var(node.func)
+        for i, (param, arg) in enumerate(itertools.izip(decl.params, node.args)):
+            # Unset variables and arrays passed by reference, even to in
+            # parameters, since the callee can pass arrays on to out parameters.
+            if callgraph.is_by_reference(param):
+                if self.writes_param(decl, i):
+                    self.define_variable(arg, None)
             else:
-                # Propagate variables sent as in parameters
+                # Propagate variables and array elements sent as in parameters.
                 if isinstance(arg, syntaxtree.Name):
                     value = self.get_var(arg)
-                    if value is not None:
-                        node.args[i] = value
+                elif isinstance(arg, syntaxtree.Subscript):
+                    value = self.get_element(arg)
+                else:
+                    value = None
+                if value is not None:
+                    node.args[i] = value
+                    self.modified_tree = True
+        self.invalidate_globals(node)
+        return node
+    
+class ScalarReplacer(syntaxtree.TreeMutator):
+    '''Replace small local arrays that are only indexed by constants with a variable for each element.
+    
+    Array elements are always read from and written to memory in the generated
+    code, but scalar variables can be kept in registers. An array is replaced
+    if it's declared in the procedure being optimized, has at most max_length
+    elements, and is only ever used with int literal indexes that are in
+    bounds, so it's never passed to a call as a whole. Element i of an array a
+    becomes a variable named a.i, and elements that are never used are
+    dropped. Constant propagation replaces indexes that are known variables
+    with literals, which lets more arrays be replaced.'''
+    def __init__(self, max_length=DEFAULT_ARRAY_BUDGET):
+        super(ScalarReplacer, self).__init__()
+        self.max_length = max_length
+        
+        # Maps the names of the arrays being replaced to dicts of the
+        # variables for their elements by index.
+        self.replacements = {}
+        
+        self.visit_functions = {
+            syntaxtree.Subscript: self.visit_subscript,
+        }
+        
+    def walk_procedure(self, node, program):
+        '''Replace the small arrays in a single procedure or program.'''
+        arrays = dict((d.name, d) for d in node.decls
+                      if isinstance(d, syntaxtree.VarDecl) and not d.is_global and
+                      d.array_length is not None and
+                      int(d.array_length.n) <= self.max_length)
+        if not arrays:
+            return node
+        
+        # The indexes of the elements that are used in each array.
+        used = dict((name, set()) for name in arrays)
+        for statement in syntaxtree.iter_statements(node.body):
+            if isinstance(statement, syntaxtree.Assign):
+                expressions = [statement.target, statement.value]
+            elif isinstance(statement, syntaxtree.Call):
+                expressions = statement.args
+            elif isinstance(statement, (syntaxtree.If, syntaxtree.For)):
+                expressions = [statement.test]
+            else:
+                expressions = []
+            for expression in expressions:
+                self.find_indexes(expression, arrays, used)
+        if not used:
+            return node
+        
+        variables = procedure_variables(node)
+        decls = []
+        for decl in node.decls:
+            if not isinstance(decl, syntaxtree.VarDecl) or decl.name not in used:
+                decls.append(decl)
+                continue
+            elements = self.replacements[decl.name] = {}
+            for index in sorted(used[decl.name]):
+                name = unique_name('%s.%d' % (decl.name.id, index), variables)
+                variables[name] = elements[index] = syntaxtree.VarDecl(False, decl.type,
+                                                                       name, None)
+                decls.append(variables[name])
+        node.decls = decls
+        for statement in node.body:
+            self.visit(statement)
+        self.modified_tree = True
         return node
     
+    def find_indexes(self, node, arrays, used):
+        '''Add the indexes that an expression uses to the used sets, and remove the arrays that can't be replaced from them.'''
+        if isinstance(node, syntaxtree.Name):
+            # The whole array is passed to a call.
+            used.pop(node, None)
+        elif isinstance(node, syntaxtree.Subscript):
+            if node.name in used:
+                index = constant_value(node.index)
+                if index is not None and 0 <= index < int(arrays[node.name].array_length.n):
+                    used[node.name].add(index)
+                else:
+                    del used[node.name]
+            self.find_indexes(node.index, arrays, used)
+        elif isinstance(node, syntaxtree.BinaryOp):
+            self.find_indexes(node.left, arrays, used)
+            self.find_indexes(node.right, arrays, used)
+        elif isinstance(node, syntaxtree.UnaryOp):
+            self.find_indexes(node.operand, arrays, used)
+            
+    def visit_subscript(self, node):
+        elements = self.replacements.get(node.name)
+        if elements is None:
+            self.visit_children(node)
+            return node
+        name = syntaxtree.Name(elements[constant_value(node.index)].name.id, token=node.name.token)
+        name.node_type = node.node_type
+        return name
+    
 class DeadCodeEliminator(syntaxtree.TreeMutator):
     '''Optimizer that eliminates dead branches, loops, assignments, and declarations.
     
@@ -256,6 +879,14 @@ class DeadCodeEliminator(syntaxtree.TreeMutator):
     assigned as it encounters them. When it reaches an assignment or
     declaration, it will have encountered all references to that identifier
     already.
+    
+    Where control flow joins, the statuses from each path are merged. Variables
+    read anywhere in a loop are marked as referenced before the loop body is
+    walked, since they can be read again on the next iteration.
+    
+    Out parameters and global variables are always treated as live. Since a
+    procedure might not write to all of its out parameters, passing a variable
+    as an out argument doesn't kill earlier assignments to it.
     '''
     ASSIGNED = 1
     REFERENCED = 2
@@ -264,6 +895,10 @@ class DeadCodeEliminator(syntaxtree.TreeMutator):
     def __init__(self):
         super(DeadCodeEliminator, self).__init__()
         
+        # When set, only this procedure is optimized, and nested procedures are
+        # left alone. See walk_procedure.
+        self.unit = None
+        
         # Scopes store whether variables have been read or assigned to
         # For procedures, they store a tuple of (decl, read or assigned)
         self.global_scope = {}
@@ -281,6 +916,21 @@ class DeadCodeEliminator(syntaxtree.TreeMutator):
         }
         
         
+    def walk_procedure(self, node, program):
+        '''Eliminate dead code in the body of a single procedure or program.
+        
+        Nested procedures are not visited or removed, since whether they are
+        called depends on the rest of the program. The program is needed to
+        find the global declarations that are visible inside the node.'''
+        self.unit = node
+        for decl in program.decls:
+            if decl.is_global:
+                if isinstance(decl, syntaxtree.ProcDecl):
+                    self.define_var(decl.name, (decl, None), is_global=True)
+                else:
+                    self.define_var(decl.name, self.UNKNOWN, is_global=True)
+        return self.walk(node)
+        
     def enter_scope(self):
         self.scopes.append({})
 
@@ -293,6 +943,36 @@ class DeadCodeEliminator(syntaxtree.TreeMutator):
         else:
             self.scopes[-1][name] = value
             
+    def mark_var(self, name, value):
+        '''Set the status of a variable, unless it is always live.'''
+        if self.get_var(name) != self.UNKNOWN:
+            self.define_var(name, value)
+            
+    def save_state(self):
+        return dict(self.scopes[-1]), dict(self.global_scope)
+    
+    def restore_state(self, state):
+        self.scopes[-1] = dict(state[0])
+        self.global_scope = dict(state[1])
+        
+    def merge_state(self, state):
+        '''Combine the statuses from another path through the procedure with the current statuses.'''
+        for scope, other in ((self.scopes[-1], state[0]),
+                             (self.global_scope, state[1])):
+            for name, status in other.iteritems():
+                scope[name] = self.merge_status(scope.get(name), status)
+                
+    def merge_status(self, a, b):
+        if isinstance(a, tuple) or isinstance(b, tuple):
+            decl = (a or b)[0]
+            if self.REFERENCED in (a and a[1], b and b[1]):
+                return (decl, self.REFERENCED)
+            return (decl, None)
+        for status in (self.UNKNOWN, self.REFERENCED, self.ASSIGNED):
+            if status in (a, b):
+                return status
+        return None
+            
     def set_var(self, name, value):
         if name in self.scopes[-1]:
             self.scopes[-1] = value
@@ -314,21 +994,28 @@ class DeadCodeEliminator(syntaxtree.TreeMutator):
         
     def walk_body(self, node, attrname='body'):
         # Manually walk the body in reverse to construct implicit D-U Chains.
+        old_body = getattr(node, attrname)
         new_body = []
-        for child in reversed(getattr(node, attrname)):
+        for child in reversed(old_body):
             value = self.visit(child)
             if value is not None:
                 if isinstance(value, list):
                     new_body = value + new_body
                 else:
                     new_body.insert(0, value)
+        if (len(new_body) != len(old_body) or
+            any(a is not b for a, b in itertools.izip(new_body, old_body))):
+            self.modified_tree = True
         setattr(node, attrname, new_body)
         
             
     def visit_block(self, node):
         # This function is used for both Program and ProcDecl nodes
         if isinstance(node, syntaxtree.ProcDecl):
-            if self.get_var(node.name)[1]  is None:
+            if self.unit is not None:
+                if node is not self.unit:
+                    return node
+            elif self.get_var(node.name)[1]  is None:
                 return None
         
         self.enter_scope()
@@ -345,6 +1032,9 @@ class DeadCodeEliminator(syntaxtree.TreeMutator):
         for decl in node.decls:
             if isinstance(decl, syntaxtree.ProcDecl):
                 self.define_var(decl.name, (decl, None), decl.is_global)
+            elif decl.is_global:
+                # Global variables can be read by any procedure.
+                self.define_var(decl.name, self.UNKNOWN, True)
             else:
                 self.define_var(decl.name, None)
         
@@ -355,6 +1045,7 @@ class DeadCodeEliminator(syntaxtree.TreeMutator):
         # terminates the procedure.
         try:
             del node.body[node.body.index(syntaxtree.Return()):]
+            self.modified_tree = True
         except ValueError:
             pass
 
@@ -369,83 +1060,2851 @@ class DeadCodeEliminator(syntaxtree.TreeMutator):
     
     def visit_assign(self, node):
         if isinstance(node.target, syntaxtree.Subscript):
+            # Assignments to array elements are never eliminated, but the array
+            # still has to be declared.
+            if self.get_var(node.target.name) is None:
+                self.mark_var(node.target.name, self.ASSIGNED)
+            self.visit(node.target.index)
+            self.visit(node.value)
             return node
         status = self.get_var(node.target)
         if status == self.REFERENCED:
             self.define_var(node.target, self.ASSIGNED)
-            return node
-        if status == self.UNKNOWN:
-            return node
-        return None
+        elif status != self.UNKNOWN:
+            return None
+        # The value is read before the target is written, so it's visited
+        # second in reverse program order.
+        self.visit(node.value)
+        return node
 
     def visit_name(self, node):
-        self.define_var(node, self.REFERENCED)
+        self.mark_var(node, self.REFERENCED)
         return node
         
     def visit_call(self, node):
         decl = self.get_var(node.func)[0]
         self.define_var(node.func, (decl, self.REFERENCED), is_global=decl.is_global)
         for arg, param in itertools.izip(node.args, decl.params):
-            if isinstance(arg, syntaxtree.Name):
-                self.define_var(arg, self.REFERENCED if param.direction ==
-                                            tokens.IN else self.ASSIGNED)
+            if (param.direction == tokens.IN or
+                param.var_decl.array_length is not None):
+                # Arrays are passed by reference, so the callee can read them
+                # no matter which direction they're passed in.
+                self.visit(arg)
+            elif self.get_var(arg) is None:
+                # The variable still has to be declared for the call.
+                self.mark_var(arg, self.ASSIGNED)
         return node
         
+    def iter_reads(self, statement):
+        '''Yield the names read by a statement, not including nested statements.'''
+        if isinstance(statement, syntaxtree.Assign):
+            if isinstance(statement.target, syntaxtree.Subscript):
+                for name in syntaxtree.iter_names(statement.target.index):
+                    yield name
+            for name in syntaxtree.iter_names(statement.value):
+                yield name
+        elif isinstance(statement, syntaxtree.Call):
+            decl = self.get_var(statement.func)[0]
+            for arg, param in itertools.izip(statement.args, decl.params):
+                if (param.direction == tokens.IN or
+                    param.var_decl.array_length is not None):
+                    for name in syntaxtree.iter_names(arg):
+                        yield name
+        elif isinstance(statement, (syntaxtree.If, syntaxtree.For)):
+            for name in syntaxtree.iter_names(statement.test):
+                yield name
+        
+    def constant_test(self, test):
+        '''Return whether a test that has been folded to a literal is true, or None if it isn't a literal.'''
+        if isinstance(test, syntaxtree.Num):
+            return literal_value(test.n) != 0
+        return None
+        
     def visit_if(self, node):
-        if node.test == syntaxtree.Num('1'):
+        test = self.constant_test(node.test)
+        if test is True:
             self.walk_body(node)
             return node.body
-        if node.test == syntaxtree.Num('0'):
+        if test is False:
             self.walk_body(node, 'orelse')
             # The orelse can be empty, which removes this node.
             return node.orelse
+        
+        # Each branch starts from the statuses after the if statement.
+        after = self.save_state()
+        self.walk_body(node, 'orelse')
+        orelse = self.save_state()
+        self.restore_state(after)
+        self.walk_body(node)
+        self.merge_state(orelse)
+        
         if not node.body and not node.orelse:
             # In the only recorded case of the lack of functions being helpful,
             # expressions can't have side effects, which means we can drop the
             # test without worrying about what it's doing.
             return None
-        self.walk_body(node, 'orelse')
-        self.walk_body(node)
         self.visit(node.test)
         
         return node
     
     def visit_for(self, node):
-        if node.test == syntaxtree.Num('0'):
+        if self.constant_test(node.test) is False:
             return None
-        self.visit(node.test)
+        
+        after = self.save_state()
+        for statement in syntaxtree.iter_statements([node]):
+            for name in self.iter_reads(statement):
+                self.mark_var(name, self.REFERENCED)
+                
+        # The loop's assignment can't be removed, but it's still walked so that
+        # its target stays declared.
+        if self.visit_assign(node.assignment) is None:
+            if self.get_var(node.assignment.target) is None:
+                self.mark_var(node.assignment.target, self.ASSIGNED)
         self.walk_body(node)
+        
+        # The body might not run at all.
+        self.merge_state(after)
+        self.visit(node.test)
         return node
     
-def optimize_tree(ast, level=1):
-    if level == 0:
-        return ast
-    if level == 1:
-        return ConstantFolder().walk(ast)
-    if level == 2:
-        ConstantPropagator(print_errors=True).walk(ast)
-        DeadCodeEliminator().walk(ast)
-        for i in xrange(3):
-            propagator = ConstantPropagator()
-            propagator.walk(ast)
-            eliminator = DeadCodeEliminator()
-            eliminator.walk(ast)
-            if not propagator.modified_tree or not eliminator.modified_tree:
-                return ast
+def index_key(index):
+    '''Return an array index as a tuple of a Name or None and a constant offset, or None if it has another form.'''
+    if isinstance(index, syntaxtree.Num):
+        return None, literal_value(index.n)
+    if isinstance(index, syntaxtree.Name):
+        return index, 0
+    if (isinstance(index, syntaxtree.BinaryOp) and index.op in (tokens.PLUS, tokens.MINUS) and
+        isinstance(index.right, syntaxtree.Num)):
+        left = index_key(index.left)
+        if left is not None and left[0] is not None:
+            offset = literal_value(index.right.n)
+            return left[0], left[1] + (offset if index.op == tokens.PLUS else -offset)
+    return None
+
+# Stands for every element of an array in a LiveVariables.
+ALL_ELEMENTS = 'all elements'
+
+class LiveVariables(object):
+    '''The variables and array elements that might be read before they're written.
     
-if __name__ == '__main__':
-    import argparse
-    import scanner
-    import parser
-    import typechecker
+    Elements are identified by their index_key, so an element with a Name in
+    its key is the one at that index for the value the variable has at the
+    current point in the procedure.'''
+    def __init__(self):
+        self.names = set()
+        # Maps arrays to sets of the keys of their live elements, or to
+        # ALL_ELEMENTS.
+        self.elements = {}
+        
+    def copy(self):
+        live = LiveVariables()
+        live.names = set(self.names)
+        live.elements = dict((a, k if k is ALL_ELEMENTS else set(k))
+                             for a, k in self.elements.iteritems())
+        return live
+        
+    def update(self, other):
+        self.names.update(other.names)
+        for array, keys in other.elements.iteritems():
+            self.add_elements(array, keys)
+            
+    def __eq__(self, other):
+        return self.names == other.names and self.elements == other.elements
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def add_elements(self, array, keys):
+        current = self.elements.get(array, set())
+        if current is not ALL_ELEMENTS:
+            if keys is ALL_ELEMENTS:
+                self.elements[array] = ALL_ELEMENTS
+            else:
+                self.elements[array] = current | keys
+                
+    def is_live(self, array, key):
+        '''Return whether an element might be read, if key is a live element's index_key.'''
+        keys = self.elements.get(array, set())
+        if keys is ALL_ELEMENTS or key is None:
+            return bool(keys)
+        # Elements are only known to be different if their indexes are
+        # different offsets from the same value.
+        return any(k[0] != key[0] or k[1] == key[1] for k in keys)
+    
+    def kill(self, name):
+        '''Remove a variable that's written, and forget which elements are at indexes that read it.'''
+        self.names.discard(name)
+        self.clobber(name)
+        
+    def clobber(self, name):
+        '''Forget which elements are at indexes that read a variable that might be written.'''
+        for array, keys in self.elements.items():
+            if keys is not ALL_ELEMENTS and any(k[0] == name for k in keys):
+                self.elements[array] = ALL_ELEMENTS
+                
+    def kill_element(self, array, key):
+        keys = self.elements.get(array)
+        if key is not None and keys and keys is not ALL_ELEMENTS:
+            keys.discard(key)
+            if not keys:
+                del self.elements[array]
+            
+    def read(self, node):
+        '''Add the variables and elements read by an expression.'''
+        for name in syntaxtree.iter_names(node):
+            self.names.add(name)
+        for subscript in iter_subscripts(node):
+            key = index_key(subscript.index)
+            self.add_elements(subscript.name, ALL_ELEMENTS if key is None else set([key]))
+            
+# The control flow graph of a procedure, and a dict mapping its blocks to the
+# LiveVariables when they start. See DeadStoreEliminator.find_liveness.
+Liveness = collections.namedtuple('Liveness', ['graph', 'live_in'])
+            
+def iter_subscripts(node):
+    '''Yield every Subscript in an expression.'''
+    if isinstance(node, syntaxtree.Subscript):
+        yield node
+        for subscript in iter_subscripts(node.index):
+            yield subscript
+    elif isinstance(node, syntaxtree.BinaryOp):
+        for subscript in iter_subscripts(node.left):
+            yield subscript
+        for subscript in iter_subscripts(node.right):
+            yield subscript
+    elif isinstance(node, syntaxtree.UnaryOp):
+        for subscript in iter_subscripts(node.operand):
+            yield subscript
+    elif isinstance(node, syntaxtree.Select):
+        for field in node:
+            for subscript in iter_subscripts(field):
+                yield subscript
 
-    argparser = argparse.ArgumentParser(description='Test the type optimization functionality.')
+class DeadStoreEliminator(object):
+    '''Remove assignments to variables and array elements that are overwritten or never read.
     
-    argparser.add_argument('filename', help='the file to parse')
-    argparser.add_argument('-O', type=int, choices=[0, 1, 2], default=2,
-                           help='the level of optimization to apply to the program (default 2)')
-    args = argparser.parse_args()
+    Liveness is computed backwards over the control flow graph of a
+    procedure, for each variable and for each array element whose index is a
+    constant, or a constant offset from a variable. An assignment is dead if
+    its target can't be read before it's written again or the procedure
+    returns. Elements whose indexes are offsets from the same value of a
+    variable are the same if the offsets are equal and different otherwise,
+    and other pairs of elements of the same array might be the same.
+    
+    Out parameters, global variables, and array parameters are live when the
+    procedure returns, but the program's variables aren't live at its end.
+    Calls to procedures other than the runtime's can read every global
+    variable, and any call can read the arrays passed to it. If a call graph
+    is given, calls only read the globals and arrays that the callee's
+    summary says it might. Calls don't kill anything passed as an out
+    argument, since the procedure might not write to it, except for runtime
+    procedures, which always do. The assignments of For loops are never
+    removed, since the loop needs them.'''
+    def __init__(self, call_graph=None):
+        self.call_graph = call_graph
+        self.scope = {}
+        self.exit_live = LiveVariables()
+        self.globals = LiveVariables()
+        self.modified_tree = False
+        
+    def walk_procedure(self, node, program, liveness=None):
+        '''Eliminate the dead stores in the body of a single procedure or program.
+        
+        The Liveness of the procedure can be given if it was already found
+        with the same call graph, so that it isn't solved again.'''
+        self.start_procedure(node, program)
+        if liveness is None:
+            graph = controlflow.ControlFlowGraph(node)
+            liveness = Liveness(graph, self.solve(graph))
+        graph, live_in = liveness
+        
+        # The assignments of For loops are in the graph but not in any list of
+        # statements.
+        removable = set(id(s) for c in ssa.iter_containers(node.body) for s in c)
+        dead = set()
+        for block in graph.blocks:
+            live = self.live_out(graph, block, live_in)
+            for statement in reversed(block.statements):
+                if id(statement) in removable and self.is_dead(statement, live):
+                    dead.add(id(statement))
+                else:
+                    self.transfer(statement, live)
+        
+        if dead:
+            for container in ssa.iter_containers(node.body):
+                container[:] = [s for s in container if id(s) not in dead]
+            self.modified_tree = True
+        return node
+    
+    def find_liveness(self, node, program, graph):
+        '''Return the Liveness of a procedure with a control flow graph of it.'''
+        self.start_procedure(node, program)
+        return Liveness(graph, self.solve(graph))
+    
+    def start_procedure(self, node, program):
+        '''Find the variables that a procedure can use, and the ones that are live when it returns.'''
+        self.scope = ssa.procedure_scope(node, program)
+        local_names = procedure_variables(node)
+        
+        # Global variables that aren't shadowed, with their arrays' elements.
+        self.globals = LiveVariables()
+        for decl in itertools.chain.from_iterable(
+                p.decls for p in syntaxtree.iter_procedures(program)):
+            if (isinstance(decl, syntaxtree.VarDecl) and decl.is_global and
+                decl.name not in local_names):
+                if decl.array_length is None:
+                    self.globals.names.add(decl.name)
+                else:
+                    self.globals.elements[decl.name] = ALL_ELEMENTS
+        
+        self.exit_live = LiveVariables()
+        if isinstance(node, syntaxtree.ProcDecl):
+            self.exit_live.update(self.globals)
+            for param in node.params:
+                if param.var_decl.array_length is not None:
+                    self.exit_live.elements[param.var_decl.name] = ALL_ELEMENTS
+                elif param.direction == tokens.OUT:
+                    self.exit_live.names.add(param.var_decl.name)
+    
+    def solve(self, graph):
+        '''Return a dict mapping the blocks of a graph to the variables that are live when they start.'''
+        live_in = dict((block, LiveVariables()) for block in graph.blocks)
+        changed = True
+        while changed:
+            changed = False
+            for block in graph.postorder():
+                live = self.live_out(graph, block, live_in)
+                for statement in reversed(block.statements):
+                    self.transfer(statement, live)
+                if live != live_in[block]:
+                    live_in[block] = live
+                    changed = True
+        return live_in
+    
+    def live_out(self, graph, block, live_in):
+        if block is graph.exit:
+            return self.exit_live.copy()
+        live = LiveVariables()
+        for successor in block.successors:
+            live.update(live_in[successor])
+        if block.test is not None:
+            live.read(block.test)
+        return live
+    
+    def is_dead(self, statement, live):
+        '''Return whether an assignment can be removed, given the variables that are live after it.'''
+        if not isinstance(statement, syntaxtree.Assign):
+            return False
+        target = statement.target
+        if isinstance(target, syntaxtree.Subscript):
+            return not live.is_live(target.name, index_key(target.index))
+        return target not in live.names
+    
+    def transfer(self, statement, live):
+        '''Change the variables that are live after a statement to the ones that are live before it.'''
+        if isinstance(statement, syntaxtree.Assign):
+            target = statement.target
+            if isinstance(target, syntaxtree.Subscript):
+                live.kill_element(target.name, index_key(target.index))
+                live.read(target.index)
+            else:
+                live.kill(target)
+            live.read(statement.value)
+        elif isinstance(statement, syntaxtree.Call):
+            decl = self.scope[statement.func]
+            is_runtime = is_runtime_procedure(decl)
+            if self.call_graph is not None and decl in self.call_graph:
+                effects = self.call_graph.effects(decl)
+            else:
+                effects = None
+            for i, (arg, param) in enumerate(zip(statement.args, decl.params)):
+                if param.var_decl.array_length is not None:
+                    if effects is None or i in effects.param_reads:
+                        live.add_elements(arg, ALL_ELEMENTS)
+                elif param.direction == tokens.IN:
+                    live.read(arg)
+                elif is_runtime:
+                    live.kill(arg)
+                elif effects is None or i in effects.param_writes:
+                    # Other procedures might not write to the argument, and
+                    # the value it had is stored back if they don't.
+                    live.clobber(arg)
+                    live.names.add(arg)
+            if effects is None and not is_runtime:
+                for name in self.globals.names:
+                    live.clobber(name)
+                live.update(self.globals)
+            elif effects is not None:
+                for name in effects.global_writes:
+                    if name in self.globals.names:
+                        live.clobber(name)
+                for name in effects.global_reads:
+                    if name in self.globals.names:
+                        live.names.add(name)
+                    elif name in self.globals.elements:
+                        live.add_elements(name, ALL_ELEMENTS)
+
+class CopyPropagator(object):
+    '''Replace reads of variables that hold a copy of another variable with that variable.
+    
+    A copy like x := y is available at a point if every path to it runs the
+    copy and then doesn't write to x or y, which is found forwards over the
+    control flow graph of a procedure. Where it's available, reads of x are
+    replaced by y, following chains of copies back to the first variable, so
+    that the copies are no longer read and the dead store eliminator can
+    remove them.
+    
+    Only copies between scalar variables of the same type are propagated.
+    Calls kill the copies of the globals they might write to and of their out
+    arguments. Inside of procedures, global variables and out parameters are
+    stored to memory around calls, and an out parameter might be an alias of a
+    global or of another out parameter, so a call that might write to any of
+    them kills the copies of all of them. If a call graph is given, only the
+    out arguments and globals that the callee's summary says it might write
+    are killed.'''
+    def __init__(self, call_graph=None):
+        self.call_graph = call_graph
+        self.scope = {}
+        # The scalar variables that copies can be propagated between, the
+        # global ones among them, and the ones that are stored to memory
+        # around calls.
+        self.variables = set()
+        self.globals = set()
+        self.memory = set()
+        self.modified_tree = False
+        
+    def walk_procedure(self, node, program):
+        '''Propagate the copies in the body of a single procedure or program.'''
+        self.scope = ssa.procedure_scope(node, program)
+        local_variables = procedure_variables(node)
+        self.variables = set(name for name, decl in local_variables.iteritems()
+                             if decl.array_length is None)
+        self.globals = set()
+        self.memory = set()
+        if isinstance(node, syntaxtree.ProcDecl):
+            self.memory.update(p.var_decl.name for p in node.params
+                               if p.direction == tokens.OUT and
+                               p.var_decl.array_length is None)
+        for decl in program.decls:
+            if (isinstance(decl, syntaxtree.VarDecl) and decl.is_global and
+                decl.array_length is None and decl.name not in local_variables):
+                self.variables.add(decl.name)
+                self.globals.add(decl.name)
+                if node is not program:
+                    self.memory.add(decl.name)
+        
+        graph = controlflow.ControlFlowGraph(node)
+        copies_in = self.solve(graph)
+        for block in graph.blocks:
+            copies = copies_in[block]
+            if copies is None:
+                continue
+            copies = dict(copies)
+            for statement in block.statements:
+                self.replace_reads(statement, copies)
+                self.transfer(statement, copies)
+            if block.test is not None:
+                test = self.replace(block.test, copies)
+                if test is not block.test:
+                    block.test = block.branch.test = test
+        return node
+    
+    def solve(self, graph):
+        '''Return a dict mapping the blocks of a graph to the copies available when they start.
+        
+        Copies map the variables that hold them to their sources. Blocks that
+        can't be reached map to None.'''
+        copies_in = dict((block, None) for block in graph.blocks)
+        copies_out = dict((block, None) for block in graph.blocks)
+        changed = True
+        while changed:
+            changed = False
+            for block in graph.reverse_postorder():
+                if block is graph.entry:
+                    copies = {}
+                else:
+                    copies = self.meet(copies_out[p] for p in block.predecessors)
+                if copies is None:
+                    continue
+                copies_in[block] = dict(copies)
+                for statement in block.statements:
+                    self.transfer(statement, copies)
+                if copies != copies_out[block]:
+                    copies_out[block] = copies
+                    changed = True
+        return copies_in
+    
+    def meet(self, predecessors):
+        '''Return the copies available at the end of every predecessor that has been reached.'''
+        result = None
+        for copies in predecessors:
+            if copies is None:
+                continue
+            if result is None:
+                result = dict(copies)
+            else:
+                result = dict((target, source) for target, source in result.iteritems()
+                              if copies.get(target) == source)
+        return result
+    
+    def is_copy(self, statement):
+        '''Return whether an assignment copies one variable that can be propagated to another.'''
+        return (isinstance(statement, syntaxtree.Assign) and
+                isinstance(statement.target, syntaxtree.Name) and
+                isinstance(statement.value, syntaxtree.Name) and
+                statement.target in self.variables and statement.value in self.variables and
+                statement.target != statement.value and
+                statement.target.node_type == statement.value.node_type)
+    
+    def kill(self, copies, names):
+        '''Remove the copies to or from any of a set of variables.'''
+        for target, source in copies.items():
+            if target in names or source in names:
+                del copies[target]
+    
+    def transfer(self, statement, copies):
+        '''Change the copies available before a statement to the ones available after it.'''
+        if isinstance(statement, syntaxtree.Assign):
+            target = statement.target
+            if isinstance(target, syntaxtree.Name):
+                self.kill(copies, set([target]))
+                if self.is_copy(statement):
+                    copies[target] = statement.value
+        elif isinstance(statement, syntaxtree.Call):
+            decl = self.scope[statement.func]
+            if self.call_graph is not None and decl in self.call_graph:
+                effects = self.call_graph.effects(decl)
+            else:
+                effects = None
+            written = set()
+            for i, (arg, param) in enumerate(zip(statement.args, decl.params)):
+                if (param.direction == tokens.OUT and isinstance(arg, syntaxtree.Name) and
+                    (effects is None or i in effects.param_writes)):
+                    written.add(arg)
+            if is_runtime_procedure(decl):
+                writes_memory = bool(written & self.memory)
+            elif effects is None:
+                written.update(self.globals)
+                writes_memory = bool(self.memory)
+            else:
+                written.update(effects.global_writes & self.globals)
+                writes_memory = bool(written & self.memory)
+            if writes_memory:
+                written.update(self.memory)
+            self.kill(copies, written)
+    
+    def replace(self, node, copies):
+        '''Return an expression with the variables that hold copies replaced by their sources.'''
+        if not copies:
+            return node
+        replacements = {}
+        for name in syntaxtree.iter_names(node):
+            source = name
+            while source in copies:
+                source = copies[source]
+            if source != name:
+                replacements[name] = source
+        if not replacements:
+            return node
+        self.modified_tree = True
+        return syntaxtree.replace_names(node, replacements)
+    
+    def replace_reads(self, statement, copies):
+        if isinstance(statement, syntaxtree.Assign):
+            if isinstance(statement.target, syntaxtree.Subscript):
+                statement.target.index = self.replace(statement.target.index, copies)
+            statement.value = self.replace(statement.value, copies)
+        elif isinstance(statement, syntaxtree.Call):
+            decl = self.scope[statement.func]
+            for i, (arg, param) in enumerate(zip(statement.args, decl.params)):
+                # Out arguments and arrays are passed by reference.
+                if param.direction == tokens.IN and param.var_decl.array_length is None:
+                    statement.args[i] = self.replace(arg, copies)
+
+def literal_type(node):
+    '''Return the type of the value in a Num or Str node.'''
+    if isinstance(node, syntaxtree.Str):
+        return tokens.STRING_TYPE
+    if node.n in (tokens.TRUE, tokens.FALSE):
+        return tokens.BOOL
+    if '.' in node.n:
+        return tokens.FLOAT
+    return tokens.INT
+
+# Lattice values for conditional constant propagation. Every version starts out
+# UNDEFINED, and can only move down to a literal and then to VARYING.
+UNDEFINED = 'undefined'
+VARYING = 'varying'
+
+def evaluate_expression(expression, value):
+    '''Return the lattice value of an expression without changing it.
+    
+    The lattice value of each Name is value(name).'''
+    if isinstance(expression, (syntaxtree.Num, syntaxtree.Str)):
+        return expression
+    if isinstance(expression, syntaxtree.Name):
+        return value(expression)
+    if isinstance(expression, syntaxtree.BinaryOp):
+        operands = [evaluate_expression(expression.left, value),
+                    evaluate_expression(expression.right, value)]
+    elif isinstance(expression, syntaxtree.UnaryOp):
+        operands = [evaluate_expression(expression.operand, value)]
+    else:
+        # Array elements are memory.
+        return VARYING
+    
+    if VARYING in operands:
+        return VARYING
+    if UNDEFINED in operands:
+        return UNDEFINED
+    if not all(isinstance(o, syntaxtree.Num) for o in operands):
+        return VARYING
+    if isinstance(expression, syntaxtree.BinaryOp):
+        result = fold_binary(expression.op, expression.node_type,
+                             operands[0].n, operands[1].n)
+    else:
+        result = fold_unary(expression.op, expression.node_type, operands[0].n)
+    if result is None:
+        return VARYING
+    return result
+
+class ConditionalConstantPropagator(object):
+    '''Sparse conditional constant propagation on a procedure in SSA form.
+    
+    This is the algorithm from "Constant Propagation with Conditional Branches"
+    by Wegman and Zadeck. A block is only evaluated once a branch that can be
+    taken jumps to it, and phis ignore the values that come from edges that
+    can't be taken. This finds constants that are merged at joins and loop
+    headers, and branches whose tests are constant.
+    
+    Instead of walking the whole procedure, the propagator follows the uses of
+    each version whose value changes, so each statement is only evaluated
+    again when one of its operands changes.'''
+    def __init__(self, form):
+        self.form = form
+        self.folder = ConstantFolder()
+        self.values = {}
+        self.reachable = set()
+        self.executable_edges = set()
+        self.edge_worklist = []
+        self.version_worklist = []
+    
+    def value(self, version):
+        if self.form.definitions[version] is None:
+            # Parameters and uninitialized variables.
+            return VARYING
+        return self.values.get(version, UNDEFINED)
+    
+    def evaluate(self, expression):
+        '''Return the lattice value of an expression without changing it.'''
+        def value(name):
+            if name in self.form.definitions:
+                return self.value(name)
+            return VARYING
+        return evaluate_expression(expression, value)
+    
+    def meet(self, a, b):
+        if a is UNDEFINED:
+            return b
+        if b is UNDEFINED:
+            return a
+        if a is VARYING or b is VARYING or a != b:
+            return VARYING
+        return a
+    
+    def set_value(self, version, value):
+        # Literals of a different type would change the code generated for
+        # the expressions they're substituted into.
+        if (value is not UNDEFINED and value is not VARYING and
+            literal_type(value) != self.form.variables[self.form.origins[version]].type):
+            value = VARYING
+        old = self.value(version)
+        value = self.meet(old, value)
+        if value is not old and value != old:
+            self.values[version] = value
+            self.version_worklist.append(version)
+            
+    def mark_edge(self, source, target):
+        if (source, target) not in self.executable_edges:
+            self.executable_edges.add((source, target))
+            self.edge_worklist.append((source, target))
+    
+    def visit_phi(self, phi, block):
+        value = UNDEFINED
+        for predecessor, arg in itertools.izip(block.predecessors, phi.args):
+            if (predecessor, block) in self.executable_edges:
+                value = self.meet(value, self.value(arg))
+        self.set_value(phi.target, value)
+        
+    def visit_statement(self, statement):
+        target = self.form.assigned_name(statement)
+        if target in self.form.definitions:
+            self.set_value(target, self.evaluate(statement.value))
+            
+    def visit_branch(self, block):
+        if block.test is None:
+            for successor in block.successors:
+                self.mark_edge(block, successor)
+            return
+        value = self.evaluate(block.test)
+        if value is VARYING:
+            for successor in block.successors:
+                self.mark_edge(block, successor)
+        elif value is not UNDEFINED:
+            taken = 0 if literal_value(value.n) else 1
+            self.mark_edge(block, block.successors[taken])
+            
+    def visit_block(self, block):
+        self.reachable.add(block)
+        for phi in self.form.phis[block]:
+            self.visit_phi(phi, block)
+        for statement in block.statements:
+            self.visit_statement(statement)
+        self.visit_branch(block)
+    
+    def visit_use(self, site):
+        if isinstance(site, ssa.Phi):
+            block = self.form.phi_blocks[id(site)]
+            if block in self.reachable:
+                self.visit_phi(site, block)
+        elif isinstance(site, controlflow.BasicBlock):
+            if site in self.reachable:
+                self.visit_branch(site)
+        elif self.form.statement_blocks.get(id(site)) in self.reachable:
+            self.visit_statement(site)
+            
+    def propagate(self):
+        '''Find the values of every version and replace the reads of constant versions.
+        
+        Returns whether any reads were replaced.'''
+        self.visit_block(self.form.graph.entry)
+        while self.edge_worklist or self.version_worklist:
+            if self.edge_worklist:
+                source, target = self.edge_worklist.pop()
+                if target not in self.reachable:
+                    self.visit_block(target)
+                else:
+                    # Only the phis can change when another edge into a block
+                    # is taken.
+                    for phi in self.form.phis[target]:
+                        self.visit_phi(phi, target)
+            else:
+                version = self.version_worklist.pop()
+                for site in self.form.uses[version]:
+                    self.visit_use(site)
+        
+        constants = dict((v, value) for v, value in self.values.iteritems()
+                         if value is not VARYING and value is not UNDEFINED)
+        sites = []
+        seen = set()
+        for version in constants:
+            for site in self.form.uses[version]:
+                if not isinstance(site, ssa.Phi) and id(site) not in seen:
+                    seen.add(id(site))
+                    sites.append(site)
+        
+        modified = []
+        def substitute(expression):
+            new_expression = self.folder.walk(syntaxtree.replace_names(expression, constants))
+            if new_expression is not expression:
+                modified.append(expression)
+            return new_expression
+        for site in sites:
+            self.form.rewrite(site, substitute)
+        return bool(modified)
+    
+COMMUTATIVE_OPERATORS = frozenset((tokens.PLUS, tokens.MULTIPLY, tokens.AND, tokens.OR,
+                                   tokens.EQUAL, tokens.NOTEQUAL))
+COMPARISON_OPERATORS = frozenset((tokens.LT, tokens.LTE, tokens.GT, tokens.GTE,
+                                  tokens.EQUAL, tokens.NOTEQUAL))
+
+def temporary_type(node):
+    '''Return the type of a variable that can hold the value of an expression.'''
+    if isinstance(node, syntaxtree.BinaryOp) and node.op in COMPARISON_OPERATORS:
+        # Comparisons are typed by their operands.
+        return tokens.BOOL
+    return node.node_type
+
+class AvailableExpression(object):
+    '''An expression whose value can be reused by later computations of the same expression.'''
+    def __init__(self, node, setter, statement, holder=None):
+        self.node = node
+        
+        # Replaces the node where it appears in the tree.
+        self.setter = setter
+        
+        # The statement (or block, for tests) that the node is currently in.
+        self.statement = statement
+        
+        # The SSA version that holds the value of the expression, once one is
+        # needed.
+        self.holder = holder
+
+class ValueNumberer(object):
+    '''Global value numbering and common subexpression elimination on a procedure in SSA form.
+    
+    Expressions are numbered by their structure, with each version replaced by
+    the version it's a copy of and the operands of commutative operators
+    sorted. Since versions are only assigned once, an expression that only
+    reads versions has the same value everywhere it's dominated by another
+    computation of it, so the dominator tree is walked with a scoped table of
+    available expressions. The first computation is saved in a temporary (or
+    in the version it's assigned to) the first time it's reused.
+    
+    Expressions that read memory (globals, out parameters, array elements, and
+    variables that aren't in SSA form) are only reused within a basic block,
+    and are killed by stores and calls. Out parameters and arrays passed by
+    reference might be aliases, so any store to an array kills every array
+    element, any store to a memory variable kills every expression that reads
+    one, and calls kill everything that reads memory.'''
+    def __init__(self, form):
+        self.form = form
+        self.copies = {}
+        self.available = {}
+        self.recorded = {}
+        self.modified = False
+        
+        # The expressions that read memory in the current block, and what
+        # they read.
+        self.memory = {}
+        self.memory_reads = {}
+        
+    def leader(self, version):
+        '''Return the version that a version is a copy of.'''
+        return self.copies.get(version, version)
+    
+    def expression_key(self, node):
+        '''Return a hashable key for an expression, and whether it reads array elements and memory variables.'''
+        if isinstance(node, syntaxtree.Num):
+            return ('num', node.n), False, False
+        if isinstance(node, syntaxtree.Str):
+            return ('str', node.s), False, False
+        if isinstance(node, syntaxtree.Name):
+            if node in self.form.definitions:
+                return ('version', self.leader(node).id), False, False
+            return ('memory', node.id), False, True
+        if isinstance(node, syntaxtree.Subscript):
+            index, _, names = self.expression_key(node.index)
+            return ('subscript', node.name.id, index), True, names
+        if isinstance(node, syntaxtree.UnaryOp):
+            operand, arrays, names = self.expression_key(node.operand)
+            return (node.op, node.node_type, operand), arrays, names
+        left, left_arrays, left_names = self.expression_key(node.left)
+        right, right_arrays, right_names = self.expression_key(node.right)
+        if node.op in COMMUTATIVE_OPERATORS and right < left:
+            left, right = right, left
+        return ((node.op, node.node_type, left, right),
+                left_arrays or right_arrays, left_names or right_names)
+    
+    def holder(self, expression):
+        '''Return the version that holds the value of an available expression, or None if it can't have one.'''
+        if expression.holder is not None:
+            return expression.holder
+        if not self.form.can_insert_before(expression.statement):
+            return None
+        
+        node = expression.node
+        type = temporary_type(node)
+        assignment = syntaxtree.Assign(None, node)
+        version = self.form.add_temporary(type, assignment)
+        assignment.target = syntaxtree.Name(version.id)
+        assignment.target.node_type = type
+        self.form.insert_before(expression.statement, assignment)
+        expression.setter(ssa.renamed(node, version))
+        expression.holder = version
+        
+        # Expressions inside of the node are in the new statement now.
+        stack = [node]
+        while stack:
+            child = stack.pop()
+            inner = self.recorded.get(id(child))
+            if inner is not None:
+                inner.statement = assignment
+            stack.extend(c for c in child if isinstance(c, syntaxtree.Node))
+        return version
+    
+    def visit_expression(self, node, setter, statement, scope):
+        if not isinstance(node, (syntaxtree.BinaryOp, syntaxtree.UnaryOp, syntaxtree.Subscript)):
+            return
+        key, reads_arrays, reads_names = self.expression_key(node)
+        reads_memory = reads_arrays or reads_names
+        table = self.memory if reads_memory else self.available
+        available = table.get(key)
+        if available is not None:
+            holder = self.holder(available)
+            if holder is not None:
+                setter(ssa.renamed(node, holder))
+                self.modified = True
+                return
+        
+        if isinstance(node, syntaxtree.BinaryOp):
+            self.visit_expression(node.left, lambda n: setattr(node, 'left', n), statement, scope)
+            self.visit_expression(node.right, lambda n: setattr(node, 'right', n), statement, scope)
+        elif isinstance(node, syntaxtree.UnaryOp):
+            self.visit_expression(node.operand, lambda n: setattr(node, 'operand', n), statement, scope)
+        else:
+            self.visit_expression(node.index, lambda n: setattr(node, 'index', n), statement, scope)
+        
+        if available is None:
+            expression = AvailableExpression(node, setter, statement)
+            if isinstance(statement, syntaxtree.Assign) and statement.value is node:
+                # The version the expression is assigned to already holds it.
+                target = self.form.assigned_name(statement)
+                if target in self.form.definitions:
+                    expression.holder = target
+            if expression.holder is not None or self.form.can_insert_before(statement):
+                table[key] = expression
+                if reads_memory:
+                    self.memory_reads[key] = (reads_arrays, reads_names)
+                else:
+                    scope.append(key)
+                self.recorded[id(node)] = expression
+                
+    def visit_statement(self, statement, scope):
+        if isinstance(statement, syntaxtree.Assign):
+            if isinstance(statement.target, syntaxtree.Subscript):
+                self.visit_expression(statement.target.index,
+                                      lambda n: setattr(statement.target, 'index', n),
+                                      statement, scope)
+            self.visit_expression(statement.value, lambda n: setattr(statement, 'value', n),
+                                  statement, scope)
+            
+            target = self.form.assigned_name(statement)
+            if target in self.form.definitions:
+                value = statement.value
+                if isinstance(value, syntaxtree.Name) and value in self.form.definitions:
+                    self.copies[target] = self.leader(value)
+            else:
+                self.kill(arrays=target is None, names=target is not None)
+        else:
+            for i, arg in enumerate(statement.args):
+                self.visit_expression(arg, lambda n, i=i: statement.args.__setitem__(i, n),
+                                      statement, scope)
+            self.kill(arrays=True, names=True)
+    
+    def set_test(self, block, node):
+        block.test = block.branch.test = node
+        
+    def kill(self, arrays, names):
+        '''Forget the expressions that read array elements or memory variables.'''
+        for key, (reads_arrays, reads_names) in self.memory_reads.items():
+            if (arrays and reads_arrays) or (names and reads_names):
+                del self.memory_reads[key]
+                self.memory.pop(key, None)
+                
+    def number(self):
+        '''Replace the expressions that are computed again with the versions that hold their values.
+        
+        Returns whether anything was replaced.'''
+        children = self.form.graph.dominator_tree()
+        stack = [(self.form.graph.entry, None)]
+        while stack:
+            block, scope = stack.pop()
+            if scope is not None:
+                for key in scope:
+                    del self.available[key]
+                continue
+            scope = []
+            self.memory = {}
+            self.memory_reads = {}
+            for statement in list(block.statements):
+                self.visit_statement(statement, scope)
+            if block.test is not None:
+                self.visit_expression(block.test, lambda n, block=block: self.set_test(block, n),
+                                      block, scope)
+            stack.append((block, scope))
+            stack.extend((child, None) for child in children[block])
+        return self.modified
+        
+def can_speculate(node):
+    '''Return whether an expression can be evaluated where the original code might not evaluate it.
+    
+    Array indexes might be out of bounds, integer division might trap, and
+    boolean operators check their operands at runtime.'''
+    if isinstance(node, syntaxtree.Subscript):
+        return False
+    if isinstance(node, syntaxtree.BinaryOp):
+        if node.node_type == tokens.BOOL:
+            return False
+        if node.op == tokens.DIVIDE and node.node_type == tokens.INT:
+            if not isinstance(node.right, syntaxtree.Num) or literal_value(node.right.n) in (0, -1):
+                return False
+        return can_speculate(node.left) and can_speculate(node.right)
+    if isinstance(node, syntaxtree.UnaryOp):
+        if node.op == tokens.NOT and node.node_type == tokens.BOOL:
+            return False
+        return can_speculate(node.operand)
+    if isinstance(node, syntaxtree.Select):
+        return all(can_speculate(field) for field in node)
+    return True
+
+class LoopInvariantCodeMotion(object):
+    '''Move computations out of For loops when they give the same value on every iteration.
+    
+    An expression is invariant in a loop if every version it reads is defined
+    outside of the loop, and the memory it reads isn't stored to anywhere in
+    the loop. Stores are treated as conservatively as they are for value
+    numbering: any store to an array element or call that might change one
+    makes every array element vary, and any store to a memory variable or call
+    with an out argument makes every memory variable vary. Calls to procedures
+    other than the runtime's can change anything.
+    
+    Assignments to versions whose values are invariant are moved to the
+    preheader, the end of the block right before the loop, where they run once
+    each time the loop is entered. Other invariant expressions, including the
+    ones in the loop's test and its assignment, are computed in a temporary in
+    the preheader. Inner loops are done first, so their invariants can be moved
+    out of the loops around them too.
+    
+    The body of a loop might not run at all, so expressions that can fail are
+    only moved out of the loop's test, and out of the first block of the body
+    when the loop is always entered.'''
+    def __init__(self, form, program):
+        self.form = form
+        self.scope = ssa.procedure_scope(form.procedure, program)
+        self.modified = False
+        
+    def find_stores(self, loop):
+        '''Return whether a loop might store to array elements and to memory variables.'''
+        arrays = names = False
+        for block in loop.blocks:
+            for statement in block.statements:
+                if isinstance(statement, syntaxtree.Assign):
+                    if isinstance(statement.target, syntaxtree.Subscript):
+                        arrays = True
+                    elif statement.target not in self.form.definitions:
+                        names = True
+                    continue
+                decl = self.scope[statement.func]
+                if decl.is_global and decl.name.id in callgraph.RUNTIME_PROCEDURES:
+                    if any(p.direction == tokens.OUT for p in decl.params):
+                        names = True
+                else:
+                    arrays = names = True
+        return arrays, names
+    
+    def is_invariant(self, node, loop, stores):
+        if isinstance(node, syntaxtree.Name):
+            if node in self.form.definitions:
+                return self.form.definition_block(node) not in loop.blocks
+            return not stores[1]
+        if isinstance(node, syntaxtree.Subscript):
+            return not stores[0] and self.is_invariant(node.index, loop, stores)
+        if isinstance(node, syntaxtree.BinaryOp):
+            return (self.is_invariant(node.left, loop, stores) and
+                    self.is_invariant(node.right, loop, stores))
+        if isinstance(node, syntaxtree.UnaryOp):
+            return self.is_invariant(node.operand, loop, stores)
+        return True
+    
+    def is_entered(self, loop):
+        '''Return whether a loop's test is always true when the loop is entered.'''
+        header = loop.header
+        entry = next(i for i, p in enumerate(header.predecessors)
+                     if not self.form.graph.dominates(header, p))
+        constants = {}
+        for phi in self.form.phis[header]:
+            definition = self.form.definitions[phi.args[entry]]
+            if (isinstance(definition, syntaxtree.Assign) and
+                isinstance(definition.value, syntaxtree.Num)):
+                constants[phi.target] = definition.value
+        value = evaluate_expression(header.test, lambda n: constants.get(n, VARYING))
+        return isinstance(value, syntaxtree.Num) and bool(literal_value(value.n))
+    
+    def hoist_expression(self, node, loop, stores, guaranteed):
+        '''Replace the largest invariant parts of an expression with temporaries computed in the preheader.'''
+        if not isinstance(node, (syntaxtree.BinaryOp, syntaxtree.UnaryOp, syntaxtree.Subscript)):
+            return node
+        if (any(True for _ in syntaxtree.iter_names(node)) and
+            self.is_invariant(node, loop, stores) and (guaranteed or can_speculate(node))):
+            type = temporary_type(node)
+            assignment = syntaxtree.Assign(None, node)
+            version = self.form.add_temporary(type, assignment)
+            assignment.target = syntaxtree.Name(version.id)
+            assignment.target.node_type = type
+            self.form.insert_in_preheader(loop.header, assignment)
+            self.modified = True
+            replacement = ssa.renamed(node, version)
+            replacement.node_type = type
+            return replacement
+        
+        if isinstance(node, syntaxtree.BinaryOp):
+            node.left = self.hoist_expression(node.left, loop, stores, guaranteed)
+            node.right = self.hoist_expression(node.right, loop, stores, guaranteed)
+        elif isinstance(node, syntaxtree.UnaryOp):
+            node.operand = self.hoist_expression(node.operand, loop, stores, guaranteed)
+        else:
+            node.index = self.hoist_expression(node.index, loop, stores, guaranteed)
+        return node
+    
+    def can_move(self, statement, loop, stores, guaranteed):
+        # Copies and constants are as cheap as moving their values out of the
+        # loop would be, and moving them would only make them live longer.
+        return (self.form.assigned_name(statement) in self.form.definitions and
+                isinstance(statement.value, (syntaxtree.BinaryOp, syntaxtree.UnaryOp,
+                                             syntaxtree.Subscript)) and
+                self.form.is_removable(statement) and
+                self.is_invariant(statement.value, loop, stores) and
+                (guaranteed or can_speculate(statement.value)))
+    
+    def visit_loop(self, loop, order):
+        stores = self.find_stores(loop)
+        guaranteed_blocks = set([loop.header])
+        if self.is_entered(loop):
+            guaranteed_blocks.add(loop.header.successors[0])
+        
+        for block in order:
+            if block not in loop.blocks:
+                continue
+            guaranteed = block in guaranteed_blocks
+            hoist = lambda e: self.hoist_expression(e, loop, stores, guaranteed)
+            for statement in list(block.statements):
+                if self.can_move(statement, loop, stores, guaranteed):
+                    self.form.remove(statement)
+                    self.form.insert_in_preheader(loop.header, statement)
+                    self.modified = True
+                else:
+                    self.form.rewrite(statement, hoist)
+            if block.test is not None:
+                self.form.rewrite(block, hoist)
+    
+    def hoist(self):
+        '''Move the invariant computations out of every For loop in the procedure.
+        
+        Returns whether anything was moved.'''
+        order = self.form.graph.reverse_postorder()
+        for loop in reversed(self.form.graph.loops()):
+            if loop.node is not None:
+                self.visit_loop(loop, order)
+        return self.modified
+        
+def typed_name(version, type):
+    '''Return a copy of a version's Name with a node type.'''
+    name = syntaxtree.Name(version.id)
+    name.node_type = type
+    return name
+
+class InductionVariable(object):
+    '''A variable that is changed by the same amount on every iteration of a loop.'''
+    def __init__(self, phi, increment, step):
+        # The phi in the loop's header, and the assignment that defines its
+        # value for the next iteration.
+        self.phi = phi
+        self.increment = increment
+        
+        # The loop invariant Num or version that's added on each iteration.
+        self.step = step
+        
+        # Maps the factors that the variable is multiplied by to the variables
+        # that replace the products, and the amounts they're incremented by.
+        self.reductions = collections.OrderedDict()
+
+class StrengthReducer(object):
+    '''Induction variable strength reduction and elimination on a procedure in SSA form.
+    
+    A basic induction variable of a For loop has a phi in the loop's header,
+    and the value it has on the next iteration is the phi plus a loop invariant
+    step, like the variable in the loop's assignment. Products of a basic
+    induction variable and a loop invariant factor, like the indexes in
+    a[i * 4], are replaced with a new induction variable. It starts out as the
+    product of the initial value and the factor, and is incremented by the step
+    times the factor at the end of each iteration, so the multiplication in the
+    loop becomes an addition.
+    
+    If the original variable is then only used to increment itself and in the
+    loop's test, the test is rewritten to compare the new variable, which is
+    incremented by the loop's assignment instead, and the original variable is
+    removed. Since ints wrap on overflow, this is only done when the start,
+    step, bound and factor are constants that keep both variables in range.'''
+    def __init__(self, form):
+        self.form = form
+        self.modified = False
+        
+    def is_invariant(self, node, loop):
+        if isinstance(node, syntaxtree.Num):
+            return literal_type(node) == tokens.INT
+        return (isinstance(node, syntaxtree.Name) and node in self.form.definitions and
+                self.form.definition_block(node) not in loop.blocks)
+    
+    def find_induction_variables(self, loop, latch):
+        '''Return a dict mapping the phi targets of the basic induction variables of a loop to their InductionVariables.'''
+        variables = {}
+        for phi in self.form.phis[loop.header]:
+            if self.form.variables[phi.variable].type != tokens.INT:
+                continue
+            increment = self.form.definitions[phi.args[latch]]
+            if (not isinstance(increment, syntaxtree.Assign) or
+                not isinstance(increment.value, syntaxtree.BinaryOp)):
+                continue
+            value = increment.value
+            step = None
+            if value.op == tokens.PLUS:
+                if value.left == phi.target and self.is_invariant(value.right, loop):
+                    step = value.right
+                elif value.right == phi.target and self.is_invariant(value.left, loop):
+                    step = value.left
+            elif (value.op == tokens.MINUS and value.left == phi.target and
+                  isinstance(value.right, syntaxtree.Num) and self.is_invariant(value.right, loop)):
+                step = fold_unary(tokens.MINUS, tokens.INT, value.right.n)
+            if step is not None:
+                variables[phi.target] = InductionVariable(phi, increment, step)
+        return variables
+    
+    def multiply(self, a, b, header):
+        '''Return a Num or version that holds the product of two loop invariants, computing it before the loop if needed.'''
+        if isinstance(a, syntaxtree.Num) and isinstance(b, syntaxtree.Num):
+            return fold_binary(tokens.MULTIPLY, tokens.INT, a.n, b.n)
+        if isinstance(a, syntaxtree.Num) and literal_value(a.n) == 1:
+            return b
+        if isinstance(b, syntaxtree.Num) and literal_value(b.n) == 1:
+            return a
+        product = syntaxtree.BinaryOp(tokens.MULTIPLY, a, b)
+        product.node_type = tokens.INT
+        return self.compute_in_preheader(product, header)
+    
+    def compute_in_preheader(self, value, header):
+        assignment = syntaxtree.Assign(None, value)
+        version = self.form.add_temporary(tokens.INT, assignment)
+        assignment.target = typed_name(version, tokens.INT)
+        self.form.insert_in_preheader(header, assignment)
+        return version
+        
+    def reduce(self, variable, factor, loop, entry):
+        '''Return the phi target of the variable that replaces an induction variable times a factor.'''
+        key = (factor.n,) if isinstance(factor, syntaxtree.Num) else factor.id
+        if key in variable.reductions:
+            return variable.reductions[key][0].target
+        
+        header = loop.header
+        initial = self.multiply(variable.phi.args[entry], factor, header)
+        if isinstance(initial, syntaxtree.Num):
+            initial = self.compute_in_preheader(initial, header)
+        phi = ssa.Phi(None, [None] * len(header.predecessors))
+        phi.target = self.form.add_temporary(tokens.INT, phi)
+        phi.variable = self.form.origins[phi.target]
+        phi.args[entry] = initial
+        self.form.add_phi(header, phi)
+        variable.reductions[key] = (phi, factor, self.multiply(variable.step, factor, header))
+        return phi.target
+    
+    def reduce_products(self, node, variables, loop, entry):
+        if isinstance(node, syntaxtree.BinaryOp):
+            if node.op == tokens.MULTIPLY and node.node_type == tokens.INT:
+                for operand, factor in ((node.left, node.right), (node.right, node.left)):
+                    if (isinstance(operand, syntaxtree.Name) and operand in variables and
+                        self.is_invariant(factor, loop)):
+                        self.modified = True
+                        reduction = self.reduce(variables[operand], factor, loop, entry)
+                        return typed_name(reduction, tokens.INT)
+            node.left = self.reduce_products(node.left, variables, loop, entry)
+            node.right = self.reduce_products(node.right, variables, loop, entry)
+        elif isinstance(node, syntaxtree.UnaryOp):
+            node.operand = self.reduce_products(node.operand, variables, loop, entry)
+        elif isinstance(node, syntaxtree.Subscript):
+            node.index = self.reduce_products(node.index, variables, loop, entry)
+        return node
+    
+    def is_only_read_by(self, version, sites):
+        '''Return whether the only statements, phis, and blocks that read a version are in a list.'''
+        readers = set()
+        for block in self.form.graph.blocks:
+            for site in self.form.phis[block] + block.statements + [block]:
+                if version in self.form.read_versions(site):
+                    readers.add(id(site))
+        return readers == set(id(s) for s in sites)
+    
+    def can_eliminate(self, variable, loop, entry, latch, phi, factor):
+        '''Return the new test for a loop if an induction variable can be replaced by one of its reductions.'''
+        header = loop.header
+        target = variable.phi.target
+        step = variable.step
+        test = header.test
+        initial = self.form.definitions[variable.phi.args[entry]]
+        if (variable.increment is not loop.node.assignment or
+            not isinstance(step, syntaxtree.Num) or literal_value(step.n) <= 0 or
+            not isinstance(factor, syntaxtree.Num) or literal_value(factor.n) <= 0 or
+            not isinstance(initial, syntaxtree.Assign) or
+            not isinstance(initial.value, syntaxtree.Num) or
+            not isinstance(test, syntaxtree.BinaryOp)):
+            return None
+        
+        if test.op in (tokens.LT, tokens.LTE) and test.left == target:
+            bound = test.right
+        elif test.op in (tokens.GT, tokens.GTE) and test.right == target:
+            bound = test.left
+        else:
+            return None
+        if not isinstance(bound, syntaxtree.Num) or literal_type(bound) != tokens.INT:
+            return None
+        
+        # The variable is at most the bound plus the step when the test fails.
+        start = literal_value(initial.value.n)
+        last = literal_value(bound.n) + literal_value(step.n)
+        scale = literal_value(factor.n)
+        if not all(to_int32(v) == v for v in (start, last, start * scale, last * scale)):
+            return None
+        
+        if (not self.is_only_read_by(target, [variable.increment, header]) or
+            not self.is_only_read_by(variable.phi.args[latch], [variable.phi])):
+            return None
+        
+        new_bound = fold_binary(tokens.MULTIPLY, tokens.INT, bound.n, factor.n)
+        if test.left == target:
+            new_test = syntaxtree.BinaryOp(test.op, typed_name(phi.target, tokens.INT), new_bound)
+        else:
+            new_test = syntaxtree.BinaryOp(test.op, new_bound, typed_name(phi.target, tokens.INT))
+        new_test.node_type = tokens.INT
+        return new_test
+    
+    def visit_loop(self, loop):
+        header = loop.header
+        if len(header.predecessors) != 2:
+            return
+        latch = next(i for i, p in enumerate(header.predecessors)
+                     if self.form.graph.dominates(header, p))
+        entry = 1 - latch
+        variables = self.find_induction_variables(loop, latch)
+        if not variables:
+            return
+        
+        reduce_products = lambda e: self.reduce_products(e, variables, loop, entry)
+        for block in self.form.graph.blocks:
+            if block not in loop.blocks:
+                continue
+            for statement in list(block.statements):
+                self.form.rewrite(statement, reduce_products)
+            if block.test is not None:
+                self.form.rewrite(block, reduce_products)
+        
+        eliminated = False
+        for variable in variables.itervalues():
+            for phi, factor, amount in variable.reductions.itervalues():
+                new_test = None
+                if not eliminated:
+                    new_test = self.can_eliminate(variable, loop, entry, latch, phi, factor)
+                if new_test is not None:
+                    eliminated = True
+                    header.test = header.branch.test = new_test
+                    self.form.remove_phi(variable.phi)
+                    # The loop's assignment increments the new variable instead.
+                    increment = variable.increment
+                else:
+                    increment = syntaxtree.Assign(None, None)
+                    self.form.append_to_loop_body(header, increment)
+                if isinstance(amount, syntaxtree.Num):
+                    amount = syntaxtree.Num(amount.n)
+                    amount.node_type = tokens.INT
+                else:
+                    amount = typed_name(amount, tokens.INT)
+                increment.value = syntaxtree.BinaryOp(tokens.PLUS, typed_name(phi.target, tokens.INT),
+                                                      amount)
+                increment.value.node_type = tokens.INT
+                next_version = self.form.add_temporary(tokens.INT, increment)
+                increment.target = typed_name(next_version, tokens.INT)
+                phi.args[latch] = next_version
+    
+    def reduce_loops(self):
+        '''Strength reduce the induction variables of every For loop in the procedure.
+        
+        Returns whether any products were replaced.'''
+        for loop in reversed(self.form.graph.loops()):
+            if loop.node is not None:
+                self.visit_loop(loop)
+        return self.modified
+    
+def eliminate_dead_definitions(form):
+    '''Remove assignments to SSA versions that are never read, and the phis that aren't needed.
+    
+    Everything that a statement with side effects or a branch reads is live,
+    along with everything read by the definitions of live versions. Returns
+    whether any statements were removed.'''
+    live = set()
+    worklist = []
+    
+    def mark_reads(site):
+        for version in form.read_versions(site):
+            definition = form.definitions[version]
+            if definition is not None and id(definition) not in live:
+                live.add(id(definition))
+                worklist.append(definition)
+                
+    def is_dead(statement):
+        return (form.assigned_name(statement) in form.definitions and
+                id(statement) not in live and form.is_removable(statement))
+    
+    for block in form.graph.blocks:
+        for statement in block.statements:
+            if (form.assigned_name(statement) not in form.definitions or
+                not form.is_removable(statement)):
+                mark_reads(statement)
+        mark_reads(block)
+    while worklist:
+        mark_reads(worklist.pop())
+    
+    removed = False
+    for block in form.graph.blocks:
+        for statement in [s for s in block.statements if is_dead(s)]:
+            form.remove(statement)
+            removed = True
+        form.phis[block][:] = [p for p in form.phis[block] if id(p) in live]
+    return removed
+    
+def tree_size(node):
+    '''Return the number of nodes in a tree or a list of trees.'''
+    if isinstance(node, list):
+        return sum(tree_size(child) for child in node)
+    if not isinstance(node, syntaxtree.Node):
+        return 0
+    return 1 + sum(tree_size(field) for field in node)
+
+# Loops are fully unrolled if the straight-line code would have at most this
+# many nodes, and partially unrolled loops have bodies of at most this size.
+MAX_UNROLLED_SIZE = 64
+
+DEFAULT_UNROLL_FACTOR = 4
+
+# Loops that are hot in a profile are unrolled by this many times the factor,
+# and into this many times MAX_UNROLLED_SIZE nodes.
+HOT_UNROLL_FACTOR = 2
+
+FLIPPED_COMPARISONS = {
+    tokens.LT: tokens.GT,
+    tokens.LTE: tokens.GTE,
+    tokens.GT: tokens.LT,
+    tokens.GTE: tokens.LTE,
+    tokens.NOTEQUAL: tokens.NOTEQUAL,
+}
+
+def assigns_variable(statement, variable):
+    '''Return whether a statement, or a statement nested in it, assigns to a variable.'''
+    return any(isinstance(s, syntaxtree.Assign) and s.target == variable
+               for s in syntaxtree.iter_statements([statement]))
+
+def initial_value(variable, before):
+    '''Return the constant that a variable holds after a list of statements, or None if it's unknown.'''
+    for statement in reversed(before):
+        if isinstance(statement, syntaxtree.Assign) and statement.target == variable:
+            if (isinstance(statement.value, syntaxtree.Num) and
+                literal_type(statement.value) == tokens.INT):
+                return literal_value(statement.value.n)
+            return None
+        if assigns_variable(statement, variable):
+            return None
+    return None
+
+def find_trip_count(node, before, variables):
+    '''Return the start, step, and number of iterations of a loop, or None if they aren't known.
+    
+    They are known when the loop's assignment adds a constant step to one of
+    the variables in a dict from find_variables, like i := i + 1, its test
+    compares the variable to a constant bound, nothing else in the loop assigns
+    to the variable, and the statement that last assigned to the variable in a
+    list of the statements before the loop set it to a constant.'''
+    assignment = node.assignment
+    variable = assignment.target
+    value = assignment.value
+    test = node.test
+    if (not isinstance(variable, syntaxtree.Name) or variable not in variables or
+        variables[variable].type != tokens.INT or
+        not isinstance(value, syntaxtree.BinaryOp) or
+        not isinstance(test, syntaxtree.BinaryOp) or
+        test.op not in FLIPPED_COMPARISONS or test.node_type != tokens.INT):
+        return None
+    
+    step = None
+    if value.op == tokens.PLUS:
+        if value.left == variable:
+            step = value.right
+        elif value.right == variable:
+            step = value.left
+    elif value.op == tokens.MINUS and value.left == variable:
+        step = value.right
+    if not isinstance(step, syntaxtree.Num):
+        return None
+    step = literal_value(step.n)
+    if value.op == tokens.MINUS:
+        step = -step
+    
+    op = test.op
+    if test.left == variable:
+        bound = test.right
+    elif test.right == variable:
+        op = FLIPPED_COMPARISONS[op]
+        bound = test.left
+    else:
+        return None
+    if not isinstance(bound, syntaxtree.Num):
+        return None
+    bound = literal_value(bound.n)
+    
+    if step == 0 or any(assigns_variable(s, variable) for s in node.body):
+        return None
+    start = initial_value(variable, before)
+    if start is None:
+        return None
+    
+    if op == tokens.LTE:
+        op, bound = tokens.LT, bound + 1
+    elif op == tokens.GTE:
+        op, bound = tokens.GT, bound - 1
+    if op == tokens.LT:
+        if start >= bound:
+            count = 0
+        elif step > 0:
+            count = (bound - start + step - 1) // step
+        else:
+            return None
+    elif op == tokens.GT:
+        if start <= bound:
+            count = 0
+        elif step < 0:
+            count = (start - bound - step - 1) // -step
+        else:
+            return None
+    else:
+        if (bound - start) % step != 0 or (bound - start) // step < 0:
+            return None
+        count = (bound - start) // step
+    
+    # The variable can't wrap around before the loop ends.
+    last = start + count * step
+    if to_int32(last) != last:
+        return None
+    return start, step, count
+
+class LoopAccesses(object):
+    '''The variables and array elements that a loop body reads and writes.'''
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        
+        # Tuples of (array, index, is_write). The index is a (coefficient,
+        # offset) pair for elements at coefficient * n + offset on the nth
+        # iteration, or None if the index is unknown or the whole array is
+        # passed to a procedure.
+        self.arrays = []
+        
+        self.has_calls = False
+        # Whether the body calls a procedure other than the runtime's, which
+        # can read and write any global variable.
+        self.calls_procedures = False
+        
+class LoopFuser(object):
+    '''Merge adjacent For loops that run for the same number of iterations.
+    
+    Two loops are adjacent when the second one directly follows the first,
+    apart from the assignment of its variable's initial value. If both have
+    trip counts known at compile time (see find_trip_count) and the counts are
+    equal, the body of the second loop is appended to the body of the first
+    one, which saves the test and jump of every iteration of the second loop.
+    If the loops use different variables, the second variable is initialized
+    before the fused loop and incremented at the end of its body.
+    
+    Fusion runs the nth iteration of the second body before the later
+    iterations of the first body, which is only legal if nothing that the
+    second body does on an iteration depends on, or is depended on by, a later
+    iteration of the first body. The loops aren't fused if:
+    
+        - either body returns, or both make calls, since calls can write
+          output
+        - a variable written by one body is read or written by the other
+        - one body calls a procedure other than the runtime's and the other
+          reads or writes a global variable or an array parameter
+        - an element written by one body might be read or written by the
+          other on an earlier iteration
+          
+    Array indexes are compared as linear functions of the iteration number,
+    and arrays passed to procedures other than the runtime's might have any of
+    their elements written. Local arrays can only alias themselves, but array parameters and global
+    arrays can all be the same array.'''
+    def __init__(self):
+        self.variables = {}
+        self.scope = {}
+        self.locals = set()
+        self.modified_tree = False
+        
+    def walk_procedure(self, node, program):
+        '''Fuse the loops in the body of a single procedure or program.'''
+        self.variables = ssa.find_variables(node, program)
+        self.scope = ssa.procedure_scope(node, program)
+        self.locals = set(d.name for d in node.decls
+                          if isinstance(d, syntaxtree.VarDecl) and not d.is_global)
+        if isinstance(node, syntaxtree.ProcDecl):
+            self.locals.update(p.var_decl.name for p in node.params
+                               if p.var_decl.array_length is None)
+        node.body = self.fuse_body(node.body)
+        return node
+    
+    def fuse_body(self, statements):
+        result = []
+        for statement in statements:
+            if isinstance(statement, syntaxtree.If):
+                statement.body = self.fuse_body(statement.body)
+                statement.orelse = self.fuse_body(statement.orelse)
+            elif isinstance(statement, syntaxtree.For):
+                statement.body = self.fuse_body(statement.body)
+                if (len(result) >= 2 and isinstance(result[-2], syntaxtree.For) and
+                    self.fuse(result[-2], result[-1], statement, result[:-2])):
+                    # The fused loop has the first loop's test, so if the loops
+                    # have different variables, the second one is initialized
+                    # before it.
+                    initialization = result.pop()
+                    if initialization.target != result[-1].assignment.target:
+                        result.insert(-1, initialization)
+                    self.modified_tree = True
+                    continue
+            result.append(statement)
+        return result
+    
+    def fuse(self, first, initialization, second, before):
+        '''Append the body of a loop to the body of the loop before it if they can be fused.
+        
+        Returns whether the loops were fused.'''
+        if (not isinstance(initialization, syntaxtree.Assign) or
+            initialization.target != second.assignment.target):
+            return False
+        first_trip = find_trip_count(first, before, self.variables)
+        second_trip = find_trip_count(second, [initialization], self.variables)
+        if first_trip is None or second_trip is None or first_trip[2] != second_trip[2]:
+            return False
+        
+        first_variable = first.assignment.target
+        second_variable = second.assignment.target
+        if first_variable == second_variable and first_trip != second_trip:
+            return False
+        first_accesses = self.find_accesses(first, before, first_trip)
+        second_accesses = self.find_accesses(second, [initialization], second_trip)
+        if (first_accesses is None or second_accesses is None or
+            not self.can_fuse(first_accesses, second_accesses, first_trip[2])):
+            return False
+        if first_variable != second_variable and (
+            second_variable in first_accesses.reads | first_accesses.writes or
+            first_variable in second_accesses.reads | second_accesses.writes):
+            return False
+        
+        first.body.extend(second.body)
+        if first_variable != second_variable:
+            first.body.append(second.assignment)
+        return True
+    
+    def find_inductions(self, node, before, trip):
+        '''Return a dict mapping the variables that a loop adds a constant to on every iteration to their (step, start).
+        
+        Besides the loop's own variable, this finds variables that are only
+        assigned by a single statement at the top level of the body that adds a
+        constant, like the variables made by strength reduction and the
+        variables of fused loops.'''
+        start, step, count = trip
+        inductions = {node.assignment.target: (step, start)}
+        assignments = collections.defaultdict(list)
+        for statement in syntaxtree.iter_statements(node.body):
+            if isinstance(statement, syntaxtree.Assign) and isinstance(statement.target, syntaxtree.Name):
+                assignments[statement.target].append(statement)
+        for statement in node.body:
+            if (not isinstance(statement, syntaxtree.Assign) or
+                not isinstance(statement.target, syntaxtree.Name)):
+                continue
+            variable = statement.target
+            value = statement.value
+            if (variable not in self.variables or self.variables[variable].type != tokens.INT or
+                variable in inductions or assignments[variable] != [statement] or
+                not isinstance(value, syntaxtree.BinaryOp) or
+                value.op not in (tokens.PLUS, tokens.MINUS) or value.left != variable or
+                not isinstance(value.right, syntaxtree.Num)):
+                continue
+            start = initial_value(variable, before)
+            if start is not None:
+                step = literal_value(value.right.n)
+                inductions[variable] = (step if value.op == tokens.PLUS else -step, start)
+        return inductions
+    
+    def index_function(self, node, inductions):
+        '''Return the (coefficient, offset) of an index as a function of the iteration number, or None if it isn't linear.'''
+        if isinstance(node, syntaxtree.Num):
+            if literal_type(node) != tokens.INT:
+                return None
+            return 0, literal_value(node.n)
+        if isinstance(node, syntaxtree.Name):
+            return inductions.get(node)
+        if isinstance(node, syntaxtree.UnaryOp):
+            operand = self.index_function(node.operand, inductions)
+            if node.op != tokens.MINUS or operand is None:
+                return None
+            return -operand[0], -operand[1]
+        if isinstance(node, syntaxtree.BinaryOp):
+            left = self.index_function(node.left, inductions)
+            right = self.index_function(node.right, inductions)
+            if left is None or right is None:
+                return None
+            if node.op == tokens.PLUS:
+                return left[0] + right[0], left[1] + right[1]
+            if node.op == tokens.MINUS:
+                return left[0] - right[0], left[1] - right[1]
+            if node.op == tokens.MULTIPLY:
+                if left[0] == 0:
+                    return left[1] * right[0], left[1] * right[1]
+                if right[0] == 0:
+                    return left[0] * right[1], left[1] * right[1]
+        return None
+    
+    def find_accesses(self, loop, before, trip):
+        '''Return the LoopAccesses of a loop's body, or None if it returns.'''
+        accesses = LoopAccesses()
+        inductions = self.find_inductions(loop, before, trip)
+        
+        def read(node):
+            if isinstance(node, syntaxtree.Name):
+                accesses.reads.add(node)
+            elif isinstance(node, syntaxtree.Subscript):
+                accesses.arrays.append((node.name, self.index_function(node.index, inductions),
+                                        False))
+                read(node.index)
+            elif isinstance(node, syntaxtree.BinaryOp):
+                read(node.left)
+                read(node.right)
+            elif isinstance(node, syntaxtree.UnaryOp):
+                read(node.operand)
+                
+        def write(node):
+            if isinstance(node, syntaxtree.Subscript):
+                accesses.arrays.append((node.name, self.index_function(node.index, inductions),
+                                        True))
+                read(node.index)
+            else:
+                accesses.writes.add(node)
+        
+        for top_level in loop.body:
+            for statement in syntaxtree.iter_statements([top_level]):
+                if isinstance(statement, syntaxtree.Return):
+                    return None
+                if isinstance(statement, syntaxtree.Assign):
+                    write(statement.target)
+                    read(statement.value)
+                elif isinstance(statement, syntaxtree.Call):
+                    accesses.has_calls = True
+                    decl = self.scope[statement.func]
+                    is_runtime = decl.is_global and decl.name.id in callgraph.RUNTIME_PROCEDURES
+                    if not is_runtime:
+                        accesses.calls_procedures = True
+                    for param, arg in itertools.izip(decl.params, statement.args):
+                        if param.var_decl.array_length is not None:
+                            # Other procedures can pass in arrays on to out
+                            # parameters.
+                            accesses.arrays.append((arg, None, param.direction == tokens.OUT or
+                                                    not is_runtime))
+                        elif param.direction == tokens.OUT:
+                            write(arg)
+                        else:
+                            read(arg)
+                else:
+                    read(statement.test)
+            
+            # The statements after the increment of an induction variable see
+            # the value it has on the next iteration.
+            if (isinstance(top_level, syntaxtree.Assign) and
+                isinstance(top_level.target, syntaxtree.Name) and
+                top_level.target in inductions and top_level.target != loop.assignment.target):
+                step, start = inductions[top_level.target]
+                inductions[top_level.target] = (step, start + step)
+        return accesses
+    
+    def uses_globals(self, accesses):
+        '''Return whether a loop body reads or writes global variables or array parameters.'''
+        return (any(name not in self.locals for name in accesses.reads | accesses.writes) or
+                any(array not in self.locals for array, index, is_write in accesses.arrays))
+    
+    def may_alias(self, a, b):
+        return a == b or (a not in self.locals and b not in self.locals)
+    
+    def is_earlier(self, first_index, second_index, count):
+        '''Return whether an element accessed by the first body might be accessed by the second body on an earlier iteration.'''
+        if first_index is None or second_index is None:
+            return True
+        coefficient, offset = first_index
+        if second_index[0] != coefficient:
+            return True
+        # The first body's element on iteration n is the second body's element
+        # on iteration n - distance.
+        difference = second_index[1] - offset
+        if coefficient == 0:
+            return difference == 0 and count > 1
+        return difference % coefficient == 0 and 0 < difference // coefficient < count
+    
+    def can_fuse(self, first, second, count):
+        if first.has_calls and second.has_calls:
+            return False
+        if ((first.calls_procedures and self.uses_globals(second)) or
+            (second.calls_procedures and self.uses_globals(first))):
+            return False
+        if (first.writes & (second.reads | second.writes) or
+            second.writes & first.reads):
+            return False
+        for first_array, first_index, first_writes in first.arrays:
+            for second_array, second_index, second_writes in second.arrays:
+                if ((first_writes or second_writes) and
+                    self.may_alias(first_array, second_array) and
+                    self.is_earlier(first_index, second_index, count)):
+                    return False
+        return True
+    
+class LoopUnroller(object):
+    '''Unroll For loops that run a number of times known at compile time.
+    
+    See find_trip_count for the loops that this applies to. If the body and
+    the assignment repeated for every iteration are small enough, the loop is
+    replaced by the repeated statements, which saves the test and the jump back
+    to the header on every iteration and lets constant propagation see the
+    value of the variable in each copy.
+    
+    Otherwise the body is repeated factor times in the loop, with the
+    assignment between the copies, and the test is changed so the loop stops
+    before it would run past the bound. The iterations that are left over run
+    in a remainder loop after it, or as straight-line code if they're small
+    enough. Loops created by partial unrolling are recorded in a dict that can
+    be shared between runs, and aren't unrolled again.
+    
+    If a Profile is given, loops whose bodies never ran aren't unrolled, and
+    hot loops are unrolled further (see HOT_UNROLL_FACTOR).'''
+    def __init__(self, factor=DEFAULT_UNROLL_FACTOR, unrolled=None, profile=None):
+        self.factor = factor
+        self.profile = profile
+        # Maps the ids of the loops made by partial unrolling to the loops,
+        # which keeps them alive so that their ids aren't reused.
+        self.unrolled = {} if unrolled is None else unrolled
+        self.variables = {}
+        self.modified_tree = False
+        
+    def walk_procedure(self, node, program):
+        '''Unroll the loops in the body of a single procedure or program.'''
+        self.variables = ssa.find_variables(node, program)
+        node.body = self.unroll_body(node.body)
+        return node
+        
+    def unroll_body(self, statements):
+        result = []
+        for statement in statements:
+            if isinstance(statement, syntaxtree.If):
+                statement.body = self.unroll_body(statement.body)
+                statement.orelse = self.unroll_body(statement.orelse)
+            elif isinstance(statement, syntaxtree.For):
+                # Inner loops are unrolled first, so that the cost of the outer
+                # loop includes their unrolled bodies.
+                statement.body = self.unroll_body(statement.body)
+                if id(statement) not in self.unrolled:
+                    trip = find_trip_count(statement, result, self.variables)
+                    if trip is not None:
+                        unrolled = self.unroll(statement, *trip)
+                        if unrolled is not None:
+                            self.modified_tree = True
+                            result.extend(unrolled)
+                            continue
+            result.append(statement)
+        return result
+    
+    def repeat(self, node, count):
+        '''Return a list of statements that runs count iterations of a loop.'''
+        statements = []
+        for i in xrange(count):
+            statements.extend(syntaxtree.copy_tree(node.body))
+            statements.append(syntaxtree.copy_tree(node.assignment))
+        return statements
+    
+    def limits(self, node):
+        '''Return the unroll factor and the maximum unrolled size for a loop.'''
+        if self.profile is not None:
+            iterations = self.profile.iteration_count(node)
+            if self.profile.is_cold(iterations):
+                return 1, 0
+            if self.profile.is_hot(iterations):
+                return (self.factor * HOT_UNROLL_FACTOR,
+                        MAX_UNROLLED_SIZE * HOT_UNROLL_FACTOR)
+        return self.factor, MAX_UNROLLED_SIZE
+    
+    def unroll(self, node, start, step, count):
+        '''Return the statements that replace a loop, or None if it's too large to unroll.'''
+        max_factor, max_size = self.limits(node)
+        size = tree_size(node.body) + tree_size(node.assignment)
+        if count * size <= max_size:
+            return self.repeat(node, count)
+        
+        factor = min(max_factor, max_size // size)
+        if factor > self.factor:
+            # Hot loops are unrolled as far as their trip count allows, but
+            # never less than they would be without a profile.
+            factor = max(min(factor, count // 2), self.factor)
+        if factor < 2 or count < factor * 2:
+            return None
+        
+        remainder = count % factor
+        if remainder * size <= max_size:
+            after = self.repeat(node, remainder)
+        else:
+            after = [syntaxtree.For(syntaxtree.copy_tree(node.assignment),
+                                    syntaxtree.copy_tree(node.test),
+                                    syntaxtree.copy_tree(node.body), token=node.token)]
+            self.unrolled[id(after[0])] = after[0]
+            
+        # The last copy of the assignment is the loop's own.
+        node.body = self.repeat(node, factor)[:-1]
+        end = start + (count - remainder) * step
+        variable = node.assignment.target
+        name = syntaxtree.Name(variable.id, token=variable.token)
+        name.node_type = tokens.INT
+        bound = make_literal(end)
+        bound.node_type = tokens.INT
+        node.test = syntaxtree.BinaryOp(tokens.LT if step > 0 else tokens.GT, name, bound,
+                                        token=node.test.token)
+        node.test.node_type = tokens.INT
+        self.unrolled[id(node)] = node
+        return [node] + after
+
+def used_names(statements):
+    '''Return a set of the Names read or written by a list of statements, including the names of arrays.'''
+    used = set()
+    for statement in syntaxtree.iter_statements(statements):
+        if isinstance(statement, syntaxtree.Assign):
+            used.update(syntaxtree.iter_names(statement.target))
+            used.update(syntaxtree.iter_names(statement.value))
+        elif isinstance(statement, syntaxtree.Call):
+            for arg in statement.args:
+                used.update(syntaxtree.iter_names(arg))
+        elif isinstance(statement, (syntaxtree.If, syntaxtree.For)):
+            used.update(syntaxtree.iter_names(statement.test))
+    return used
+
+# Procedures are inlined at every call site if their bodies have at most this
+# many nodes, and at their only call site if they have at most
+# MAX_SINGLE_CALL_INLINED_SIZE, since they're removed afterwards.
+DEFAULT_INLINE_SIZE = 32
+MAX_SINGLE_CALL_INLINED_SIZE = 512
+
+# With a profile, procedures of up to this many times the inline size are
+# inlined at hot call sites.
+HOT_INLINE_FACTOR = 4
+
+# Procedures with other call sites aren't inlined into callers that would grow
+# past this many nodes.
+MAX_INLINING_CALLER_SIZE = 2048
+
+# Each Return in an If can double the statements after the If when they're
+# inlined (see remove_returns), so only procedures with a few are inlined.
+MAX_INLINED_RETURNS = 8
+
+def contains_return(statements):
+    '''Return whether a list of statements has a Return in it, including in branches and loops.'''
+    return any(isinstance(s, syntaxtree.Return) for s in syntaxtree.iter_statements(statements))
+
+def remove_returns(statements):
+    '''Rewrite a procedure body without Returns, so that it can be inlined.
+    
+    The statements after an If that might return are moved into both of its
+    branches, where they are dropped after any Return. Returns inside of loops
+    aren't supported. Returns the new list of statements, and whether every
+    path through it returns.'''
+    result = []
+    for i, statement in enumerate(statements):
+        if isinstance(statement, syntaxtree.Return):
+            return result, True
+        if isinstance(statement, syntaxtree.If) and contains_return([statement]):
+            rest = statements[i + 1:]
+            statement.body, body_returns = remove_returns(statement.body + rest)
+            statement.orelse, orelse_returns = remove_returns(statement.orelse +
+                                                              syntaxtree.copy_tree(rest))
+            result.append(statement)
+            return result, body_returns and orelse_returns
+        result.append(statement)
+    return result, False
+
+def substitute_variables(node, replacements):
+    '''Return an expression with Names replaced by copies of the nodes they map to in a dict.
+    
+    Unlike syntaxtree.replace_names, the names of subscripted arrays are
+    replaced too, and the expression is changed in place.'''
+    if isinstance(node, syntaxtree.Name):
+        replacement = replacements.get(node)
+        if replacement is None:
+            return node
+        if isinstance(replacement, syntaxtree.Name):
+            return ssa.renamed(node, replacement)
+        return syntaxtree.copy_tree(replacement)
+    elif isinstance(node, syntaxtree.BinaryOp):
+        node.left = substitute_variables(node.left, replacements)
+        node.right = substitute_variables(node.right, replacements)
+    elif isinstance(node, syntaxtree.UnaryOp):
+        node.operand = substitute_variables(node.operand, replacements)
+    elif isinstance(node, syntaxtree.Subscript):
+        node.name = substitute_variables(node.name, replacements)
+        node.index = substitute_variables(node.index, replacements)
+    return node
+
+def procedure_variables(node):
+    '''Return a dict mapping the local variables and parameters of a procedure or program to their declarations.'''
+    variables = dict((d.name, d) for d in node.decls
+                     if isinstance(d, syntaxtree.VarDecl) and not d.is_global)
+    if isinstance(node, syntaxtree.ProcDecl):
+        variables.update((p.var_decl.name, p.var_decl) for p in node.params)
+    return variables
+
+def is_runtime_procedure(decl):
+    return decl.is_global and decl.name.id in callgraph.RUNTIME_PROCEDURES
+
+class Inliner(object):
+    '''Replace calls to small procedures with copies of their bodies.
+    
+    A call stores and reloads every register, pushes its arguments, and jumps
+    to the procedure and back, which costs more than the whole body of a small
+    procedure. Procedures with small enough bodies are inlined at every call
+    site, and larger procedures are inlined if they only have one call site,
+    which leaves them unreachable.
+    
+    In parameters are passed by value, so the argument is assigned to a new
+    variable before the inlined body, unless it's a literal or a local
+    variable of the caller that the body can't change, which are used
+    directly. Out parameters and arrays are passed by reference, so they're
+    replaced by the variables passed for them. The callee's local variables are
+    declared in the caller with new names, and its Returns are removed with
+    remove_returns.
+    
+    A call isn't inlined if:
+    
+        - the callee is recursive or a runtime procedure
+        - the callee returns from inside of a loop
+        - the callee calls a procedure that has a different declaration, or
+          none, in the caller's scope, like the callee's nested procedures
+        - a global variable used by the callee is shadowed in the caller
+        - an argument's type is different from its parameter's
+        - the same variable is passed for two out parameters, or a global
+          variable is passed for an out parameter and the callee could also
+          read or write it directly, since the callee only stores out
+          parameters when it returns
+    
+    If a Profile is given, the size limit is raised at hot call sites (see
+    HOT_INLINE_FACTOR), and call sites that never ran are only inlined if
+    they're the callee's only one.'''
+    def __init__(self, graph, max_size=DEFAULT_INLINE_SIZE, profile=None):
+        self.graph = graph
+        self.max_size = max_size
+        self.profile = profile
+        self.procedure = None
+        self.scope = {}
+        self.variables = {}
+        self.calls = {}
+        self.modified_tree = False
+        
+    def walk_procedure(self, node, program):
+        '''Inline the calls in the body of a single procedure or program.'''
+        self.procedure = node
+        self.scope = ssa.procedure_scope(node, program)
+        self.variables = dict((d.name, d) for d in program.decls
+                              if isinstance(d, syntaxtree.VarDecl) and d.is_global)
+        self.variables.update(procedure_variables(node))
+        # Calls in the inlined bodies aren't in the call graph until it's
+        # updated, so they're left for the next run.
+        self.calls = dict((id(call), decl) for call, decl in self.graph.calls(node))
+        node.body = self.inline_body(node.body)
+        return node
+        
+    def inline_body(self, statements):
+        result = []
+        for statement in statements:
+            if isinstance(statement, syntaxtree.If):
+                statement.body = self.inline_body(statement.body)
+                statement.orelse = self.inline_body(statement.orelse)
+            elif isinstance(statement, syntaxtree.For):
+                statement.body = self.inline_body(statement.body)
+            elif isinstance(statement, syntaxtree.Call):
+                callee = self.calls.get(id(statement))
+                if callee is not None and self.can_inline(callee, statement):
+                    inlined = self.inline(statement, callee)
+                    if inlined is not None:
+                        result.extend(inlined)
+                        self.modified_tree = True
+                        continue
+            result.append(statement)
+        return result
+    
+    def call_sites(self, callee):
+        return sum(1 for caller in self.graph.callers(callee)
+                   for call, decl in self.graph.calls(caller) if decl is callee)
+    
+    def size_limit(self, call):
+        '''Return the size of the largest procedure that's inlined at a call site with other call sites.'''
+        if self.profile is None:
+            return self.max_size
+        count = self.profile.call_count(call)
+        if self.profile.is_cold(count):
+            return 0
+        if self.profile.is_hot(count):
+            return self.max_size * HOT_INLINE_FACTOR
+        return self.max_size
+    
+    def can_inline(self, callee, call):
+        '''Return whether the body of a procedure can and should replace a call to it.'''
+        if (self.max_size <= 0 or callee is self.procedure or is_runtime_procedure(callee) or
+            any(c is callee for c in self.graph.callees(callee))):
+            return False
+        
+        size = tree_size(callee.body)
+        if size > self.size_limit(call):
+            if size > MAX_SINGLE_CALL_INLINED_SIZE or self.call_sites(callee) != 1:
+                return False
+        elif (self.call_sites(callee) != 1 and
+              tree_size(self.procedure.body) + size > MAX_INLINING_CALLER_SIZE):
+            return False
+        
+        returns = 0
+        for statement in syntaxtree.iter_statements(callee.body):
+            if isinstance(statement, syntaxtree.Return):
+                returns += 1
+            elif isinstance(statement, syntaxtree.For) and contains_return(statement.body):
+                return False
+        if returns > MAX_INLINED_RETURNS:
+            return False
+        
+        return all(self.scope.get(call.func) is decl for call, decl in self.graph.calls(callee))
+    
+    def new_variables(self, callee, variables):
+        '''Declare copies of a callee's variables in the caller, and return a dict mapping the old names to the new ones.
+        
+        The new names start with the callee's name and a number that makes
+        them unique in the caller.'''
+        number = 1
+        while any(syntaxtree.Name('%s.%d.%s' % (callee.name.id, number, v.id)) in self.variables
+                  for v in variables):
+            number += 1
+        names = {}
+        for variable, decl in variables.iteritems():
+            name = syntaxtree.Name('%s.%d.%s' % (callee.name.id, number, variable.id))
+            new_decl = syntaxtree.VarDecl(False, decl.type, name,
+                                          syntaxtree.copy_tree(decl.array_length))
+            self.procedure.decls.append(new_decl)
+            self.variables[name] = new_decl
+            names[variable] = name
+        return names
+    
+    def inline(self, call, callee):
+        '''Return the statements that replace a call, or None if it can't be inlined.'''
+        used = used_names(callee.body)
+        callee_variables = procedure_variables(callee)
+        for name in used:
+            if name not in callee_variables:
+                decl = self.variables.get(name)
+                if decl is None or not decl.is_global:
+                    return None
+        
+        out_args = [arg for arg, param in zip(call.args, callee.params)
+                    if param.direction == tokens.OUT]
+        if len(set(out_args)) != len(out_args):
+            return None
+        
+        replacements = {}
+        copied = {}
+        for arg, param in zip(call.args, callee.params):
+            decl = param.var_decl
+            if param.direction == tokens.OUT or decl.array_length is not None:
+                arg_decl = self.variables.get(arg)
+                if (arg_decl is None or arg_decl.type != decl.type or
+                    (arg_decl.array_length is None) != (decl.array_length is None)):
+                    return None
+                if (param.direction == tokens.OUT and arg_decl.is_global and
+                    (arg in used or not all(is_runtime_procedure(c)
+                                            for c in self.graph.callees(callee)))):
+                    return None
+                replacements[decl.name] = arg
+            elif arg.node_type != decl.type:
+                return None
+            elif (isinstance(arg, (syntaxtree.Num, syntaxtree.Str)) or
+                  (isinstance(arg, syntaxtree.Name) and arg not in out_args and
+                   not self.variables[arg].is_global)):
+                replacements[decl.name] = arg
+            else:
+                copied[decl.name] = (decl, arg)
+        
+        # Copied in parameters and the callee's local variables get new
+        # variables in the caller.
+        variables = collections.OrderedDict()
+        for param in callee.params:
+            if param.var_decl.name in copied:
+                variables[param.var_decl.name] = param.var_decl
+        for decl in callee.decls:
+            if isinstance(decl, syntaxtree.VarDecl):
+                variables[decl.name] = decl
+        new_names = self.new_variables(callee, variables)
+        replacements.update(new_names)
+        
+        statements = []
+        for param in callee.params:
+            if param.var_decl.name in copied:
+                decl, arg = copied[param.var_decl.name]
+                target = typed_name(new_names[decl.name], decl.type)
+                statements.append(syntaxtree.Assign(target, arg, token=call.token))
+        
+        body = syntaxtree.copy_tree(callee.body)
+        for statement in syntaxtree.iter_statements(body):
+            if isinstance(statement, syntaxtree.Assign):
+                statement.target = substitute_variables(statement.target, replacements)
+                statement.value = substitute_variables(statement.value, replacements)
+            elif isinstance(statement, syntaxtree.Call):
+                statement.args = [substitute_variables(a, replacements) for a in statement.args]
+            elif isinstance(statement, (syntaxtree.If, syntaxtree.For)):
+                statement.test = substitute_variables(statement.test, replacements)
+        body, _ = remove_returns(body)
+        return statements + body
+
+def unique_name(base, variables):
+    '''Return a Name for a new variable that isn't one of the names in a set or dict.'''
+    name = syntaxtree.Name(base)
+    number = 0
+    while name in variables:
+        number += 1
+        name = syntaxtree.Name('%s.%d' % (base, number))
+    return name
+
+class TailRecursionEliminator(object):
+    '''Turn calls that a procedure makes to itself in tail position into a loop.
+    
+    A call in tail position (see callgraph.iter_tail_calls) is replaced by
+    assignments of the arguments to the in parameters and of true to a new
+    variable, and the body is put in a For loop that runs again while that
+    variable is true. The Returns in the body are removed with remove_returns,
+    so that they leave the loop instead. Arguments that read other parameters
+    are assigned to new variables first, since all of the arguments are
+    evaluated before any parameter changes.
+    
+    Out parameters and arrays are passed by reference, so a call is only
+    replaced if it passes the procedure's own parameters for them. Procedures
+    that return from inside of a loop are left alone. Calls in tail position
+    to other procedures reuse the caller's stack frame in the generated code
+    instead.'''
+    def __init__(self, graph):
+        self.graph = graph
+        self.modified_tree = False
+        
+    def walk_procedure(self, node, program):
+        '''Eliminate the tail recursion in a single procedure.'''
+        if not isinstance(node, syntaxtree.ProcDecl):
+            return node
+        calls = [c for c in callgraph.iter_tail_calls(node.body)
+                 if self.graph.resolve(node, c.func) is node and self.can_eliminate(node, c)]
+        if not calls:
+            return node
+        
+        returns = 0
+        for statement in syntaxtree.iter_statements(node.body):
+            if isinstance(statement, syntaxtree.Return):
+                returns += 1
+            elif isinstance(statement, syntaxtree.For) and contains_return(statement.body):
+                return node
+        if returns > MAX_INLINED_RETURNS:
+            return node
+        
+        variables = procedure_variables(node)
+        flag = unique_name('%s.recurse' % node.name.id, variables)
+        variables[flag] = syntaxtree.VarDecl(False, tokens.BOOL, flag, None)
+        node.decls.append(variables[flag])
+        
+        replaced = set(id(c) for c in calls)
+        for container in ssa.iter_containers(node.body):
+            statements = []
+            for statement in container:
+                if id(statement) in replaced:
+                    statements.extend(self.assign_parameters(node, statement, variables))
+                    statements.append(self.set_flag(flag, True))
+                else:
+                    statements.append(statement)
+            container[:] = statements
+        body, _ = remove_returns(node.body)
+        
+        # The loop's assignment doesn't do anything, since the flag is set
+        # where the calls were.
+        test = typed_name(flag, tokens.BOOL)
+        node.body = [self.set_flag(flag, True),
+                     syntaxtree.For(syntaxtree.Assign(typed_name(flag, tokens.BOOL), test), test,
+                                    [self.set_flag(flag, False)] + body)]
+        self.modified_tree = True
+        return node
+    
+    def set_flag(self, flag, value):
+        literal = make_literal(value)
+        literal.node_type = tokens.BOOL
+        return syntaxtree.Assign(typed_name(flag, tokens.BOOL), literal)
+    
+    def can_eliminate(self, node, call):
+        for arg, param in zip(call.args, node.params):
+            decl = param.var_decl
+            if param.direction == tokens.OUT or decl.array_length is not None:
+                if arg != decl.name:
+                    return False
+            elif arg.node_type != decl.type:
+                return False
+        return True
+    
+    def assign_parameters(self, node, call, variables):
+        '''Return the assignments that pass the arguments of a call to the procedure's in parameters.'''
+        changed = [(param.var_decl, arg) for arg, param in zip(call.args, node.params)
+                   if param.direction == tokens.IN and param.var_decl.array_length is None and
+                   arg != param.var_decl.name]
+        changed_names = set(decl.name for decl, arg in changed)
+        copies = []
+        assignments = []
+        for decl, arg in changed:
+            if any(n in changed_names and n != decl.name for n in syntaxtree.iter_names(arg)):
+                temporary = unique_name('%s.next' % decl.name.id, variables)
+                variables[temporary] = syntaxtree.VarDecl(False, decl.type, temporary, None)
+                node.decls.append(variables[temporary])
+                copies.append(syntaxtree.Assign(typed_name(temporary, decl.type), arg))
+                arg = typed_name(temporary, decl.type)
+            assignments.append(syntaxtree.Assign(typed_name(decl.name, decl.type), arg))
+        return copies + assignments
+
+# An If is only converted into a Select if the values that are evaluated on
+# every run, instead of only on the branch that's taken, cost at most this much
+# in total (see speculation_cost). A mispredicted branch costs about as much as
+# a dozen simple operations, but one that's predicted well costs almost
+# nothing, so only a little work is speculated.
+MAX_SPECULATED_COST = 8
+
+# The costs of the operators that take more than one operation in
+# speculation_cost.
+SPECULATION_COSTS = {
+    tokens.MULTIPLY: 3,
+    tokens.DIVIDE: 10,
+}
+
+def speculation_cost(node):
+    '''Return roughly how many operations evaluating an expression takes.'''
+    if isinstance(node, syntaxtree.BinaryOp):
+        return (SPECULATION_COSTS.get(node.op, 1) + speculation_cost(node.left) +
+                speculation_cost(node.right))
+    if isinstance(node, syntaxtree.UnaryOp):
+        return 1 + speculation_cost(node.operand)
+    if isinstance(node, syntaxtree.Select):
+        return 1 + sum(speculation_cost(field) for field in node)
+    return 0
+
+class IfConverter(object):
+    '''Replace Ifs that only choose the value of a variable by assignments of Selects.
+    
+    An If is converted if its body and orelse each assign to the same scalar
+    variable and do nothing else, or if one of them does and the other is
+    empty, in which case the variable keeps its value:
+    
+        if (x < y) then m := x; else m := y; end if;  ->  m := select(x < y, x, y)
+        if (c) then n := n + 1; end if;               ->  n := select(c, n + 1, n)
+        
+    The code generator writes Selects as conditional expressions, which C
+    compilers turn into conditional moves instead of branches that can be
+    mispredicted. Both values are evaluated every time, so they have to be
+    safe to evaluate when their branch isn't taken (see can_speculate), and
+    cost at most max_cost. Nested Ifs are converted first, so an If whose
+    branches became Selects can be converted too.
+    
+    Float variables are left alone, since assignments to them convert their
+    values from ints (see CodeGenerator.visit_assign). The other passes don't
+    handle Selects, so this one runs after all of them.'''
+    def __init__(self, max_cost=MAX_SPECULATED_COST):
+        self.max_cost = max_cost
+        self.modified_tree = False
+        
+    def walk_procedure(self, node, program):
+        '''Convert the Ifs in the body of a single procedure or program.'''
+        node.body = self.convert_body(node.body)
+        return node
+    
+    def convert_body(self, statements):
+        result = []
+        for statement in statements:
+            if isinstance(statement, syntaxtree.If):
+                statement.body = self.convert_body(statement.body)
+                statement.orelse = self.convert_body(statement.orelse)
+                assignment = self.convert(statement)
+                if assignment is not None:
+                    statement = assignment
+                    self.modified_tree = True
+            elif isinstance(statement, syntaxtree.For):
+                statement.body = self.convert_body(statement.body)
+            result.append(statement)
+        return result
+    
+    def convert(self, node):
+        '''Return the assignment of a Select that an If can be replaced by, or None.'''
+        branches = [node.body, node.orelse]
+        if any(len(branch) > 1 for branch in branches):
+            return None
+        assignments = [branch[0] for branch in branches if branch]
+        if not assignments or not all(isinstance(a, syntaxtree.Assign) for a in assignments):
+            return None
+        target = assignments[0].target
+        if (not isinstance(target, syntaxtree.Name) or target.node_type == tokens.FLOAT or
+            any(a.target != target for a in assignments)):
+            return None
+        values = [branch[0].value if branch else target for branch in branches]
+        if (any(value.node_type == tokens.FLOAT for value in values) or
+            not all(can_speculate(value) for value in values) or
+            sum(speculation_cost(value) for value in values) > self.max_cost):
+            return None
+        select = syntaxtree.Select(node.test, values[0], values[1], token=node.token)
+        select.node_type = target.node_type
+        return syntaxtree.Assign(target, select, token=assignments[0].token)
+
+# The maximum number of times that the passes are run on a single procedure.
+# Most procedures reach a fixed point in two or three runs.
+DEFAULT_ITERATION_BUDGET = 10
+
+def remove_unreachable_procedures(call_graph):
+    '''Remove procedures that can't be called from the program body.'''
+    reachable = set(id(p) for p in call_graph.reachable())
+    for procedure in list(call_graph.procedures):
+        if id(procedure) not in reachable and procedure in call_graph:
+            call_graph.remove(procedure)
+            
+def remove_unused_globals(ast):
+    '''Remove global variable declarations that are never referenced.'''
+    used = set()
+    stack = [ast]
+    while stack:
+        node = stack.pop()
+        used.update(used_names(node.body))
+        stack.extend(d for d in node.decls if isinstance(d, syntaxtree.ProcDecl))
+    ast.decls = [d for d in ast.decls if isinstance(d, syntaxtree.ProcDecl) or
+                 not d.is_global or d.name in used]
+    
+# -- Pass manager --
+#
+# Passes and analyses are registered by name, so that pipelines of passes can be
+# given as strings like 'sccp,propagate,dce'. Each pass is a function that takes
+# the PassManager and a procedure, and returns whether it changed the
+# procedure. Each analysis is a function that takes the PassManager and a
+# procedure (or None for analyses of the whole program) and returns its result,
+# which the manager caches until a pass that doesn't preserve it changes the
+# procedure.
+
+Pass = collections.namedtuple('Pass', ['run', 'requires', 'preserves', 'final'])
+Analysis = collections.namedtuple('Analysis', ['build', 'invalidate', 'per_procedure',
+                                               'transforms_tree'])
+
+PASSES = {}
+ANALYSES = {}
+
+def register_pass(name, run, requires=(), preserves=(), final=False):
+    '''Make a pass available to pipelines by name.
+    
+    The analyses in requires are built before the pass runs. When the pass
+    changes a procedure, the cached analyses that aren't in preserves are
+    invalidated. Final passes run once on each procedure after the other passes
+    in the pipeline reach a fixed point.'''
+    PASSES[name] = Pass(run, frozenset(requires), frozenset(preserves), final)
+    
+def register_analysis(name, build, invalidate=None, per_procedure=True,
+                      transforms_tree=False):
+    '''Make an analysis available to passes by name.
+    
+    When the analysis of a procedure is invalidated, invalidate is called with
+    the manager, the procedure, and the result. It returns the result to keep
+    in the cache, or None to drop it. Analyses that transform the tree, like SSA
+    form, are invalidated before any pass that doesn't require them, and after
+    the pipeline finishes with a procedure.'''
+    ANALYSES[name] = Analysis(build, invalidate, per_procedure, transforms_tree)
+    
+def update_call_graph(manager, procedure, graph):
+    manager.removed_callees.extend(graph.update(procedure))
+    return graph
+    
+def destroy_ssa(manager, procedure, form):
+    form.destroy()
+    # Destroying the form changes the statements in the graph, and the
+    # variables in them.
+    manager.discard('cfg', procedure)
+    manager.discard('liveness', procedure)
+    return None
+    
+def find_liveness(manager, procedure):
+    eliminator = DeadStoreEliminator(manager.get('callgraph'))
+    return eliminator.find_liveness(procedure, manager.program, manager.get('cfg', procedure))
+    
+register_analysis('callgraph', lambda manager, procedure: callgraph.CallGraph(manager.program),
+                  update_call_graph, per_procedure=False)
+register_analysis('cfg', lambda manager, procedure: controlflow.ControlFlowGraph(procedure))
+register_analysis('ssa', lambda manager, procedure: ssa.SSAForm(manager.get('cfg', procedure),
+                                                                 manager.program),
+                  destroy_ssa, transforms_tree=True)
+register_analysis('liveness', find_liveness)
+
+def walk_pass(make_pass):
+    '''Return a pass function that runs walk_procedure on the pass that make_pass(manager) returns.'''
+    def run(manager, procedure):
+        optimizer = make_pass(manager)
+        optimizer.walk_procedure(procedure, manager.program)
+        return optimizer.modified_tree
+    return run
+    
+def propagate_constants(manager, procedure):
+    propagator = ConstantPropagator(manager.print_errors, manager.get('callgraph'),
+                                    manager.array_budget)
+    propagator.walk_procedure(procedure, manager.program)
+    # Only report the first warning.
+    manager.print_errors = propagator.print_errors
+    return propagator.modified_tree
+    
+def eliminate_dead_stores(manager, procedure):
+    eliminator = DeadStoreEliminator(manager.get('callgraph'))
+    eliminator.walk_procedure(procedure, manager.program, manager.get('liveness', procedure))
+    return eliminator.modified_tree
+    
+def unroll_loops(manager, procedure):
+    if manager.unroll_factor <= 1:
+        return False
+    unroller = LoopUnroller(manager.unroll_factor, manager.unrolled, manager.profile)
+    unroller.walk_procedure(procedure, manager.program)
+    return unroller.modified_tree
+
+SSA_ANALYSES = ('ssa', 'cfg', 'callgraph')
+    
+register_pass('tre', walk_pass(lambda m: TailRecursionEliminator(m.get('callgraph'))),
+              requires=['callgraph'])
+register_pass('inline', walk_pass(lambda m: Inliner(m.get('callgraph'), m.inline_size,
+                                                        m.profile)),
+              requires=['callgraph'])
+register_pass('sccp', lambda m, p: ConditionalConstantPropagator(m.get('ssa', p)).propagate(),
+              requires=['ssa'], preserves=SSA_ANALYSES)
+register_pass('gvn', lambda m, p: ValueNumberer(m.get('ssa', p)).number(),
+              requires=['ssa'], preserves=SSA_ANALYSES)
+register_pass('licm', lambda m, p: LoopInvariantCodeMotion(m.get('ssa', p), m.program).hoist(),
+              requires=['ssa'], preserves=SSA_ANALYSES)
+register_pass('iv', lambda m, p: StrengthReducer(m.get('ssa', p)).reduce_loops(),
+              requires=['ssa'], preserves=SSA_ANALYSES)
+register_pass('ssa-dce', lambda m, p: eliminate_dead_definitions(m.get('ssa', p)),
+              requires=['ssa'], preserves=SSA_ANALYSES)
+register_pass('fold', walk_pass(lambda m: AlgebraicSimplifier([], m.rule_hits)),
+              preserves=['callgraph'])
+register_pass('propagate', propagate_constants, requires=['callgraph'], preserves=['callgraph'])
+register_pass('copy', walk_pass(lambda m: CopyPropagator(m.get('callgraph'))),
+              requires=['callgraph'])
+register_pass('sra', walk_pass(lambda m: ScalarReplacer(m.array_budget)), preserves=['callgraph'])
+register_pass('simplify', walk_pass(lambda m: AlgebraicSimplifier(SIMPLIFICATION_RULES,
+                                                                  m.rule_hits)),
+              preserves=['callgraph'])
+register_pass('dce', walk_pass(lambda m: DeadCodeEliminator()))
+register_pass('dse', eliminate_dead_stores, requires=['callgraph', 'liveness'])
+register_pass('fuse', walk_pass(lambda m: LoopFuser()))
+register_pass('unroll', unroll_loops)
+register_pass('reduce', walk_pass(lambda m: AlgebraicSimplifier(STRENGTH_REDUCTION_RULES,
+                                                                m.rule_hits)),
+              preserves=['callgraph'], final=True)
+register_pass('ifconv', walk_pass(lambda m: IfConverter()), final=True)
+
+# The passes run at -O2.
+DEFAULT_PIPELINE = ('tre,inline,sccp,gvn,licm,iv,ssa-dce,propagate,copy,sra,simplify,dce,'
+                    'dse,fuse,unroll,reduce,ifconv')
+
+def parse_pipeline(text):
+    '''Return a list of the pass names in a comma separated pipeline, or raise ValueError if one isn't registered.'''
+    names = [name.strip() for name in text.split(',') if name.strip()]
+    for name in names:
+        if name not in PASSES:
+            raise ValueError('Unknown pass %r' % name)
+    return names
+
+class PassManager(object):
+    '''Run a pipeline of passes on each procedure in a program until nothing changes.
+    
+    Callees are optimized before their callers. A procedure is only optimized
+    again if its own body changed, in which case it's optimized again before
+    anything else, or if a procedure it calls changed which parameters it
+    writes to. Procedures that can no longer be called are
+    removed. No procedure is optimized more than max_iterations times. Once
+    every procedure is done, the final passes are run, and unused globals are
+    removed.
+    
+    The options that passes use, like unroll_factor, are attributes of the
+    manager.
+    
+    If an OptimizationCache is given, the procedures whose keys are in it are
+    loaded from it before anything is optimized, and aren't optimized again.
+    The others are stored in it before the final passes run, or before they're
+    removed if inlining leaves them unreachable. Warnings about the procedures
+    loaded from the cache aren't printed again.'''
+    def __init__(self, program, pipeline, max_iterations=DEFAULT_ITERATION_BUDGET,
+                 print_errors=False, unroll_factor=DEFAULT_UNROLL_FACTOR,
+                 inline_size=DEFAULT_INLINE_SIZE, rule_hits=None,
+                 array_budget=DEFAULT_ARRAY_BUDGET, profile=None, cache=None):
+        self.program = program
+        self.pipeline = [name for name in pipeline if not PASSES[name].final]
+        self.final_pipeline = [name for name in pipeline if PASSES[name].final]
+        self.max_iterations = max_iterations
+        self.print_errors = print_errors
+        self.unroll_factor = unroll_factor
+        self.inline_size = inline_size
+        self.array_budget = array_budget
+        self.profile = profile
+        self.optimization_cache = cache
+        self.rule_hits = collections.Counter() if rule_hits is None else rule_hits
+        # The loops that the unroller has already handled, by id.
+        self.unrolled = {}
+        
+        # Analysis results by (name, procedure id), with None for the id of
+        # analyses of the whole program.
+        self.cache = {}
+        # The procedures that updates of the call graph found are no longer
+        # called by a procedure.
+        self.removed_callees = []
+        
+    def key(self, name, procedure):
+        return (name, id(procedure) if ANALYSES[name].per_procedure else None)
+        
+    def get(self, name, procedure=None):
+        '''Return the result of an analysis, building it if it isn't cached.'''
+        key = self.key(name, procedure)
+        if key not in self.cache:
+            self.cache[key] = ANALYSES[name].build(self, procedure)
+        return self.cache[key]
+    
+    def discard(self, name, procedure=None):
+        '''Drop an analysis from the cache without invalidating it.'''
+        self.cache.pop(self.key(name, procedure), None)
+        
+    def invalidate(self, procedure, names):
+        '''Invalidate the cached analyses of a procedure with the given names.'''
+        for name in names:
+            key = self.key(name, procedure)
+            if key not in self.cache:
+                continue
+            result = self.cache.pop(key)
+            invalidate = ANALYSES[name].invalidate
+            if invalidate is not None:
+                result = invalidate(self, procedure, result)
+                if result is not None:
+                    self.cache[key] = result
+        
+    def run_pass(self, name, procedure):
+        '''Run a pass on a procedure, and return whether it changed the procedure.'''
+        pass_ = PASSES[name]
+        self.invalidate(procedure, [n for n, analysis in ANALYSES.iteritems()
+                                    if analysis.transforms_tree and n not in pass_.requires])
+        for analysis in pass_.requires:
+            self.get(analysis, procedure)
+        changed = pass_.run(self, procedure)
+        if changed:
+            self.invalidate(procedure, [n for n in ANALYSES if n not in pass_.preserves])
+        return changed
+    
+    def run_pipeline(self, procedure, pipeline):
+        '''Run each pass in a pipeline on a procedure, and return whether any of them changed it.'''
+        changed = False
+        for name in pipeline:
+            if self.run_pass(name, procedure):
+                changed = True
+        self.invalidate(procedure, [n for n, analysis in ANALYSES.iteritems()
+                                    if analysis.transforms_tree])
+        return changed
+        
+    def cache_options(self):
+        '''Return a tuple of the options that affect how procedures are optimized.'''
+        profile = None
+        if self.profile is not None:
+            profile = sorted(self.profile.counts.iteritems())
+        return (tuple(self.pipeline), self.max_iterations, self.unroll_factor,
+                self.inline_size, self.array_budget, profile)
+    
+    def load_cached_procedures(self, graph):
+        '''Load the procedures that are in the cache, and return the keys of the others by id.
+        
+        Every key is found before any procedure is loaded, since loading one
+        changes the keys of its callers.'''
+        cache = self.optimization_cache
+        options = self.cache_options()
+        absolute_lines = self.profile is not None
+        keys = dict((id(p), cache.key(p, graph, options, absolute_lines))
+                    for p in graph.procedures if optcache.is_cacheable(p))
+        loaded = []
+        for procedure in list(graph.procedures):
+            key = keys.get(id(procedure))
+            if (key is not None and procedure in graph and
+                cache.load(key, procedure, absolute_lines)):
+                del keys[id(procedure)]
+                loaded.append(procedure)
+                self.invalidate(procedure, list(ANALYSES))
+                if self.removed_callees:
+                    self.removed_callees = []
+                    remove_unreachable_procedures(graph)
+        return keys, loaded
+    
+    def store_cached_procedures(self, procedures, keys):
+        '''Store procedures that were optimized in the cache, and remove their keys.'''
+        for procedure in procedures:
+            key = keys.pop(id(procedure), None)
+            if key is not None:
+                self.optimization_cache.store(key, procedure, self.profile is not None)
+        
+    def run(self):
+        graph = self.get('callgraph')
+        remove_unreachable_procedures(graph)
+        
+        keys, loaded = {}, []
+        if self.optimization_cache is not None:
+            keys, loaded = self.load_cached_procedures(graph)
+        
+        # Callees are optimized first, since their changes can affect their callers.
+        worklist = collections.deque(graph.postorder())
+        queued = set(id(p) for p in worklist)
+        runs = collections.defaultdict(int)
+        for procedure in loaded:
+            runs[id(procedure)] = self.max_iterations
+        
+        def remove_unreachable():
+            if keys:
+                reachable = set(id(p) for p in graph.reachable())
+                self.store_cached_procedures(
+                    [p for p in graph.procedures
+                     if id(p) not in reachable and runs[id(p)] > 0], keys)
+            remove_unreachable_procedures(graph)
+        
+        def enqueue(procedure, first=False):
+            if id(procedure) not in queued and runs[id(procedure)] < self.max_iterations:
+                queued.add(id(procedure))
+                if first:
+                    worklist.appendleft(procedure)
+                else:
+                    worklist.append(procedure)
+        
+        while worklist:
+            procedure = worklist.popleft()
+            queued.discard(id(procedure))
+            if procedure not in graph or runs[id(procedure)] >= self.max_iterations:
+                continue
+            runs[id(procedure)] += 1
+            
+            if isinstance(procedure, syntaxtree.ProcDecl):
+                written_params = graph.written_params(procedure)
+            if not self.run_pipeline(procedure, self.pipeline):
+                continue
+            
+            # A procedure is optimized until it stops changing before its
+            # callers are, since they might inline it. What's live in its
+            # callers depends on what it reads and writes.
+            enqueue(procedure, first=True)
+            for caller in graph.callers(procedure):
+                self.invalidate(caller, ['liveness'])
+            if (isinstance(procedure, syntaxtree.ProcDecl) and
+                graph.written_params(procedure) != written_params):
+                for caller in graph.callers(procedure):
+                    enqueue(caller)
+            if self.removed_callees:
+                self.removed_callees = []
+                remove_unreachable()
+                
+        if keys:
+            self.store_cached_procedures(graph.procedures, keys)
+        remove_unused_globals(self.program)
+        for procedure in graph.procedures:
+            self.run_pipeline(procedure, self.final_pipeline)
+        return self.program
+
+def optimize_procedures(ast, max_iterations=DEFAULT_ITERATION_BUDGET,
+                        print_errors=False, unroll_factor=DEFAULT_UNROLL_FACTOR,
+                        inline_size=DEFAULT_INLINE_SIZE, rule_hits=None, pipeline=None,
+                        array_budget=DEFAULT_ARRAY_BUDGET, profile=None, cache=None):
+    '''Optimize each procedure with a pipeline of passes until nothing changes.
+    
+    The pipeline is a list of pass names, which is DEFAULT_PIPELINE by
+    default. Tail recursion is turned into a loop first, and calls to
+    procedures whose bodies have at most inline_size nodes are inlined (see
+    Inliner), and an inline_size of 0 turns inlining off. The procedure is
+    then optimized with the sparse passes on its local variables in SSA form,
+    and then with the passes that walk the tree, which also handle globals,
+    out parameters, and arrays, propagate copies between variables (see
+    CopyPropagator), replace local arrays with at most array_budget elements
+    by scalars (see ScalarReplacer), simplify expressions with the rules in
+    SIMPLIFICATION_RULES, and remove unreachable code and dead stores.
+    Adjacent loops are then fused, and loops are unrolled, by at most
+    unroll_factor copies of the body if they can't be unrolled completely, and
+    an unroll_factor of 1 turns unrolling off. See PassManager for how often
+    each procedure is optimized.
+    
+    Once every procedure is done, the STRENGTH_REDUCTION_RULES are applied, and
+    small Ifs are replaced by Selects (see IfConverter). If a Counter is given
+    as rule_hits, the number of times each rule applied is added to it. If a
+    Profile is given, inlining and unrolling are guided by it. If an
+    OptimizationCache is given, procedures that were optimized with the same
+    options in an earlier build are loaded from it (see optcache).'''
+    if pipeline is None:
+        pipeline = parse_pipeline(DEFAULT_PIPELINE)
+    manager = PassManager(ast, pipeline, max_iterations, print_errors, unroll_factor,
+                          inline_size, rule_hits, array_budget, profile, cache)
+    return manager.run()
+
+def optimize_tree(ast, level=1, max_iterations=DEFAULT_ITERATION_BUDGET,
+                  unroll_factor=DEFAULT_UNROLL_FACTOR, inline_size=DEFAULT_INLINE_SIZE,
+                  rule_hits=None, pipeline=None, array_budget=DEFAULT_ARRAY_BUDGET,
+                  profile=None, cache=None):
+    '''Optimize a program at an optimization level, or with a list of pass names if one is given.'''
+    if pipeline is not None or level == 2:
+        return optimize_procedures(ast, max_iterations, print_errors=True,
+                                   unroll_factor=unroll_factor, inline_size=inline_size,
+                                   rule_hits=rule_hits, pipeline=pipeline,
+                                   array_budget=array_budget, profile=profile,
+                                   cache=cache)
+    if level == 0:
+        return ast
+    if level == 1:
+        return AlgebraicSimplifier(SIMPLIFICATION_RULES + STRENGTH_REDUCTION_RULES,
+                                   rule_hits).walk(ast)
+    
+if __name__ == '__main__':
+    import argparse
+    import scanner
+    import parser
+    import typechecker
+
+    argparser = argparse.ArgumentParser(description='Test the type optimization functionality.')
+    
+    argparser.add_argument('filename', help='the file to parse')
+    argparser.add_argument('-O', type=int, choices=[0, 1, 2], default=2,
+                           help='the level of optimization to apply to the program (default 2)')
+    argparser.add_argument('--max-iterations', type=int, default=DEFAULT_ITERATION_BUDGET,
+                           help='the maximum number of times to optimize each procedure (default %d)'
+                           % DEFAULT_ITERATION_BUDGET)
+    argparser.add_argument('--unroll-factor', type=int, default=DEFAULT_UNROLL_FACTOR,
+                           help='the maximum number of copies of a loop body made by partial '
+                           'unrolling, or 1 to turn unrolling off (default %d)'
+                           % DEFAULT_UNROLL_FACTOR)
+    argparser.add_argument('--inline-size', type=int, default=DEFAULT_INLINE_SIZE,
+                           help='the maximum size of the procedures inlined at every call '
+                           'site, or 0 to turn inlining off (default %d)' % DEFAULT_INLINE_SIZE)
+    argparser.add_argument('--array-budget', type=int, default=DEFAULT_ARRAY_BUDGET,
+                           help='the maximum length of the local arrays replaced by scalars, '
+                           'and the maximum number of array elements whose values are tracked '
+                           '(default %d)' % DEFAULT_ARRAY_BUDGET)
+    argparser.add_argument('--profile-use', metavar='PROFILE',
+                           help='guide inlining and unrolling by the counts that a program '
+                           'compiled with --profile-generate wrote to PROFILE')
+    argparser.add_argument('--cache-dir', metavar='DIR',
+                           help='store the optimized procedures in DIR, and reuse the ones '
+                           'that haven\'t changed since an earlier run')
+    argparser.add_argument('--rule-hits', action='store_true',
+                           help='print the number of times each simplification rule applied')
+    argparser.add_argument('--passes', type=parse_pipeline,
+                           help='a comma separated list of passes to run instead of a level '
+                           '(one of %s)' % ', '.join(sorted(PASSES)))
+    args = argparser.parse_args()
+    profile = None
+    if args.profile_use is not None:
+        try:
+            profile = profiling.read_profile(args.profile_use)
+        except profiling.ProfileError as err:
+            argparser.error(str(err))
+    cache = None
+    if args.cache_dir is not None:
+        cache = optcache.OptimizationCache(args.cache_dir)
     ast = parser.parse_tokens(scanner.tokenize_file(args.filename))
     if typechecker.tree_is_valid(ast):
-        optimize_tree(ast, args.O)
+        rule_hits = collections.Counter()
+        optimize_tree(ast, args.O, args.max_iterations, args.unroll_factor,
+                      args.inline_size, rule_hits, args.passes, args.array_budget, profile,
+                      cache)
         syntaxtree.dump_tree(ast)
+        if args.rule_hits:
+            print
+            for name, rule in SIMPLIFICATION_RULES + STRENGTH_REDUCTION_RULES:
+                print '%s: %d' % (name, rule_hits[name])
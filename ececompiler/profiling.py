@@ -0,0 +1,97 @@
+'''Read the execution counts that instrumented programs write.
+
+A program compiled with a profile file (see CodeGenerator) counts the number of
+times each procedure is entered, each If and For statement is reached, the body
+of each If and For runs, and each call is made. When the program exits, it
+appends the counts to the file, one per line, as the kind of counter, the line
+and column of the token of the statement it belongs to, and the count.
+
+Counters are found by the tokens of the statements, so the counts still apply
+when the program is compiled again, and copies of a statement made by the
+optimizer share its counters. The counts for every copy in the instrumented
+program, and for every run in the file, are added together.
+'''
+
+import collections
+
+# The kinds of counters. Procedures are found by the token of their name, and
+# calls by the token of the name of the procedure they call.
+PROCEDURE = 'proc'
+IF = 'if'
+THEN = 'then'
+LOOP = 'loop'
+ITERATION = 'iteration'
+CALL = 'call'
+
+COUNTER_KINDS = frozenset((PROCEDURE, IF, THEN, LOOP, ITERATION, CALL))
+
+# Counts that are at least this fraction of the largest count in a profile are
+# hot.
+HOT_FRACTION = 0.01
+
+class ProfileError(Exception): pass
+
+def location(token):
+    '''Return the (line, column) that a counter for a token is stored under.'''
+    return (token.lineno, token.start)
+
+class Profile(object):
+    '''The counts from one or more runs of an instrumented program.
+
+    Counts are None for statements that the instrumented program didn't have,
+    like code that the optimizer removed, so that they aren't mistaken for
+    code that never ran.'''
+    def __init__(self, counts=None):
+        # Maps (kind, line, column) tuples to counts.
+        self.counts = collections.Counter() if counts is None else counts
+        self.max_count = max(self.counts.itervalues()) if self.counts else 0
+
+    def count(self, kind, token):
+        '''Return the count of a kind of counter for the statement with a token, or None.'''
+        if token is None:
+            return None
+        return self.counts.get((kind,) + location(token))
+
+    def is_hot(self, count):
+        return count is not None and count > 0 and count >= self.max_count * HOT_FRACTION
+
+    def is_cold(self, count):
+        return count == 0
+
+    def call_count(self, call):
+        return self.count(CALL, call.func.token)
+
+    def branch_counts(self, node):
+        '''Return the number of times the body and the orelse of an If ran, or None.'''
+        total = self.count(IF, node.token)
+        taken = self.count(THEN, node.token)
+        if total is None or taken is None:
+            return None
+        return taken, total - taken
+
+    def iteration_count(self, node):
+        '''Return the number of times the body of a For ran, or None.'''
+        return self.count(ITERATION, node.token)
+
+def read_profile(filename):
+    '''Return a Profile of the counts in a file, or raise ProfileError if it can't be read.'''
+    counts = collections.Counter()
+    try:
+        with open(filename) as f:
+            for lineno, line in enumerate(f, 1):
+                fields = line.split()
+                if not fields:
+                    continue
+                try:
+                    kind, line_number, column, count = fields
+                    key = (kind, int(line_number), int(column))
+                    count = int(count)
+                except ValueError:
+                    kind = None
+                if kind not in COUNTER_KINDS:
+                    raise ProfileError('%s:%d: invalid profile entry %r' %
+                                       (filename, lineno, line.strip()))
+                counts[key] += count
+    except IOError as err:
+        raise ProfileError('Unable to read profile: %s' % err)
+    return Profile(counts)
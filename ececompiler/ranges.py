@@ -0,0 +1,348 @@
+'''Find the ranges of the values of int and bool expressions in a procedure.
+
+The generated code checks that the operands of every boolean operator are 0 or
+1 by calling validateBooleanOp in the runtime, and it can check that the index
+of every array access is in bounds. A check is redundant when the operands can
+only be literals, comparisons, or variables that are only ever assigned values
+like those, or when the index is always in range, and find_redundant_checks
+finds the operators and subscripts whose checks can be left out.
+
+Ranges are (low, high) tuples of signed 32-bit ints. The analysis runs forward
+over the procedure's ControlFlowGraph, and tracks the range of each scalar
+variable that is in a register at the start of every block. Variables that are
+never assigned, arrays, floats, and anything that a call might write to can hold
+any value. Where control flow joins, the ranges from each predecessor are
+combined. So that loops are only analyzed a few times, a range that grows at a
+loop header is widened to the next of 0, 1, or the limits of an int. Along the
+edges out of a branch, the ranges of the int variables compared by its test are
+narrowed to the values for which the test has that result, so the test of a
+loop bounds the index variable in its body.
+
+A boolean operator only produces a result if its check passes, so its operands
+are assumed to be 0 or 1 when finding the range of its result.
+'''
+
+import controlflow
+import syntaxtree
+import tokens
+
+INT_MIN = -2**31
+INT_MAX = 2**31 - 1
+
+FULL_RANGE = (INT_MIN, INT_MAX)
+BOOLEAN_RANGE = (0, 1)
+
+# The bounds that ranges are widened to at loop headers.
+WIDENING_BOUNDS = (INT_MIN, 0, 1, INT_MAX)
+
+COMPARISON_OPERATORS = frozenset((tokens.LT, tokens.LTE, tokens.GT, tokens.GTE,
+                                  tokens.EQUAL, tokens.NOTEQUAL))
+
+# The comparison that is true when a comparison is false, and the comparison
+# that is true when a comparison with its operands swapped is.
+NEGATED_COMPARISONS = {tokens.LT: tokens.GTE, tokens.LTE: tokens.GT,
+                       tokens.GT: tokens.LTE, tokens.GTE: tokens.LT,
+                       tokens.EQUAL: tokens.NOTEQUAL, tokens.NOTEQUAL: tokens.EQUAL}
+MIRRORED_COMPARISONS = {tokens.LT: tokens.GT, tokens.LTE: tokens.GTE,
+                        tokens.GT: tokens.LT, tokens.GTE: tokens.LTE,
+                        tokens.EQUAL: tokens.EQUAL, tokens.NOTEQUAL: tokens.NOTEQUAL}
+
+def make_range(low, high):
+    '''Return a range, or the full range if the bounds overflow an int.'''
+    if low < INT_MIN or high > INT_MAX:
+        return FULL_RANGE
+    return (low, high)
+
+def join(a, b):
+    '''Return the smallest range that contains two ranges.'''
+    return (min(a[0], b[0]), max(a[1], b[1]))
+
+def widen(old, new):
+    '''Return a range containing new, with any bound that grew past old moved out to a widening bound.'''
+    low, high = new
+    if low < old[0]:
+        low = max(b for b in WIDENING_BOUNDS if b <= low)
+    if high > old[1]:
+        high = min(b for b in WIDENING_BOUNDS if b >= high)
+    return (low, high)
+
+def is_boolean(value_range):
+    return BOOLEAN_RANGE[0] <= value_range[0] and value_range[1] <= BOOLEAN_RANGE[1]
+
+def bit_ceiling(value):
+    '''Return the smallest number of the form 2**n - 1 that is at least a non-negative value.'''
+    return (1 << value.bit_length()) - 1
+
+def binary_range(op, left, right):
+    '''Return the range of the result of an int operator on operands in two ranges.'''
+    if op == tokens.PLUS:
+        return make_range(left[0] + right[0], left[1] + right[1])
+    if op == tokens.MINUS:
+        return make_range(left[0] - right[1], left[1] - right[0])
+    if op == tokens.MULTIPLY:
+        products = [a * b for a in left for b in right]
+        return make_range(min(products), max(products))
+    if op == tokens.DIVIDE:
+        if left[0] >= 0 and right[0] > 0:
+            return (left[0] // right[1], left[1] // right[0])
+    elif op == tokens.AND:
+        if left[0] >= 0 and right[0] >= 0:
+            return (0, min(left[1], right[1]))
+        if left[0] >= 0:
+            return (0, left[1])
+        if right[0] >= 0:
+            return (0, right[1])
+    elif op == tokens.OR:
+        if left[0] >= 0 and right[0] >= 0:
+            return (max(left[0], right[0]), bit_ceiling(max(left[1], right[1])))
+    return FULL_RANGE
+
+def unary_range(op, operand):
+    '''Return the range of the result of an int operator on an operand in a range.'''
+    if op == tokens.MINUS:
+        return make_range(-operand[1], -operand[0])
+    if op == tokens.NOT:
+        # The bitwise complement of x is -x - 1, which never overflows.
+        return (-operand[1] - 1, -operand[0] - 1)
+    return FULL_RANGE
+
+def expression_range(node, ranges, redundant=None, lengths=None):
+    '''Return the range of an expression, given a dict of the ranges of variables.
+
+    Variables that aren't in the dict can have any value. If a set is given, the
+    ids of the boolean operators in the expression whose checks are redundant
+    are added to it, and if a dict of the lengths of arrays is given too, so
+    are the ids of the subscripts whose indexes are always in bounds.'''
+    if isinstance(node, syntaxtree.Num):
+        if node.n == tokens.TRUE:
+            return (1, 1)
+        if node.n == tokens.FALSE:
+            return (0, 0)
+        if '.' in node.n:
+            return FULL_RANGE
+        value = int(node.n)
+        return make_range(value, value)
+    if isinstance(node, syntaxtree.Name):
+        return ranges.get(node, FULL_RANGE)
+    if isinstance(node, syntaxtree.Subscript):
+        index = expression_range(node.index, ranges, redundant, lengths)
+        if (redundant is not None and lengths is not None and node.name in lengths and
+            0 <= index[0] and index[1] < lengths[node.name]):
+            redundant.add(id(node))
+        return FULL_RANGE
+    if isinstance(node, syntaxtree.BinaryOp):
+        left = expression_range(node.left, ranges, redundant, lengths)
+        right = expression_range(node.right, ranges, redundant, lengths)
+        if node.node_type == tokens.FLOAT:
+            # Float results are stored by their bit pattern.
+            return FULL_RANGE
+        if node.node_type == tokens.BOOL:
+            if is_boolean(left) and is_boolean(right):
+                if redundant is not None:
+                    redundant.add(id(node))
+            else:
+                # The check aborts the program unless both operands are 0 or 1.
+                left = (max(left[0], 0), min(left[1], 1))
+                right = (max(right[0], 0), min(right[1], 1))
+                if left[0] > left[1] or right[0] > right[1]:
+                    return BOOLEAN_RANGE
+        if node.op in COMPARISON_OPERATORS:
+            return BOOLEAN_RANGE
+        return binary_range(node.op, left, right)
+    if isinstance(node, syntaxtree.UnaryOp):
+        operand = expression_range(node.operand, ranges, redundant, lengths)
+        if node.node_type == tokens.FLOAT:
+            return FULL_RANGE
+        if node.op == tokens.NOT and node.node_type == tokens.BOOL:
+            if redundant is not None and is_boolean(operand):
+                redundant.add(id(node))
+            return BOOLEAN_RANGE
+        return unary_range(node.op, operand)
+    if isinstance(node, syntaxtree.Select):
+        # Both values are evaluated, whatever the result of the test is.
+        expression_range(node.test, ranges, redundant, lengths)
+        if_true = expression_range(node.if_true, ranges, redundant, lengths)
+        if_false = expression_range(node.if_false, ranges, redundant, lengths)
+        if node.node_type == tokens.FLOAT:
+            return FULL_RANGE
+        return join(if_true, if_false)
+    return FULL_RANGE
+
+def narrow(name, op, bound, ranges):
+    '''Narrow the range of a variable in a dict to the values for which a comparison with a range is true.
+
+    Returns False if there aren't any.'''
+    low, high = ranges.get(name, FULL_RANGE)
+    if op == tokens.LT:
+        high = min(high, bound[1] - 1)
+    elif op == tokens.LTE:
+        high = min(high, bound[1])
+    elif op == tokens.GT:
+        low = max(low, bound[0] + 1)
+    elif op == tokens.GTE:
+        low = max(low, bound[0])
+    elif op == tokens.EQUAL:
+        low, high = max(low, bound[0]), min(high, bound[1])
+    if low > high:
+        return False
+    if (low, high) != FULL_RANGE:
+        ranges[name] = (low, high)
+    return True
+
+def refine(test, ranges, taken):
+    '''Narrow the ranges in a dict given whether a branch test was nonzero.
+
+    Returns False if the test can't have that result. Comparisons are 1 when
+    they're true and 0 when they're false.'''
+    if isinstance(test, syntaxtree.UnaryOp):
+        # The not of an int is its bitwise complement.
+        if test.op == tokens.NOT and test.node_type == tokens.BOOL:
+            return refine(test.operand, ranges, not taken)
+        return True
+    if not isinstance(test, syntaxtree.BinaryOp):
+        return True
+    if test.op == (tokens.AND if taken else tokens.OR):
+        # x & y is only nonzero if both operands are, and x | y is only zero if
+        # both operands are.
+        return refine(test.left, ranges, taken) and refine(test.right, ranges, taken)
+    if test.op not in COMPARISON_OPERATORS:
+        return True
+    op = test.op if taken else NEGATED_COMPARISONS[test.op]
+    for name, other, op in ((test.left, test.right, op),
+                            (test.right, test.left, MIRRORED_COMPARISONS[op])):
+        if isinstance(name, syntaxtree.Name) and name.node_type == tokens.INT:
+            if not narrow(name, op, expression_range(other, ranges), ranges):
+                return False
+    return True
+
+def array_lengths(procedure, program):
+    '''Return a dict of the lengths of the arrays that a procedure or program can use, by name.'''
+    lengths = {}
+    decls = [d for d in program.decls if isinstance(d, syntaxtree.VarDecl) and d.is_global]
+    decls.extend(d for d in procedure.decls if isinstance(d, syntaxtree.VarDecl) and not d.is_global)
+    if isinstance(procedure, syntaxtree.ProcDecl):
+        decls.extend(param.var_decl for param in procedure.params)
+    for decl in decls:
+        # Local declarations shadow global ones.
+        if decl.array_length is not None:
+            lengths[decl.name] = int(decl.array_length.n)
+        else:
+            lengths.pop(decl.name, None)
+    return lengths
+
+class RangeAnalysis(object):
+    '''Find the ranges of the variables at the start of each block of a procedure.
+
+    The call graph is used to find which variables each call might write to.'''
+    def __init__(self, procedure, call_graph):
+        self.procedure = procedure
+        self.call_graph = call_graph
+        self.graph = controlflow.ControlFlowGraph(procedure)
+        self.headers = set(loop.header for loop in self.graph.loops())
+        self.lengths = array_lengths(procedure, call_graph.program)
+
+        # Local variables and in parameters keep their values across calls,
+        # unless they're passed as out arguments.
+        self.locals = set(d.name for d in procedure.decls
+                          if isinstance(d, syntaxtree.VarDecl) and not d.is_global)
+        self.out_params = set()
+        if isinstance(procedure, syntaxtree.ProcDecl):
+            for param in procedure.params:
+                if param.direction == tokens.IN:
+                    self.locals.add(param.var_decl.name)
+                else:
+                    self.out_params.add(param.var_decl.name)
+
+        # Dicts of the ranges of the variables that are known at the start of
+        # each block that can be reached. Variables that aren't in a dict can
+        # have any value.
+        self.block_ranges = {self.graph.entry: {}}
+
+    def visit_statement(self, statement, ranges, redundant=None):
+        '''Update a dict of ranges with the effects of an Assign or Call.'''
+        if isinstance(statement, syntaxtree.Assign):
+            value = expression_range(statement.value, ranges, redundant, self.lengths)
+            target = statement.target
+            if isinstance(target, syntaxtree.Subscript):
+                expression_range(target, ranges, redundant, self.lengths)
+            elif target.node_type == tokens.FLOAT or value == FULL_RANGE:
+                ranges.pop(target, None)
+            else:
+                ranges[target] = value
+        elif isinstance(statement, syntaxtree.Call):
+            decl = self.call_graph.resolve(self.procedure, statement.func)
+            written = []
+            for i, (arg, param) in enumerate(zip(statement.args, decl.params)):
+                if param.direction == tokens.IN:
+                    if param.var_decl.array_length is None:
+                        expression_range(arg, ranges, redundant, self.lengths)
+                elif self.call_graph.may_write_param(decl, i):
+                    written.append(arg)
+            # Out parameters can be aliases of globals, so writing to one
+            # might change any global.
+            writes_alias = any(arg in self.out_params for arg in written)
+            for name in list(ranges):
+                if name in written or (name not in self.locals and
+                                       (writes_alias or
+                                        self.call_graph.may_write_global(decl, name))):
+                    del ranges[name]
+
+    def visit_block(self, block, redundant=None):
+        '''Return the ranges of the variables at the end of a block.'''
+        ranges = dict(self.block_ranges[block])
+        for statement in block.statements:
+            self.visit_statement(statement, ranges, redundant)
+        if block.test is not None:
+            expression_range(block.test, ranges, redundant, self.lengths)
+        return ranges
+
+    def merge(self, block, ranges):
+        '''Combine the ranges from a predecessor with the ones at the start of a block.
+
+        Returns whether the ranges at the start of the block changed.'''
+        old = self.block_ranges.get(block)
+        if old is None:
+            self.block_ranges[block] = ranges
+            return True
+        new = {}
+        for name, value in old.iteritems():
+            if name in ranges:
+                value = join(value, ranges[name])
+                if block in self.headers:
+                    value = widen(old[name], value)
+                if value != FULL_RANGE:
+                    new[name] = value
+        if new == old:
+            return False
+        self.block_ranges[block] = new
+        return True
+
+    def analyze(self):
+        order = self.graph.reverse_postorder()
+        position = dict((block, i) for i, block in enumerate(order))
+        pending = set([self.graph.entry])
+        while pending:
+            block = min(pending, key=position.get)
+            pending.remove(block)
+            ranges = self.visit_block(block)
+            for i, successor in enumerate(block.successors):
+                successor_ranges = dict(ranges)
+                if block.test is not None and not refine(block.test, successor_ranges, i == 0):
+                    # The edge can't be taken.
+                    continue
+                if self.merge(successor, successor_ranges):
+                    pending.add(successor)
+
+    def redundant_checks(self):
+        '''Return a set of the ids of the boolean operators and subscripts whose checks are redundant.'''
+        self.analyze()
+        redundant = set()
+        for block, ranges in self.block_ranges.iteritems():
+            self.visit_block(block, redundant)
+        return redundant
+
+def find_redundant_checks(procedure, call_graph):
+    '''Return a set of the ids of the boolean operators in a procedure whose operands are always 0 or 1, and of the subscripts whose indexes are always in bounds.
+
+    The procedure has to be in the call graph.'''
+    return RangeAnalysis(procedure, call_graph).redundant_checks()
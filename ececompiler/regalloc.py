@@ -0,0 +1,326 @@
+'''Allocate the registers of the code generated for a procedure with a linear scan.
+
+The code generator writes the C code of a procedure with as many virtual
+registers as it needs, which are written $1, $2, and so on, and the allocator
+maps them to at most register_count physical registers. Those are local
+variables of main, R1 and up (R0 holds return addresses), so that the C
+compiler can keep them in machine registers, which it can't do for an array.
+
+The control flow of the code is read from its lines: labels, gotos, and
+conditional gotos. A goto to a label that isn't in the procedure, or to its
+first line, is a call or a tail call, and continues at the next line, which is
+the label that the call returns to. Jumps through R0 and return statements
+leave the procedure, and nothing is live in a register across procedures.
+Which virtual registers are live at each line is found by the usual backward
+dataflow analysis, and assignments to virtual registers that are never read,
+like the loads of variables that are assigned before they're used, are
+removed. The live interval of a virtual register runs from the first line
+where it's assigned or live to the last one.
+
+Intervals are allocated registers in the order of their starts, and a
+register is free again once the interval using it has ended. The spill cost
+of an interval is the number of lines that use it, with each line inside of a
+loop counting LOOP_WEIGHT times as much as it would outside of it. When there
+isn't a free register, the interval with the lowest spill cost per line of its
+length is spilled, and if that's not the one being allocated, the one being
+allocated takes its register. Spilled virtual registers are kept in memory for
+their whole interval, and with a register_count of 0, all of them are.
+
+A call overwrites the registers below the number that the callee clobbers (see
+CodeGenerator.record_clobbered_registers), or all of them if that's unknown. An
+interval that's live across calls gets the free register with the lowest cost
+of storing it before those calls and loading it after them, which is nothing
+for registers that the callees don't use, and is spilled instead if that's
+cheaper. Values that are live across a call are stored in slots in the
+procedure's stack frame, so that the callee can't overwrite them; the others
+share the slots of the global array S, like registers.
+'''
+
+import re
+
+# The number of physical registers that virtual registers are allocated to.
+REGISTER_COUNT = 12
+
+# How many times more a line inside of a loop counts in spill costs than the
+# same line outside of it.
+LOOP_WEIGHT = 10
+
+VIRTUAL_REGISTER = re.compile(r'\$(\d+)')
+LABEL = re.compile(r'^(\w+):$')
+GOTO = re.compile(r'^goto (\w+);$')
+CONDITIONAL_GOTO = re.compile(r'^if \(.*\) goto (\w+);$')
+ASSIGNMENT = re.compile(r'^\$(\d+) = ')
+COPY = re.compile(r'^memcpy\(&\$(\d+), ')
+EXITS = ('goto *', 'return ')
+SELF_ASSIGNMENT = re.compile(r'^(\S+) = \1;$')
+
+def split_comment(line):
+    '''Return the code and the comment of a line, which might contain source code with $ in it.'''
+    position = line.find('/*')
+    if position < 0:
+        return line, ''
+    return line[:position], line[position:]
+
+def iter_bits(mask):
+    '''Yield the indexes of the bits that are set in an int.'''
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def mask_of(registers):
+    mask = 0
+    for register in registers:
+        mask |= 1 << register
+    return mask
+
+class Interval(object):
+    '''The lines where a virtual register is live, and where it's kept.'''
+    def __init__(self, register, start):
+        self.register = register
+        self.start = start
+        self.end = start
+        # Whether the virtual register is assigned on its first line, instead
+        # of being live there already.
+        self.assigned_at_start = False
+        self.cost = 0
+        # The (clobbered registers, weight) of each call that the interval is
+        # live across.
+        self.calls = []
+        self.location = None
+        self.slot = None
+
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+    def save_cost(self, location):
+        '''Return the cost of storing and reloading a physical register around the calls that the interval is live across.'''
+        return sum(2 * weight for clobbered, weight in self.calls
+                   if clobbered is None or location < clobbered)
+
+    def ends_before(self, other):
+        '''Return whether the interval's register can be reused for another interval.
+
+        An interval that ends on the line that assigns to the other one can
+        share its register, since C reads the operands of an assignment first.'''
+        return self.end < other.start or (self.end == other.start and other.assigned_at_start)
+
+class RegisterAllocator(object):
+    '''Allocate physical registers and spill slots to the virtual registers in the lines of a procedure.
+
+    depths are the loop depths of the lines, and calls maps the labels that
+    calls return to to the number of registers that the callee clobbers, or
+    None if that's unknown.'''
+    def __init__(self, lines, depths, calls, register_count=REGISTER_COUNT):
+        self.lines = lines
+        self.depths = depths
+        self.calls = calls
+        self.register_count = register_count
+
+        self.successors = []
+        self.uses = []
+        self.definitions = []
+        self.live_in = []
+        self.removed = set()
+        self.intervals = {}
+
+        # The number of physical registers used, including R0, and the number
+        # of slots in the stack frame and in S.
+        self.used_registers = 1
+        self.frame_slots = 0
+        self.shared_slots = 0
+
+        # The (physical register, frame slot) pairs stored before and loaded
+        # after the call that returns to each line.
+        self.saves = {}
+
+    def allocate(self):
+        self.read_lines()
+        self.find_liveness()
+        self.find_intervals()
+        self.scan()
+        self.assign_slots()
+        self.find_saves()
+
+    def read_lines(self):
+        '''Find the successors of each line, and the virtual registers it uses and assigns.'''
+        labels = {}
+        for i, line in enumerate(self.lines):
+            match = LABEL.match(line.strip())
+            if match and i > 0:
+                labels[match.group(1)] = i
+
+        for i, line in enumerate(self.lines):
+            code = split_comment(line)[0].strip()
+            definitions = []
+            match = ASSIGNMENT.match(code) or COPY.match(code)
+            if match:
+                definitions.append(int(match.group(1)))
+                read = code[match.end():]
+            else:
+                read = code
+            self.uses.append(mask_of(int(r) for r in VIRTUAL_REGISTER.findall(read)))
+            self.definitions.append(mask_of(definitions))
+
+            next_line = [i + 1] if i + 1 < len(self.lines) else []
+            goto = GOTO.match(code)
+            conditional = CONDITIONAL_GOTO.match(code)
+            if code.startswith(EXITS):
+                self.successors.append([])
+            elif goto and goto.group(1) in labels:
+                self.successors.append([labels[goto.group(1)]])
+            elif conditional:
+                self.successors.append(next_line + [labels[conditional.group(1)]])
+            else:
+                # Calls return to the next line.
+                self.successors.append(next_line)
+
+    def find_liveness(self):
+        '''Find the virtual registers that are live at the start of each line, and remove the dead assignments.'''
+        self.live_in = [0] * len(self.lines)
+        changed = True
+        while changed:
+            changed = False
+            for i in reversed(xrange(len(self.lines))):
+                live_out = 0
+                for successor in self.successors[i]:
+                    live_out |= self.live_in[successor]
+                live_in = self.uses[i] | (live_out & ~self.definitions[i])
+                if live_in != self.live_in[i]:
+                    self.live_in[i] = live_in
+                    changed = True
+
+        for i, line in enumerate(self.lines):
+            if ASSIGNMENT.match(line.strip()):
+                live_out = 0
+                for successor in self.successors[i]:
+                    live_out |= self.live_in[successor]
+                if not self.definitions[i] & live_out:
+                    self.removed.add(i)
+
+    def find_intervals(self):
+        for i in xrange(len(self.lines)):
+            if i in self.removed:
+                continue
+            weight = LOOP_WEIGHT ** self.depths[i]
+            for register in iter_bits(self.live_in[i] | self.definitions[i]):
+                interval = self.intervals.get(register)
+                if interval is None:
+                    interval = self.intervals[register] = Interval(register, i)
+                    interval.assigned_at_start = not self.live_in[i] & (1 << register)
+                interval.end = i
+            for register in iter_bits(self.uses[i] | self.definitions[i]):
+                self.intervals[register].cost += weight
+
+        labels = dict((LABEL.match(line.strip()).group(1), i)
+                      for i, line in enumerate(self.lines) if LABEL.match(line.strip()))
+        for label, clobbered in self.calls.iteritems():
+            i = labels[label]
+            for register in iter_bits(self.live_in[i]):
+                self.intervals[register].calls.append((clobbered,
+                                                       LOOP_WEIGHT ** self.depths[i]))
+
+    def scan(self):
+        '''Allocate physical registers to the intervals, or spill them.'''
+        active = []
+        free = set(xrange(1, self.register_count + 1))
+        for interval in sorted(self.intervals.itervalues(), key=lambda i: (i.start, i.end)):
+            for other in [a for a in active if a.ends_before(interval)]:
+                active.remove(other)
+                free.add(other.location)
+
+            if free:
+                location = min(free, key=lambda r: (interval.save_cost(r), r))
+                if interval.save_cost(location) > interval.cost:
+                    continue
+                interval.location = location
+                free.remove(location)
+                active.append(interval)
+                continue
+
+            if not active:
+                # There aren't any registers to allocate.
+                continue
+            victim = min(active, key=lambda a: (float(a.cost) / a.length, -a.end))
+            if float(victim.cost) / victim.length >= float(interval.cost) / interval.length:
+                continue
+            interval.location = victim.location
+            victim.location = None
+            active.remove(victim)
+            active.append(interval)
+
+        for interval in self.intervals.itervalues():
+            if interval.location is not None:
+                self.used_registers = max(self.used_registers, interval.location + 1)
+
+    def assign_slots(self):
+        '''Give each spilled interval a slot, and each interval that might be overwritten by a call a slot in the frame to save it in.
+
+        Intervals that don't overlap can share a slot.'''
+        active = {True: [], False: []}
+        free = {True: [], False: []}
+        counts = {True: 0, False: 0}
+        for interval in sorted(self.intervals.itervalues(), key=lambda i: (i.start, i.end)):
+            if interval.location is None:
+                in_frame = bool(interval.calls)
+            elif interval.save_cost(interval.location):
+                in_frame = True
+            else:
+                continue
+            for other in [a for a in active[in_frame] if a.ends_before(interval)]:
+                active[in_frame].remove(other)
+                free[in_frame].append(other.slot)
+            if free[in_frame]:
+                free[in_frame].sort()
+                interval.slot = free[in_frame].pop(0)
+            else:
+                interval.slot = counts[in_frame]
+                counts[in_frame] += 1
+            active[in_frame].append(interval)
+        self.frame_slots = counts[True]
+        self.shared_slots = counts[False]
+
+    def find_saves(self):
+        for i, line in enumerate(self.lines):
+            match = LABEL.match(line.strip())
+            if not match or match.group(1) not in self.calls:
+                continue
+            clobbered = self.calls[match.group(1)]
+            self.saves[i] = [(self.intervals[r].location, self.intervals[r].slot)
+                             for r in iter_bits(self.live_in[i])
+                             if self.intervals[r].location is not None and
+                             (clobbered is None or self.intervals[r].location < clobbered)]
+
+    def location(self, register, frame_offset):
+        '''Return the C expression for where a virtual register is kept.'''
+        interval = self.intervals[register]
+        if interval.location is not None:
+            return 'R%d' % interval.location
+        if interval.calls:
+            return 'MM[FP + %d]' % (frame_offset + interval.slot)
+        return 'S[%d]' % interval.slot
+
+    def render(self, frame_offset):
+        '''Return the lines with their virtual registers replaced by where they're kept.
+
+        The slots in the stack frame start at FP + frame_offset.'''
+        def replace(match):
+            return self.location(int(match.group(1)), frame_offset)
+
+        result = []
+        for i, line in enumerate(self.lines):
+            if i in self.removed:
+                continue
+            # The line before the label that a call returns to jumps to the
+            # callee.
+            for location, slot in self.saves.get(i + 1, []):
+                result.append('    MM[FP + %d] = R%d;' % (frame_offset + slot, location))
+            code, comment = split_comment(line)
+            code = VIRTUAL_REGISTER.sub(replace, code)
+            if SELF_ASSIGNMENT.match(code.strip()):
+                continue
+            result.append(code + comment)
+            for location, slot in self.saves.get(i, []):
+                result.append('    R%d = MM[FP + %d];' % (location, frame_offset + slot))
+        return result
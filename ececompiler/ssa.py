@@ -0,0 +1,557 @@
+'''Convert procedures to and from static single assignment form.
+
+An SSAForm is built from the ControlFlowGraph of a single procedure. Only the
+procedure's scalar local variables and in parameters are put in SSA form. Out
+parameters and arrays are passed by reference and globals can be changed by any
+call, so they are treated as memory and left alone, along with any variable
+that is passed as an out argument.
+
+Each assignment to a variable defines a new version of it, which is a Name like
+'x.2' that is only assigned once. The version that holds the value of a variable
+on entry to the procedure is the variable's own Name. Where different versions
+reach a block from its predecessors, a Phi at the start of the block picks one
+of them. Phis are only placed where the variable is live, so a phi is never
+needed just to merge values that are never read.
+
+The statements in the graph's blocks are renamed in place, so the AST is in SSA
+form until destroy is called. That renames the versions back to the original
+variables wherever their lifetimes don't overlap, and inserts copies on the
+incoming edges of each block with phis. The graph is out of date afterwards.
+
+Optimizations can follow the definitions and uses recorded in the SSAForm
+instead of walking the whole procedure.
+'''
+
+import collections
+import itertools
+
+import syntaxtree
+import tokens
+
+class Phi(object):
+    '''A phi function at the start of a block.
+
+    The args are the versions of the variable that reach the block from each of
+    its predecessors, in the same order as the block's predecessors.'''
+    def __init__(self, variable, args):
+        self.variable = variable
+        self.target = None
+        self.args = args
+
+    def __repr__(self):
+        return 'Phi(%s := %s)' % (self.target and self.target.id,
+                                  ', '.join(a.id for a in self.args if a is not None))
+
+def procedure_scope(procedure, program):
+    '''Return a dict mapping the names of the procedures that can be called from a procedure to their declarations.'''
+    scope = dict((d.name, d) for d in program.decls
+                 if isinstance(d, syntaxtree.ProcDecl) and d.is_global)
+    if isinstance(procedure, syntaxtree.ProcDecl):
+        scope[procedure.name] = procedure
+    scope.update((d.name, d) for d in procedure.decls if isinstance(d, syntaxtree.ProcDecl))
+    return scope
+
+def find_variables(procedure, program):
+    '''Return a dict mapping the variables of a procedure that can be put in SSA form to their declarations.'''
+    variables = {}
+    for decl in procedure.decls:
+        if (isinstance(decl, syntaxtree.VarDecl) and not decl.is_global and
+            decl.array_length is None):
+            variables[decl.name] = decl
+    if isinstance(procedure, syntaxtree.ProcDecl):
+        for param in procedure.params:
+            if param.direction == tokens.IN and param.var_decl.array_length is None:
+                variables[param.var_decl.name] = param.var_decl
+
+    scope = procedure_scope(procedure, program)
+    for statement in syntaxtree.iter_statements(procedure.body):
+        if isinstance(statement, syntaxtree.Call):
+            decl = scope[statement.func]
+            for param, arg in itertools.izip(decl.params, statement.args):
+                if param.direction == tokens.OUT and isinstance(arg, syntaxtree.Name):
+                    variables.pop(arg, None)
+    return variables
+
+def iter_containers(statements):
+    '''Yield every list of statements in a procedure body, including the bodies of branches and loops.'''
+    yield statements
+    for statement in statements:
+        if isinstance(statement, syntaxtree.If):
+            for container in iter_containers(statement.body):
+                yield container
+            for container in iter_containers(statement.orelse):
+                yield container
+        elif isinstance(statement, syntaxtree.For):
+            for container in iter_containers(statement.body):
+                yield container
+
+def renamed(node, name):
+    '''Return a copy of a Name node with a different id.'''
+    new_node = syntaxtree.Name(name.id, token=node.token)
+    new_node.node_type = node.node_type
+    return new_node
+
+def sequentialize(copies, new_temporary):
+    '''Order a list of (target, source) copies that happen in parallel so they can be done one at a time.
+
+    The targets must all be different. Cycles of copies are broken by saving
+    one of the values in a temporary returned by new_temporary(target).'''
+    pending = [(target, source) for target, source in copies if target != source]
+    result = []
+    while pending:
+        sources = set(source for target, source in pending)
+        for i, (target, source) in enumerate(pending):
+            if target not in sources:
+                result.append((target, source))
+                del pending[i]
+                break
+        else:
+            # Every remaining target is still needed as a source, so they form
+            # cycles.
+            target = pending[0][0]
+            temporary = new_temporary(target)
+            result.append((temporary, target))
+            pending = [(t, temporary if s == target else s) for t, s in pending]
+    return result
+
+class SSAForm(object):
+    def __init__(self, graph, program):
+        self.graph = graph
+        self.procedure = graph.procedure
+        self.variables = find_variables(self.procedure, program)
+
+        # In parameters stay in their stack slots, so their entry versions are
+        # never merged with other versions.
+        self.parameters = set()
+        if isinstance(self.procedure, syntaxtree.ProcDecl):
+            self.parameters.update(p.var_decl.name for p in self.procedure.params
+                                   if p.var_decl.name in self.variables)
+
+        self.phis = dict((block, []) for block in graph.blocks)
+        self.phi_blocks = {}
+
+        # Every version in the order that it was created, with the entry
+        # versions first. Each version maps to its variable, to the Assign or
+        # Phi that defines it (or None for entry versions), and to a list of
+        # the statements, phis, and blocks (for their tests) that read it.
+        self.versions = []
+        self.origins = {}
+        self.definitions = {}
+        self.uses = {}
+        self.counters = collections.defaultdict(int)
+
+        # The block and list of statements that each statement is in, by id.
+        # For assignments aren't in a list, so they can't be removed.
+        self.statement_blocks = {}
+        self.containers = {}
+        for container in iter_containers(self.procedure.body):
+            for statement in container:
+                self.containers[id(statement)] = container
+        for block in graph.blocks:
+            for statement in block.statements:
+                self.statement_blocks[id(statement)] = block
+
+        for variable in sorted(self.variables, key=lambda n: n.id):
+            self.add_version(variable, variable, None)
+        self.place_phis()
+        self.rename()
+
+    def add_version(self, version, variable, definition):
+        self.versions.append(version)
+        self.origins[version] = variable
+        self.definitions[version] = definition
+        self.uses[version] = []
+
+    def new_version(self, variable, definition):
+        # Variables that were named after versions by destroy can have the
+        # same name as a version of another variable.
+        version = None
+        while version is None or version in self.definitions:
+            self.counters[variable] += 1
+            version = syntaxtree.Name('%s.%d' % (variable.id, self.counters[variable]))
+        self.add_version(version, variable, definition)
+        return version
+
+    def iter_reads(self, site):
+        '''Yield the Names read by a statement, phi, or the test of a block.'''
+        if isinstance(site, Phi):
+            for arg in site.args:
+                yield arg
+        elif isinstance(site, syntaxtree.Assign):
+            if isinstance(site.target, syntaxtree.Subscript):
+                for name in syntaxtree.iter_names(site.target.index):
+                    yield name
+            for name in syntaxtree.iter_names(site.value):
+                yield name
+        elif isinstance(site, syntaxtree.Call):
+            # Out arguments are never in SSA form, so they can be treated as
+            # reads too.
+            for arg in site.args:
+                for name in syntaxtree.iter_names(arg):
+                    yield name
+        elif site.test is not None:
+            for name in syntaxtree.iter_names(site.test):
+                yield name
+
+    def read_versions(self, site):
+        '''Return a set of the versions read by a statement, phi, or the test of a block.'''
+        return set(name for name in self.iter_reads(site) if name in self.definitions)
+
+    def assigned_name(self, statement):
+        '''Return the Name that a statement assigns to, or None if it doesn't assign to a Name.'''
+        if (isinstance(statement, syntaxtree.Assign) and
+            isinstance(statement.target, syntaxtree.Name)):
+            return statement.target
+        return None
+
+    def rewrite(self, site, function):
+        '''Replace every expression read by a statement or the test of a block with function(expression).'''
+        if isinstance(site, syntaxtree.Assign):
+            if isinstance(site.target, syntaxtree.Subscript):
+                site.target.index = function(site.target.index)
+            site.value = function(site.value)
+        elif isinstance(site, syntaxtree.Call):
+            site.args[:] = [function(arg) for arg in site.args]
+        else:
+            site.test = site.branch.test = function(site.test)
+
+    def liveness(self, tracked):
+        '''Return dicts mapping each block to the sets of tracked names that are live on entry and exit.
+
+        Phi targets are defined at the start of their block, and each phi arg is
+        only live out of the predecessor it comes from.'''
+        upward = {}
+        defined = {}
+        for block in self.graph.blocks:
+            used = set()
+            assigned = set(phi.target for phi in self.phis[block])
+            for statement in block.statements:
+                used.update(n for n in self.iter_reads(statement)
+                            if n in tracked and n not in assigned)
+                target = self.assigned_name(statement)
+                if target in tracked:
+                    assigned.add(target)
+            used.update(n for n in self.iter_reads(block) if n in tracked and n not in assigned)
+            upward[block] = used
+            defined[block] = assigned
+
+        live_in = dict((block, set()) for block in self.graph.blocks)
+        live_out = dict((block, set()) for block in self.graph.blocks)
+        order = self.graph.postorder()
+        changed = True
+        while changed:
+            changed = False
+            for block in order:
+                out = set()
+                for successor in block.successors:
+                    out.update(live_in[successor])
+                    for i, predecessor in enumerate(successor.predecessors):
+                        if predecessor is block:
+                            out.update(phi.args[i] for phi in self.phis[successor])
+                live_out[block] = out
+                new_in = upward[block] | (out - defined[block])
+                if new_in != live_in[block]:
+                    live_in[block] = new_in
+                    changed = True
+        return live_in, live_out
+
+    def place_phis(self):
+        '''Add phis where different definitions of a live variable meet, using iterated dominance frontiers.'''
+        frontiers = self.graph.dominance_frontiers()
+        live_in, _ = self.liveness(self.variables)
+        assignments = collections.defaultdict(set)
+        for block in self.graph.blocks:
+            for statement in block.statements:
+                target = self.assigned_name(statement)
+                if target in self.variables:
+                    assignments[target].add(block)
+
+        for variable in sorted(assignments, key=lambda n: n.id):
+            # The entry block defines the entry version.
+            worklist = list(assignments[variable] | set([self.graph.entry]))
+            has_phi = set()
+            while worklist:
+                block = worklist.pop()
+                for frontier in frontiers[block]:
+                    if frontier not in has_phi and variable in live_in[frontier]:
+                        has_phi.add(frontier)
+                        self.add_phi(frontier, Phi(variable, [None] * len(frontier.predecessors)))
+                        worklist.append(frontier)
+
+    def rename(self):
+        '''Give every assignment a new version and make every read refer to the version that reaches it.'''
+        stacks = dict((variable, [variable]) for variable in self.variables)
+        children = self.graph.dominator_tree()
+
+        # Walk the dominator tree, so that the top of each stack is the
+        # version that reaches the block being renamed.
+        stack = [(self.graph.entry, None)]
+        while stack:
+            block, pushed = stack.pop()
+            if pushed is not None:
+                for variable in pushed:
+                    stacks[variable].pop()
+                continue
+            pushed = self.rename_block(block, stacks)
+            stack.append((block, pushed))
+            stack.extend((child, None) for child in children[block])
+
+    def rename_block(self, block, stacks):
+        pushed = []
+        for phi in self.phis[block]:
+            phi.target = self.new_version(phi.variable, phi)
+            stacks[phi.variable].append(phi.target)
+            pushed.append(phi.variable)
+
+        for site in block.statements + [block]:
+            if site is block and block.test is None:
+                break
+            current = dict((name, stacks[name][-1]) for name in self.iter_reads(site)
+                           if name in self.variables)
+            if current:
+                self.rewrite(site, lambda e: syntaxtree.replace_names(e, current))
+                for version in current.itervalues():
+                    self.uses[version].append(site)
+
+            target = self.assigned_name(site)
+            if target in self.variables:
+                version = self.new_version(target, site)
+                site.target = renamed(target, version)
+                stacks[target].append(version)
+                pushed.append(target)
+
+        for successor in block.successors:
+            for i, predecessor in enumerate(successor.predecessors):
+                if predecessor is block:
+                    for phi in self.phis[successor]:
+                        version = stacks[phi.variable][-1]
+                        phi.args[i] = version
+                        self.uses[version].append(phi)
+        return pushed
+
+    def is_removable(self, statement):
+        return id(statement) in self.containers
+
+    def can_insert_before(self, site):
+        '''Return whether statements can be added right before a statement or the test of a block.
+
+        Loop headers and For assignments don't have a place in the AST for
+        statements to go.'''
+        if isinstance(site, syntaxtree.Node):
+            return id(site) in self.containers
+        return isinstance(site.branch, syntaxtree.If)
+
+    def insert_before(self, site, statement):
+        '''Add a statement to the AST and the graph right before a statement or the test of a block.'''
+        if isinstance(site, syntaxtree.Node):
+            anchor = site
+            block = self.statement_blocks[id(site)]
+            index = next(i for i, s in enumerate(block.statements) if s is site)
+            block.statements.insert(index, statement)
+        else:
+            anchor = site.branch
+            block = site
+            block.statements.append(statement)
+        container = self.containers[id(anchor)]
+        index = next(i for i, s in enumerate(container) if s is anchor)
+        container.insert(index, statement)
+        self.containers[id(statement)] = container
+        self.statement_blocks[id(statement)] = block
+
+    def insert_in_preheader(self, header, statement):
+        '''Add a statement to the AST and the graph right before the For loop that a header belongs to.
+
+        The statement goes at the end of the block that falls through to the
+        header, so it runs once each time the loop is entered.'''
+        block = next(p for p in header.predecessors if not self.graph.dominates(header, p))
+        block.statements.append(statement)
+        container = self.containers[id(header.branch)]
+        index = next(i for i, s in enumerate(container) if s is header.branch)
+        container.insert(index, statement)
+        self.containers[id(statement)] = container
+        self.statement_blocks[id(statement)] = block
+
+    def append_to_loop_body(self, header, statement):
+        '''Add a statement to the AST and the graph at the end of the body of the For loop that a header belongs to.
+
+        The statement runs at the end of every iteration, right before the
+        loop's assignment.'''
+        loop = header.branch
+        block = next(p for p in header.predecessors if self.graph.dominates(header, p))
+        index = next(i for i, s in enumerate(block.statements) if s is loop.assignment)
+        block.statements.insert(index, statement)
+        loop.body.append(statement)
+        self.containers[id(statement)] = loop.body
+        self.statement_blocks[id(statement)] = block
+
+    def add_temporary(self, type, definition):
+        '''Return a new version of a variable for values computed by optimizations.
+
+        Temporaries of the same type are versions of the same variable, so
+        they can share storage when they aren't live at the same time.'''
+        variable = syntaxtree.Name('tmp.%s' % type)
+        self.variables.setdefault(variable, syntaxtree.VarDecl(False, type, variable, None))
+        return self.new_version(variable, definition)
+
+    def remove(self, statement):
+        '''Remove a statement from its block and the AST.'''
+        block = self.statement_blocks.pop(id(statement))
+        block.statements[:] = [s for s in block.statements if s is not statement]
+        container = self.containers.pop(id(statement))
+        container[:] = [s for s in container if s is not statement]
+
+    def add_phi(self, block, phi):
+        self.phis[block].append(phi)
+        self.phi_blocks[id(phi)] = block
+
+    def remove_phi(self, phi):
+        block = self.phi_blocks.pop(id(phi))
+        self.phis[block][:] = [p for p in self.phis[block] if p is not phi]
+
+    def definition_block(self, version):
+        '''Return the block that defines a version, or None for entry versions.'''
+        definition = self.definitions[version]
+        if definition is None:
+            return None
+        if isinstance(definition, Phi):
+            return self.phi_blocks[id(definition)]
+        return self.statement_blocks[id(definition)]
+
+    def destroy(self):
+        '''Convert the procedure back out of SSA form.
+
+        Versions that are never live at the same time share a variable. Phi
+        targets are merged with their args when possible so that the copies
+        for them can be left out.'''
+        _, live_out = self.liveness(self.definitions)
+        interference = self.find_interference(live_out)
+        find, union = self.make_classes(interference)
+
+        for block in self.graph.blocks:
+            for phi in self.phis[block]:
+                for arg in phi.args:
+                    union(phi.target, arg)
+        by_variable = collections.defaultdict(list)
+        for version in self.versions:
+            by_variable[self.origins[version]].append(version)
+        for variable, versions in sorted(by_variable.iteritems(), key=lambda i: i[0].id):
+            for i, version in enumerate(versions):
+                for other in versions[:i]:
+                    if union(other, version):
+                        break
+
+        # Each class is named after the variable of its entry version, or
+        # after its first version if it doesn't contain one.
+        names = {}
+        class_names = {}
+        self.types = {}
+        for version in self.versions:
+            root = find(version)
+            if root not in class_names:
+                class_names[root] = version
+                self.types[version] = self.variables[self.origins[version]].type
+            names[version] = class_names[root]
+
+        self.new_decls = []
+        self.declared = set(self.variables)
+        replacements = dict((v, n) for v, n in names.iteritems() if v != n)
+        for block in self.graph.blocks:
+            for site in block.statements + [block]:
+                if site is block and block.test is None:
+                    break
+                self.rewrite(site, lambda e: syntaxtree.replace_names(e, replacements))
+                self.declare_all(names[v] for v in self.read_versions(site))
+                target = self.assigned_name(site)
+                if target in names:
+                    site.target = renamed(target, names[target])
+                    self.declare_all([names[target]])
+
+        for block in self.graph.blocks:
+            phis = self.phis[block]
+            if not phis:
+                continue
+            for i, predecessor in enumerate(block.predecessors):
+                copies = sequentialize([(names[phi.target], names[phi.args[i]]) for phi in phis],
+                                       self.new_temporary)
+                self.declare_all(itertools.chain.from_iterable(copies))
+                statements = [self.make_copy(target, source) for target, source in copies]
+                self.graph.insert_on_edge(predecessor, block, statements)
+        self.procedure.decls.extend(self.new_decls)
+
+    def find_interference(self, live_out):
+        '''Return a dict mapping each version to the set of versions that are live where it is defined.'''
+        interference = collections.defaultdict(set)
+        def interfere(version, others):
+            for other in others:
+                if other != version:
+                    interference[version].add(other)
+                    interference[other].add(version)
+
+        for block in self.graph.blocks:
+            live = live_out[block] | self.read_versions(block)
+            for statement in reversed(block.statements):
+                target = self.assigned_name(statement)
+                if target in self.definitions:
+                    interfere(target, live)
+                    live.discard(target)
+                live.update(self.read_versions(statement))
+            targets = [phi.target for phi in self.phis[block]]
+            for target in targets:
+                interfere(target, live)
+                interfere(target, targets)
+        return interference
+
+    def make_classes(self, interference):
+        '''Return find and union functions for merging versions into classes that can share a variable.'''
+        parents = {}
+        members = {}
+
+        def find(version):
+            while version in parents:
+                version = parents[version]
+            return version
+
+        def union(a, b):
+            '''Merge the classes of two versions and return True, or return False if they can't be merged.'''
+            a = find(a)
+            b = find(b)
+            if a == b:
+                return True
+            if a in self.parameters or b in self.parameters:
+                return False
+            a_members = members.setdefault(a, set([a]))
+            b_members = members.setdefault(b, set([b]))
+            # Each variable's entry value is in its own stack slot.
+            if (any(m in self.variables for m in a_members) and
+                any(m in self.variables for m in b_members)):
+                return False
+            if any(interference[m] & b_members for m in a_members):
+                return False
+            if len(a_members) < len(b_members):
+                a, b = b, a
+                a_members, b_members = b_members, a_members
+            parents[b] = a
+            a_members.update(b_members)
+            del members[b]
+            return True
+
+        return find, union
+
+    def declare_all(self, names):
+        '''Add declarations for any of the names that don't have one.'''
+        for name in names:
+            if name not in self.declared:
+                self.declared.add(name)
+                self.new_decls.append(syntaxtree.VarDecl(False, self.types[name],
+                                                         syntaxtree.Name(name.id), None))
+
+    def new_temporary(self, target):
+        temporary = syntaxtree.Name('%s.tmp%d' % (target.id, len(self.types)))
+        self.types[temporary] = self.types[target]
+        return temporary
+
+    def make_copy(self, target, source):
+        target = syntaxtree.Name(target.id)
+        source = syntaxtree.Name(source.id)
+        target.node_type = source.node_type = self.types[target]
+        return syntaxtree.Assign(target, source)
@@ -68,6 +68,97 @@ class TreeMutator(TreeWalker):
                     self.modified_tree = True
         return node
     
+def iter_statements(statements):
+    '''Yield every statement in a list, including the statements nested in branches and loops.'''
+    for statement in statements:
+        yield statement
+        if isinstance(statement, If):
+            for child in iter_statements(statement.body):
+                yield child
+            for child in iter_statements(statement.orelse):
+                yield child
+        elif isinstance(statement, For):
+            yield statement.assignment
+            for child in iter_statements(statement.body):
+                yield child
+
+def iter_procedures(node):
+    '''Yield a Program or ProcDecl and every procedure nested inside of it, outer procedures first.'''
+    yield node
+    for decl in node.decls:
+        if isinstance(decl, ProcDecl):
+            for procedure in iter_procedures(decl):
+                yield procedure
+
+def iter_names(node):
+    '''Yield every Name read by an expression, including the names of subscripted arrays.'''
+    if isinstance(node, Name):
+        yield node
+    elif isinstance(node, BinaryOp):
+        for name in iter_names(node.left):
+            yield name
+        for name in iter_names(node.right):
+            yield name
+    elif isinstance(node, UnaryOp):
+        for name in iter_names(node.operand):
+            yield name
+    elif isinstance(node, Subscript):
+        yield node.name
+        for name in iter_names(node.index):
+            yield name
+    elif isinstance(node, Select):
+        for field in node:
+            for name in iter_names(field):
+                yield name
+
+def replace_names(node, replacements):
+    '''Return an expression with Names replaced by copies of the nodes they map to in a dict.
+
+    The original expression isn't modified, and subtrees without any replaced
+    names are shared with it. The names of subscripted arrays are not replaced.'''
+    if isinstance(node, Name):
+        replacement = replacements.get(node)
+        if replacement is None:
+            return node
+        new_node = type(replacement)(*replacement, token=node.token)
+    elif isinstance(node, BinaryOp):
+        left = replace_names(node.left, replacements)
+        right = replace_names(node.right, replacements)
+        if left is node.left and right is node.right:
+            return node
+        new_node = BinaryOp(node.op, left, right, token=node.token)
+    elif isinstance(node, UnaryOp):
+        operand = replace_names(node.operand, replacements)
+        if operand is node.operand:
+            return node
+        new_node = UnaryOp(node.op, operand, token=node.token)
+    elif isinstance(node, Subscript):
+        index = replace_names(node.index, replacements)
+        if index is node.index:
+            return node
+        new_node = Subscript(node.name, index, token=node.token)
+    elif isinstance(node, Select):
+        fields = [replace_names(field, replacements) for field in node]
+        if all(new is old for new, old in zip(fields, node)):
+            return node
+        new_node = Select(*fields, token=node.token)
+    else:
+        return node
+    new_node.node_type = node.node_type
+    return new_node
+
+def copy_tree(node):
+    '''Return a deep copy of a node or a list of nodes.
+
+    The copies keep the tokens and node types of the original nodes.'''
+    if isinstance(node, list):
+        return [copy_tree(child) for child in node]
+    if not isinstance(node, Node):
+        return node
+    new_node = type(node)(*[copy_tree(field) for field in node], token=node.token)
+    new_node.node_type = node.node_type
+    return new_node
+
 def dump_tree(node, indent_level=1, output=sys.stdout.write):
     indent = '  ' * indent_level
     output(node.__class__.__name__)
@@ -236,6 +327,12 @@ class Subscript(object):
     __metaclass__ = NodeMeta
     __slots__ = ('name', 'index')
 
+# Selects aren't in the language, but the optimizer generates them. They're
+# if_true if test is nonzero and if_false otherwise.
+class Select(object):
+    __metaclass__ = NodeMeta
+    __slots__ = ('test', 'if_true', 'if_false')
+
 class Num(object):
     __metaclass__ = NodeMeta
     __slots__ = ('n',)
@@ -43,6 +43,9 @@ FOR = 'for'
 AND = '&'
 OR = '|'
 NOT = 'not'
+# Shifts aren't in the language, but the optimizer generates them.
+LSHIFT = '<<'
+RSHIFT = '>>'
 PROGRAM = 'program'
 PROCEDURE = 'procedure'
 BEGIN = 'begin'
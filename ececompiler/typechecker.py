@@ -44,6 +44,8 @@ class Checker(syntaxtree.TreeWalker):
             syntaxtree.Assign:self.visit_assign,
             syntaxtree.ProcDecl:self.visit_procdecl,
             syntaxtree.Call:self.visit_call,
+            syntaxtree.If:self.visit_jump,
+            syntaxtree.For:self.visit_jump,
         }
         
     def report_error(self, err):
@@ -245,6 +247,16 @@ class Checker(syntaxtree.TreeWalker):
         except TypeCheckError as err:
             self.report_error(err)
     
+    def visit_jump(self, node):
+        # Tests aren't restricted to any type, but their operators need types
+        # so that they can be optimized and generated like any other
+        # expression.
+        try:
+            self.get_type(node.test)
+        except TypeCheckError as err:
+            self.report_error(err)
+        self.visit_children(node)
+    
     def visit_procdecl(self, node):
         self.enter_scope()
         
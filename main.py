@@ -9,6 +9,9 @@ def main():
     from ececompiler import typechecker
     from ececompiler import optimizer
     from ececompiler import codegenerator
+    from ececompiler import optcache
+    from ececompiler import profiling
+    from ececompiler import regalloc
 
     argparser = argparse.ArgumentParser(description=
                                 'Compile a source file into a c file and an executable.')
@@ -20,13 +23,69 @@ def main():
                            help='run a set of optimizations '
                            '(0=no optimization, 1=minimal optimization, '
                            '2=advanced optimization)')
+    argparser.add_argument('--max-iterations', type=int,
+                           default=optimizer.DEFAULT_ITERATION_BUDGET,
+                           help='the maximum number of times to optimize each '
+                           'procedure at -O2 (default %d)' % optimizer.DEFAULT_ITERATION_BUDGET)
+    argparser.add_argument('--unroll-factor', type=int,
+                           default=optimizer.DEFAULT_UNROLL_FACTOR,
+                           help='the maximum number of copies of a loop body made by '
+                           'partial unrolling at -O2, or 1 to turn unrolling off '
+                           '(default %d)' % optimizer.DEFAULT_UNROLL_FACTOR)
+    argparser.add_argument('--inline-size', type=int,
+                           default=optimizer.DEFAULT_INLINE_SIZE,
+                           help='the maximum size of the procedures inlined at every '
+                           'call site at -O2, or 0 to turn inlining off '
+                           '(default %d)' % optimizer.DEFAULT_INLINE_SIZE)
+    argparser.add_argument('--array-budget', type=int,
+                           default=optimizer.DEFAULT_ARRAY_BUDGET,
+                           help='the maximum length of the local arrays replaced by '
+                           'variables at -O2, and the maximum number of array elements '
+                           'whose values are tracked (default %d)'
+                           % optimizer.DEFAULT_ARRAY_BUDGET)
+    argparser.add_argument('--passes', type=optimizer.parse_pipeline,
+                           help='a comma separated list of optimization passes to run '
+                           'instead of the ones for -O (one of %s)'
+                           % ', '.join(sorted(optimizer.PASSES)))
+    argparser.add_argument('--profile-generate', metavar='PROFILE',
+                           help='count how often each procedure, branch, loop, and call '
+                           'runs, and write the counts to PROFILE when the program exits')
+    argparser.add_argument('--profile-use', metavar='PROFILE',
+                           help='guide inlining, unrolling, and the layout of branches by '
+                           'the counts in PROFILE')
+    argparser.add_argument('--cache-dir', metavar='DIR',
+                           help='store the optimized procedures in DIR, and reuse the ones '
+                           'that haven\'t changed since an earlier build')
+    argparser.add_argument('--cache-size', type=int,
+                           default=optcache.DEFAULT_CACHE_SIZE // (1024 * 1024),
+                           help='the maximum size of the cache directory in megabytes '
+                           '(default %d)' % (optcache.DEFAULT_CACHE_SIZE // (1024 * 1024)))
+    argparser.add_argument('--registers', type=int, default=regalloc.REGISTER_COUNT,
+                           help='the number of registers that variables and temporaries '
+                           'are allocated to, or 0 to keep them all in memory (default %d)'
+                           % regalloc.REGISTER_COUNT)
     argparser.add_argument('-R', '--no-runtime', action='store_true',
                             help='do not link the runtime IO functions')
+    argparser.add_argument('-b', '--check-bounds', action='store_true',
+                            help='check that array indexes are in bounds at runtime')
     argparser.add_argument('-c', action='store_true',
                             help='only parse and assemble the code to C, do not run gcc')
     argparser.add_argument('-v', '--verbose-assembly', action='store_true',
                            help='Add comments to the generated code')
     args = argparser.parse_args()
+    if args.registers < 0:
+        argparser.error('the number of registers can\'t be negative')
+    
+    profile = None
+    if args.profile_use is not None:
+        try:
+            profile = profiling.read_profile(args.profile_use)
+        except profiling.ProfileError as err:
+            argparser.error(str(err))
+    
+    cache = None
+    if args.cache_dir is not None:
+        cache = optcache.OptimizationCache(args.cache_dir, args.cache_size * 1024 * 1024)
     
     asm_filename = os.path.splitext(os.path.basename(args.filename))[0].strip() + '.c'
     try:
@@ -36,10 +95,14 @@ def main():
         pass
     else:
         if typechecker.tree_is_valid(ast):
-            optimizer.optimize_tree(ast, args.O)
+            optimizer.optimize_tree(ast, args.O, args.max_iterations,
+                                    args.unroll_factor, args.inline_size,
+                                    pipeline=args.passes, array_budget=args.array_budget,
+                                    profile=profile, cache=cache)
             
             with open(asm_filename, 'w') as f:
-                codegenerator.output_code(ast, f, args.verbose_assembly)
+                codegenerator.output_code(ast, f, args.verbose_assembly, args.check_bounds,
+                                          args.profile_generate, profile, args.registers)
                 
             if not args.c:
                 sys.exit(subprocess.call(['gcc', '-m32', '-o', args.output, 'runtime.c', asm_filename]))
@@ -15,6 +15,12 @@ void validateBooleanOp(int left, char op, int right, int lineno) {
     }
 }
 
+void indexOutOfBounds(int index, int length, int lineno) {
+    printf("FATAL ERROR:line %d:Array index %d is out of bounds for length %d",
+           lineno, index, length);
+    exit(EXIT_FAILURE);
+}
+
 int getInteger() {
     int value;
     scanf("%d", &value);
@@ -2,6 +2,7 @@
 #define RUNTIME_H
 
 extern void validateBooleanOp(int left, char op, int right, int lineno);
+extern void indexOutOfBounds(int index, int length, int lineno);
 extern int getBool();
 extern int getInteger();
 extern float getFloat();
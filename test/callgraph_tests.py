@@ -0,0 +1,221 @@
+from ececompiler import scanner
+from ececompiler import parser
+from ececompiler import typechecker
+from ececompiler import callgraph
+
+from ececompiler.syntaxtree import *
+
+def parse_prog(src):
+    ast = parser.parse_tokens(scanner.tokenize_string(src), include_runtime=True)
+    assert typechecker.tree_is_valid(ast)
+    return ast
+
+def get_proc(ast, name):
+    for decl in ast.decls:
+        if isinstance(decl, ProcDecl):
+            if decl.name == Name(name):
+                return decl
+            found = get_proc(decl, name)
+            if found is not None:
+                return found
+    return None
+
+def names(procedures):
+    return [p.name.id for p in procedures]
+
+SRC = '''
+program test_program is
+    int a;
+    global procedure g(int x in, int y out)
+    begin
+        y := x;
+    end procedure;
+    procedure f(int x in, int y out, int z out)
+        int t;
+        procedure h(int y out)
+        begin
+            g(1, y);
+        end procedure;
+    begin
+        h(t);
+        g(t, z);
+        f(x, y, z);
+    end procedure;
+    procedure unused(int x in)
+    begin
+        putInteger(x);
+    end procedure;
+begin
+    f(1, a, a);
+    getInteger(a);
+end program
+'''
+
+def test_callees():
+    ast = parse_prog(SRC)
+    graph = callgraph.CallGraph(ast)
+    assert names(graph.callees(ast)) == ['f', 'getInteger']
+    assert names(graph.callees(get_proc(ast, 'f'))) == ['h', 'g', 'f']
+    assert names(graph.callees(get_proc(ast, 'h'))) == ['g']
+    
+def test_callers():
+    ast = parse_prog(SRC)
+    graph = callgraph.CallGraph(ast)
+    assert names(graph.callers(get_proc(ast, 'g'))) == ['f', 'h']
+    assert names(graph.callers(get_proc(ast, 'f'))) == ['test_program', 'f']
+    assert graph.callers(get_proc(ast, 'unused')) == []
+    
+def test_parent():
+    ast = parse_prog(SRC)
+    graph = callgraph.CallGraph(ast)
+    assert graph.parent(ast) is None
+    assert graph.parent(get_proc(ast, 'f')) is ast
+    assert graph.parent(get_proc(ast, 'h')) is get_proc(ast, 'f')
+    
+def test_written_params():
+    ast = parse_prog(SRC)
+    graph = callgraph.CallGraph(ast)
+    assert graph.written_params(get_proc(ast, 'g')) == set([1])
+    # z is forwarded to g, which writes it, but y is only passed to f itself.
+    assert graph.written_params(get_proc(ast, 'f')) == set([2])
+    assert graph.written_params(get_proc(ast, 'getInteger')) == set([0])
+    assert graph.written_params(get_proc(ast, 'putInteger')) == set()
+    
+EFFECTS_SRC = '''
+program test_program is
+    global int a;
+    global int b;
+    global int c[2];
+    global procedure f(int x in, int y out)
+    begin
+        y := a;
+        c[x] := x;
+    end procedure;
+    global procedure g(int x[2] in, int y out)
+        int t;
+    begin
+        t := x[0];
+        h(t, y);
+    end procedure;
+    global procedure h(int x in, int y out)
+        int a;
+    begin
+        a := x;
+        y := a;
+        if (x > 0) then
+            g(c, b);
+        end if;
+    end procedure;
+begin
+    h(1, a);
+end program
+'''
+
+def test_effects():
+    ast = parse_prog(EFFECTS_SRC)
+    graph = callgraph.CallGraph(ast)
+    f = graph.effects(get_proc(ast, 'f'))
+    assert f == (set([Name('a')]), set([Name('c')]), set(), set([1]))
+    # g and h call each other, and h's local a shadows the global.
+    for name in ['g', 'h']:
+        effects = graph.effects(get_proc(ast, name))
+        assert effects.global_reads == set([Name('c')])
+        assert effects.global_writes == set([Name('b')])
+    assert graph.effects(get_proc(ast, 'g')).param_reads == set([0])
+    assert graph.effects(get_proc(ast, 'g')).param_writes == set([1])
+    assert graph.effects(ast).global_writes == set([Name('a'), Name('b')])
+    assert graph.effects(get_proc(ast, 'getInteger')).param_writes == set([0])
+    
+def test_strongly_connected_components():
+    ast = parse_prog(EFFECTS_SRC)
+    graph = callgraph.CallGraph(ast)
+    components = [sorted(names(c)) for c in graph.strongly_connected_components()]
+    assert components.index(['g', 'h']) < components.index(['test_program'])
+    assert ['f'] in components
+    assert sum(len(c) for c in components) == len(graph.procedures)
+    
+def test_reachable():
+    ast = parse_prog(SRC)
+    graph = callgraph.CallGraph(ast)
+    assert set(names(graph.reachable())) == set(['test_program', 'f', 'g', 'h',
+                                                 'getInteger'])
+    
+def test_postorder():
+    ast = parse_prog(SRC)
+    graph = callgraph.CallGraph(ast)
+    order = names(graph.postorder())
+    assert order.index('g') < order.index('h') < order.index('f')
+    assert order.index('f') < order.index('test_program')
+    assert len(order) == len(graph.procedures)
+    
+def test_update():
+    ast = parse_prog(SRC)
+    graph = callgraph.CallGraph(ast)
+    f = get_proc(ast, 'f')
+    del f.body[1:]
+    assert names(graph.update(f)) == ['g', 'f']
+    assert names(graph.callers(get_proc(ast, 'g'))) == ['h']
+    assert graph.written_params(f) == set()
+    
+def test_remove():
+    ast = parse_prog(SRC)
+    graph = callgraph.CallGraph(ast)
+    f = get_proc(ast, 'f')
+    ast.body = ast.body[1:]
+    graph.update(ast)
+    removed = graph.remove(f)
+    assert names(removed) == ['f', 'h']
+    assert get_proc(ast, 'f') is None
+    assert f not in graph
+    assert graph.callers(get_proc(ast, 'g')) == []
+    
+def test_tail_calls():
+    ast = parse_prog('''
+    program test_program is
+        int a;
+        procedure f(int x in)
+            int i;
+        begin
+            if (x < 0) then
+                putInteger(1);
+                return;
+            end if;
+            i := 0;
+            for (i := i + 1; i < 2)
+                putInteger(2);
+            end for;
+            if (x < 1) then
+                putInteger(3);
+                putInteger(4);
+            else
+                f(x - 1);
+            end if;
+        end procedure;
+    begin
+        f(a);
+    end program
+    ''')
+    f = get_proc(ast, 'f')
+    calls = list(callgraph.iter_tail_calls(f.body))
+    assert [c.args[0] for c in calls] == [Num('1'), Num('4'), BinaryOp('-', Name('x'), Num('1'))]
+    
+def test_effects_of_expression_arguments():
+    ast = parse_prog('''
+    program test_program is
+        int r;
+        procedure count(int n in, int acc out)
+        begin
+            acc := n;
+        end procedure;
+    begin
+        count(2 + 3, r);
+        count(-r, r);
+    end program
+    ''')
+    # Tail recursion elimination assigns to in parameters, but that only
+    # changes the callee's copy.
+    count = get_proc(ast, 'count')
+    count.body.insert(0, Assign(Name('n'), BinaryOp('-', Name('n'), Num('1'))))
+    graph = callgraph.CallGraph(ast)
+    assert graph.effects(count).param_writes == set([1])
+    assert graph.effects(ast).global_writes == set()
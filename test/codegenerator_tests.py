@@ -0,0 +1,45 @@
+import re
+import StringIO
+
+from ececompiler import scanner
+from ececompiler import parser
+from ececompiler import typechecker
+from ececompiler import codegenerator
+
+def generate(src, **options):
+    '''Return the C code generated for a program.'''
+    ast = parser.parse_tokens(scanner.tokenize_string(src), include_runtime=True)
+    assert typechecker.tree_is_valid(ast)
+    output = StringIO.StringIO()
+    codegenerator.output_code(ast, output, **options)
+    return output.getvalue()
+
+def test_variables_are_loaded_before_branches():
+    code = generate('''
+    program test_program is
+        int a;
+        int b;
+    begin
+        getInteger(b);
+        if (b < 0) then
+            a := a + 1;
+        end if;
+        putInteger(a);
+    end program
+    ''')
+    # a is read first in the body of the If, but putInteger needs it loaded
+    # even when the body isn't taken.
+    load = re.search(r'R\d+ = MM\[FP \+ 1\];', code)
+    assert load is not None
+    assert load.start() < code.index('if (')
+
+def test_float_literal_arguments_are_stored_by_bit_pattern():
+    code = generate('''
+    program test_program is
+    begin
+        putFloat(1.5);
+    end program
+    ''')
+    assert 'FLOAT_REG_1 = 1.5;' in code
+    assert 'memcpy(&MM[SP + 1], &FLOAT_REG_1, sizeof(float));' in code
+    assert 'MM[SP + 1] = 1.5;' not in code
@@ -0,0 +1,235 @@
+from ececompiler import scanner
+from ececompiler import parser
+from ececompiler import typechecker
+from ececompiler import controlflow
+
+from ececompiler.syntaxtree import *
+
+def parse_prog(src):
+    ast = parser.parse_tokens(scanner.tokenize_string(src), include_runtime=True)
+    assert typechecker.tree_is_valid(ast)
+    return ast
+
+def build_body(body, decls='int a; int b; int i; int j;'):
+    src = '''
+    program test_program is
+        %s
+    begin
+        %s
+    end program
+    ''' % (decls, body)
+    return controlflow.ControlFlowGraph(parse_prog(src))
+
+def indexes(blocks):
+    return [b.index for b in blocks]
+
+def test_straight_line():
+    graph = build_body('''
+        a := 1;
+        putInteger(a);
+    ''')
+    assert len(graph.blocks) == 2
+    assert graph.entry.statements == [Assign(Name('a'), Num('1')),
+                                      Call(Name('putInteger'), [Name('a')])]
+    assert graph.entry.successors == [graph.exit]
+    assert graph.exit.predecessors == [graph.entry]
+
+def test_statements_are_tree_nodes():
+    graph = build_body('a := 1;')
+    assert graph.entry.statements[0] is graph.procedure.body[0]
+
+def test_if_else():
+    graph = build_body('''
+        if (a < 1) then
+            b := 1;
+        else
+            b := 2;
+        end if;
+        putInteger(b);
+    ''')
+    entry = graph.entry
+    assert entry.test == BinaryOp('<', Name('a'), Num('1'))
+    assert entry.branch is graph.procedure.body[0]
+    body, orelse = entry.successors
+    assert body.statements == [Assign(Name('b'), Num('1'))]
+    assert orelse.statements == [Assign(Name('b'), Num('2'))]
+    assert body.successors == orelse.successors
+    join = body.successors[0]
+    assert join.statements == [Call(Name('putInteger'), [Name('b')])]
+    assert graph.immediate_dominator(join) is entry
+
+def test_if_without_else():
+    graph = build_body('''
+        if (a < 1) then
+            b := 1;
+        end if;
+    ''')
+    body, join = graph.entry.successors
+    assert body.successors == [join]
+    assert indexes(join.predecessors) == [graph.entry.index, body.index]
+
+def test_for():
+    graph = build_body('''
+        i := 0;
+        for (i := i + 1; i < 10)
+            putInteger(i);
+        end for;
+        putInteger(a);
+    ''')
+    header = graph.entry.successors[0]
+    assert header.branch is graph.procedure.body[1]
+    body, after = header.successors
+    # The loop's assignment is at the end of the body.
+    assert body.statements == [Call(Name('putInteger'), [Name('i')]),
+                               Assign(Name('i'), BinaryOp('+', Name('i'), Num('1')))]
+    assert body.successors == [header]
+    assert after.statements == [Call(Name('putInteger'), [Name('a')])]
+
+    loop, = graph.loops()
+    assert loop.header is header
+    assert loop.blocks == set([header, body])
+    assert loop.latches == [body]
+    assert loop.node is graph.procedure.body[1]
+    assert loop.exits() == [(header, after)]
+
+def test_return():
+    graph = build_body('''
+        if (a < 1) then
+            return;
+        end if;
+        putInteger(a);
+        return;
+        putInteger(b);
+    ''')
+    body, join = graph.entry.successors
+    assert body.successors == [graph.exit]
+    assert join.successors == [graph.exit]
+    # The code after the return isn't in the graph.
+    assert len(graph.blocks) == 4
+    assert indexes(graph.blocks) == range(4)
+
+def test_infinite_loop():
+    graph = build_body('''
+        for (i := i; true)
+            putInteger(i);
+        end for;
+        putInteger(a);
+    ''')
+    # The block after the loop is still reachable through the false edge.
+    assert graph.exit.predecessors
+    assert len(graph.loops()) == 1
+
+def test_dominators():
+    graph = build_body('''
+        if (a < 1) then
+            b := 1;
+        else
+            for (i := i + 1; i < 10)
+                b := 2;
+            end for;
+        end if;
+    ''')
+    body, orelse = graph.entry.successors
+    header = orelse.successors[0]
+    loop_body, after = header.successors
+    assert graph.dominates(graph.entry, graph.exit)
+    assert graph.dominates(orelse, loop_body)
+    assert graph.dominates(header, after)
+    assert not graph.dominates(body, graph.exit)
+    assert not graph.dominates(loop_body, after)
+    join = body.successors[0]
+    tree = graph.dominator_tree()
+    assert set(tree[graph.entry]) == set([body, orelse, join])
+    assert tree[join] == [graph.exit]
+
+def test_nested_loops():
+    graph = build_body('''
+        for (i := i + 1; i < 10)
+            for (j := j + 1; j < 10)
+                if (i < j) then
+                    a := 1;
+                end if;
+            end for;
+            b := 1;
+        end for;
+    ''')
+    outer, inner = graph.loops()
+    assert inner.parent is outer
+    assert outer.children == [inner]
+    assert inner.blocks < outer.blocks
+    assert outer.depth == 1
+    assert inner.depth == 2
+
+    if_block = inner.header.successors[0]
+    assert graph.innermost_loop(if_block) is inner
+    assert graph.loop_depth(if_block) == 2
+    assert graph.loop_depth(inner.header.successors[1]) == 1
+    assert graph.loop_depth(graph.exit) == 0
+
+def test_build_graphs():
+    src = '''
+    program test_program is
+        procedure f(int x in)
+            procedure g(int y in)
+            begin
+                putInteger(y);
+            end procedure;
+        begin
+            g(x);
+        end procedure;
+    begin
+        f(1);
+    end program
+    '''
+    ast = parse_prog(src)
+    graphs = controlflow.build_graphs(ast)
+    assert [g.procedure.name.id for g in graphs if g.procedure.body] == [
+        'test_program', 'f', 'g']
+
+def test_dominance_frontiers():
+    graph = build_body('''
+        if (a < 1) then
+            b := 1;
+        else
+            b := 2;
+        end if;
+        for (i := i + 1; i < 10)
+            b := 3;
+        end for;
+    ''')
+    body, orelse = graph.entry.successors
+    join = body.successors[0]
+    header = join.successors[0]
+    loop_body = header.successors[0]
+    frontiers = graph.dominance_frontiers()
+    assert frontiers[body] == frontiers[orelse] == set([join])
+    assert frontiers[graph.entry] == set()
+    assert frontiers[loop_body] == frontiers[header] == set([header])
+
+def test_insert_on_edges():
+    graph = build_body('''
+        if (a < 1) then
+            b := 1;
+        end if;
+        for (i := i + 1; i < 10)
+            b := 2;
+        end for;
+    ''')
+    branch, loop = graph.procedure.body
+    body, join = graph.entry.successors
+    header = join.successors[0]
+    loop_body = header.successors[0]
+    copy = lambda n: Assign(Name('a'), Num(str(n)))
+
+    graph.insert_on_edge(graph.entry, join, [copy(1)])
+    assert branch.orelse == [copy(1)]
+    graph.insert_on_edge(body, join, [copy(2)])
+    assert branch.body[-1] == copy(2)
+    graph.insert_on_edge(join, header, [copy(3)])
+    assert graph.procedure.body[1] == copy(3)
+    # Statements on the back edge go after the loop's assignment.
+    graph.insert_on_edge(loop_body, header, [copy(4), copy(5)])
+    assert loop.body == [Assign(Name('b'), Num('2')),
+                         Assign(Name('i'), BinaryOp('+', Name('i'), Num('1'))),
+                         copy(4)]
+    assert loop.assignment == copy(5)
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+
+from ececompiler import scanner
+from ececompiler import parser
+from ececompiler import typechecker
+from ececompiler import callgraph
+from ececompiler import optimizer
+from ececompiler import optcache
+
+from ececompiler.syntaxtree import *
+
+def parse_prog(src):
+    ast = parser.parse_tokens(scanner.tokenize_string(src), include_runtime=True)
+    assert typechecker.tree_is_valid(ast)
+    return ast
+
+def tree_tokens(node):
+    '''Return a list of the tokens in a tree.'''
+    if isinstance(node, list):
+        return [token for child in node for token in tree_tokens(child)]
+    if not isinstance(node, Node):
+        return []
+    return [node.token] + tree_tokens(list(node))
+
+def procedure_keys(src, options=()):
+    '''Return the cache keys of the procedures in a program by name.'''
+    ast = parse_prog(src)
+    graph = callgraph.CallGraph(ast)
+    return dict((p.name.id, optcache.procedure_key(p, graph, options))
+                for p in graph.procedures if optcache.is_cacheable(p))
+
+SRC = '''
+program test_program is
+    global int g;
+    int a;
+    int b;
+    global procedure f(int x in, int y out)
+        int i;
+        int z;
+    begin
+        z := 0;
+        i := 0;
+        for (i := i + 1; i < 4)
+            z := z + x * i;
+        end for;
+        y := z;
+    end procedure;
+    global procedure h(int x in, int y out)
+        int z;
+    begin
+        f(x + 1, z);
+        putInteger(z);
+        y := z;
+    end procedure;
+    global procedure k(int x in)
+    begin
+        putInteger(x * 2);
+        putInteger(x * 2);
+    end procedure;
+begin
+    h(1, a);
+    h(2, b);
+    k(a);
+    k(b);
+end program
+'''
+
+def optimize(src, directory, **options):
+    cache = optcache.OptimizationCache(directory)
+    ast = optimizer.optimize_procedures(parse_prog(src), cache=cache, **options)
+    return ast, cache
+
+def test_cached_procedures_are_loaded():
+    directory = tempfile.mkdtemp()
+    try:
+        expected = optimizer.optimize_procedures(parse_prog(SRC))
+        ast, cache = optimize(SRC, directory)
+        assert ast == expected
+        assert (cache.hits, cache.misses) == (0, 3)
+        # f and h are inlined into their callers, but they're still stored, so
+        # that they don't have to be optimized again if their callers change.
+        assert len(os.listdir(directory)) == 3
+        ast, cache = optimize(SRC, directory)
+        assert ast == expected
+        assert (cache.hits, cache.misses) == (3, 0)
+    finally:
+        shutil.rmtree(directory)
+
+def test_moved_procedures_are_loaded():
+    directory = tempfile.mkdtemp()
+    try:
+        optimize(SRC, directory)
+        moved = '\n\n' + SRC
+        ast, cache = optimize(moved, directory)
+        assert cache.hits == 3
+        expected = optimizer.optimize_procedures(parse_prog(moved))
+        assert ast == expected
+        # The tokens of the loaded trees are moved too.
+        assert tree_tokens(ast) == tree_tokens(expected)
+    finally:
+        shutil.rmtree(directory)
+
+def test_options_are_part_of_the_key():
+    directory = tempfile.mkdtemp()
+    try:
+        optimize(SRC, directory)
+        ast, cache = optimize(SRC, directory, unroll_factor=1)
+        assert cache.hits == 0
+    finally:
+        shutil.rmtree(directory)
+
+def test_damaged_entries_are_ignored():
+    directory = tempfile.mkdtemp()
+    try:
+        optimize(SRC, directory)
+        for filename in os.listdir(directory):
+            with open(os.path.join(directory, filename), 'wb') as f:
+                f.write('not a pickle')
+        ast, cache = optimize(SRC, directory)
+        assert cache.hits == 0
+        assert ast == optimizer.optimize_procedures(parse_prog(SRC))
+    finally:
+        shutil.rmtree(directory)
+
+def test_least_recently_used_entries_are_evicted():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = optcache.OptimizationCache(directory, max_size=250)
+        for i, key in enumerate(['first', 'second', 'third']):
+            with open(cache.path(key), 'wb') as f:
+                f.write('x' * 100)
+            os.utime(cache.path(key), (i, i))
+        cache.evict()
+        assert sorted(os.listdir(directory)) == ['second' + optcache.ENTRY_SUFFIX,
+                                                 'third' + optcache.ENTRY_SUFFIX]
+    finally:
+        shutil.rmtree(directory)
+
+def test_keys_include_callees():
+    keys = procedure_keys(SRC)
+    changed = procedure_keys(SRC.replace('z := z + x * i;', 'z := z - x * i;'))
+    # h calls f, so both change, but k doesn't.
+    assert keys['f'] != changed['f']
+    assert keys['h'] != changed['h']
+    assert keys['k'] == changed['k']
+
+def test_keys_include_globals():
+    keys = procedure_keys(SRC)
+    changed = procedure_keys(SRC.replace('global int g;', 'global float g;'))
+    assert all(keys[name] != changed[name] for name in keys)
+
+def test_keys_ignore_moves():
+    assert procedure_keys(SRC) == procedure_keys('\n' + SRC)
+    assert procedure_keys(SRC, ('options',)) != procedure_keys(SRC)
@@ -1,6 +1,12 @@
+import collections
 import itertools
+import os
+import shutil
+import subprocess
+import tempfile
 
 from nose.tools import raises
+from nose.plugins.skip import SkipTest
 
 from ececompiler import scanner
 from ececompiler import tokens
@@ -8,6 +14,8 @@ from ececompiler import parser
 from ececompiler import syntaxtree as st
 from ececompiler import typechecker
 from ececompiler import optimizer
+from ececompiler import callgraph
+from ececompiler import profiling
 
 from ececompiler.syntaxtree import *
 
@@ -19,8 +27,8 @@ def parse_ex(exp):
     typechecker.Checker().get_type(ast)
     return ast
 
-def parse_prog(src):
-    ast = parser.parse_tokens(scanner.tokenize_string(src))
+def parse_prog(src, include_runtime=False):
+    ast = parser.parse_tokens(scanner.tokenize_string(src), include_runtime)
     assert typechecker.tree_is_valid(ast)
     return ast
 
@@ -72,6 +80,198 @@ def test_folding_unary_not():
     yield check_folding_expression, 'not false', st.Num(tokens.TRUE)
     
     
+def test_folding_int32_semantics():
+    yield check_folding_expression, '2147483647 + 1', st.Num('-2147483648')
+    yield check_folding_expression, '65536 * 65536', st.Num('0')
+    yield check_folding_expression, '-7 / 2', st.Num('-3')
+    yield check_folding_expression, '7 / -2', st.Num('-3')
+    
+def test_folding_float32_semantics():
+    yield check_folding_expression, '0.1 + 0.2', st.Num('0.30000001192092896')
+    yield check_folding_expression, '16777217 + 0.0', st.Num('16777216.0')
+    yield check_folding_expression, '100000.0 * 100000.0', st.Num('10000000000.0')
+    
+def test_folding_skips_runtime_errors():
+    for src in ('1 / 0', '1.0 / 0.0', '2 & true', '3 | false'):
+        yield check_folding_expression, src, parse_ex(src)
+
+# Each case is (C type, left operand, operator, right operand). The same
+# expression is folded and compiled with gcc, and the results are compared.
+GCC_BINARY_CASES = [
+    ('int', '2147483647', '+', '1'),
+    ('int', '-2147483647', '-', '2'),
+    ('int', '123456789', '*', '987'),
+    ('int', '-7', '/', '2'),
+    ('int', '7', '/', '-2'),
+    ('int', '-7', '/', '-2'),
+    ('int', '12', '&', '10'),
+    ('int', '12', '|', '3'),
+    ('int', '-1', '<', '0'),
+    ('int', '3', '>=', '3'),
+    ('int', '5', '!=', '5'),
+    ('float', '0.1', '+', '0.2'),
+    ('float', '1.0', '/', '3.0'),
+    ('float', '16777217', '+', '0.0'),
+    ('float', '0.1', '*', '3'),
+    ('float', '1.5', '<', '1.4999999'),
+    ('float', '100000.0', '*', '100000.0'),
+    ('float', '0.0', '-', '0.7'),
+    ('bool', 'true', '&', 'false'),
+    ('bool', 'true', '|', 'false'),
+    ('bool', 'false', '<', 'true'),
+]
+
+GCC_UNARY_CASES = [
+    ('int', 'not', '5'),
+    ('int', '-', '2147483647'),
+    ('float', '-', '0.1'),
+    ('bool', 'not', 'true'),
+]
+
+C_UNARY_OPERATORS = {'not': '~', '-': '-'}
+COMPARISON_OPERATORS = ('<', '<=', '>', '>=', '==', '!=')
+
+def c_case(c_type, op, operands):
+    '''Return a block of C that evaluates an operator and prints the result.'''
+    if c_type == 'bool':
+        c_type = 'int'
+        operands = [{'true': '1', 'false': '0'}[o] for o in operands]
+    if c_type == 'float' and op not in COMPARISON_OPERATORS:
+        result_type, format = 'float', '%.9g'
+    else:
+        result_type, format = 'int', '%d'
+    if len(operands) == 1:
+        expression = '%sa' % op
+    else:
+        expression = 'a %s b' % op
+    decls = ' '.join('volatile %s %s = %s;' % (c_type, name, value)
+                     for name, value in zip('ab', operands))
+    return '    { %s %s r = %s; printf("%s\\n", r); }' % (
+        decls, result_type, expression, format)
+
+def format_folded(node):
+    if node.n in (tokens.TRUE, tokens.FALSE):
+        return str(int(node.n == tokens.TRUE))
+    if '.' in node.n:
+        return '%.9g' % float(node.n)
+    return node.n
+
+def run_c_cases(lines):
+    tempdir = tempfile.mkdtemp()
+    try:
+        c_file = os.path.join(tempdir, 'folding.c')
+        executable = os.path.join(tempdir, 'folding')
+        with open(c_file, 'w') as f:
+            f.write('#include <stdio.h>\nint main() {\n%s\n    return 0;\n}\n' %
+                    '\n'.join(lines))
+        try:
+            subprocess.check_call(['gcc', '-fwrapv', '-o', executable, c_file])
+        except (OSError, subprocess.CalledProcessError):
+            raise SkipTest('gcc is not available')
+        return subprocess.check_output([executable]).splitlines()
+    finally:
+        shutil.rmtree(tempdir)
+
+def check_folding_against_gcc(src, expected):
+    got = fold_ex(src)
+    print 'Source:  ', src
+    print 'gcc:     ', expected
+    print 'Got:     ', got
+    assert isinstance(got, st.Num)
+    assert format_folded(got) == expected
+
+def test_folding_against_gcc():
+    sources = []
+    lines = []
+    for c_type, left, op, right in GCC_BINARY_CASES:
+        sources.append('%s %s %s' % (left, op, right))
+        if c_type == 'bool' and op in (tokens.AND, tokens.OR):
+            c_op = op * 2
+        else:
+            c_op = op
+        lines.append(c_case(c_type, c_op, [left, right]))
+    for c_type, op, operand in GCC_UNARY_CASES:
+        sources.append('%s %s' % (op, operand))
+        c_op = '!' if c_type == 'bool' else C_UNARY_OPERATORS[op]
+        lines.append(c_case(c_type, c_op, [operand]))
+    
+    results = run_c_cases(lines)
+    assert len(results) == len(sources)
+    for src, expected in zip(sources, results):
+        yield check_folding_against_gcc, src, expected
+    
+# -- AlgebraicSimplifier tests --
+
+def simplify_ex(exp, rules=optimizer.SIMPLIFICATION_RULES + optimizer.STRENGTH_REDUCTION_RULES):
+    ast = get_parser(exp).expression()
+    checker = typechecker.Checker()
+    for name, type in (('x', 'int'), ('y', 'int'), ('f', 'float'), ('b', 'bool')):
+        checker.define_variable(st.Name(name), st.VarDecl(False, type, st.Name(name), None))
+    checker.get_type(ast)
+    simplifier = optimizer.AlgebraicSimplifier(rules)
+    return simplifier.walk(ast), simplifier.hits
+    
+def check_simplification(src, expected, rule):
+    got, hits = simplify_ex(src)
+    print 'Source:  ', src
+    print 'Expected:', expected
+    print 'Got:     ', got
+    print 'Hits:    ', dict(hits)
+    assert expected == got
+    assert hits[rule] > 0
+    
+def test_simplification_rules():
+    x = st.Name('x')
+    for src, expected, rule in (
+        ('x + 0', x, 'add-zero'),
+        ('0 + x', x, 'add-zero'),
+        ('x - 0', x, 'subtract-zero'),
+        ('f - 0', st.Name('f'), 'subtract-zero'),
+        ('(x + y) - (x + y)', st.Num('0'), 'subtract-self'),
+        ('0 - x', st.UnaryOp('-', x), 'subtract-from-zero'),
+        ('x * 1', x, 'multiply-one'),
+        ('x / 1', x, 'multiply-one'),
+        ('f * 1.0', st.Name('f'), 'multiply-one'),
+        ('0 * x', st.Num('0'), 'multiply-zero'),
+        ('x * -1', st.UnaryOp('-', x), 'multiply-minus-one'),
+        ('x & -1', x, 'masks'),
+        ('x | 0', x, 'masks'),
+        ('x & 0', st.Num('0'), 'masks'),
+        ('x | x', x, 'masks'),
+        ('-(-x)', x, 'double-negation'),
+        ('not (not x)', x, 'double-negation'),
+        ('not (not (x < y))', st.BinaryOp('<', x, st.Name('y')), 'double-negation'),
+        ('(x + 1) + 2', st.BinaryOp('+', x, st.Num('3')), 'reassociate'),
+        ('(x - 1) - 2', st.BinaryOp('-', x, st.Num('3')), 'reassociate'),
+        ('2 + (x - 2)', x, 'reassociate'),
+        ('(x * 3) * 5', st.BinaryOp('*', x, st.Num('15')), 'reassociate'),
+        ('(x & 12) & 10', st.BinaryOp('&', x, st.Num('8')), 'reassociate'),
+        ('x * 8', st.BinaryOp('<<', x, st.Num('3')), 'multiply-power-of-two'),
+        ('4 * x', st.BinaryOp('<<', x, st.Num('2')), 'multiply-power-of-two'),
+    ):
+        yield check_simplification, src, expected, rule
+        
+def test_simplification_preserves_semantics():
+    # Adding zero to a float would turn negative zero positive, x / -1 traps
+    # when x is the smallest int, and removing boolean operators would skip the
+    # checks of their operands.
+    for src in ('f + 0', 'f * 0', 'f - f', 'x / -1', '(x / 2) * 2', 'b & true',
+                'not (not b)'):
+        got, hits = simplify_ex(src, optimizer.SIMPLIFICATION_RULES)
+        assert got == simplify_ex(src, [])[0]
+        assert not hits
+    
+def test_signed_division_by_power_of_two():
+    got, hits = simplify_ex('x / 8')
+    assert hits['divide-power-of-two'] == 1
+    assert got.op == '>>' and got.right == st.Num('3')
+    # The shift is only exact after negative dividends are rounded up.
+    for x in (-9, -8, -7, -1, 0, 1, 7, 8, 9, -2**31, 2**31 - 1):
+        assert (x + ((x >> 31) & 7)) >> 3 == optimizer.c_divide(x, 8)
+    # Other dividends would be evaluated twice.
+    got, hits = simplify_ex('(x + y) / 8')
+    assert got.op == '/' and not hits
+    
 # -- ConstantPropagator tests--
 
 def check_propagation(src, expected_body):
@@ -268,6 +468,169 @@ def test_increment_in_loop():
 
     check_propagation(src, expected_body)
     
+def test_array_element_propagation():
+    src = '''
+    program test_program is
+        int a[4];
+        int i;
+        int j;
+        int b;
+    begin
+        i := 1;
+        a[0] := 2;
+        a[i] := 3;
+        b := a[0] + a[1];
+        a[j] := 4;
+        b := a[0];
+    end program
+    '''
+    expected_body = [
+        Assign(Name('i'), Num('1')),
+        Assign(Subscript(Name('a'), Num('0')), Num('2')),
+        Assign(Subscript(Name('a'), Num('1')), Num('3')),
+        Assign(Name('b'), Num('5')),
+        # The index isn't known, so any element might have changed.
+        Assign(Subscript(Name('a'), Name('j')), Num('4')),
+        Assign(Name('b'), Subscript(Name('a'), Num('0')))]
+    check_propagation(src, expected_body)
+    
+def test_array_budget():
+    src = '''
+    program test_program is
+        int a[4];
+        int b;
+    begin
+        a[0] := 1;
+        a[1] := 2;
+        a[0] := 3;
+        b := a[0];
+        b := a[1];
+    end program
+    '''
+    # Only one element is tracked, so a[1] is forgotten until a[0] is
+    # reassigned.
+    got = optimizer.ConstantPropagator(array_budget=1).walk(parse_prog(src))
+    assert got.body[3:] == [Assign(Name('b'), Num('3')),
+                            Assign(Name('b'), Subscript(Name('a'), Num('1')))]
+    
+def test_arrays_passed_after_element_stores():
+    src = '''
+    program test_program is
+        int arr[4];
+        procedure show(int x[4] in, int i in)
+        begin
+            putInteger(x[i]);
+        end procedure;
+    begin
+        arr[2] := 7;
+        show(arr, 1);
+    end program
+    '''
+    # The value of arr[2] isn't the value of arr.
+    got = optimizer.ConstantPropagator().walk(parse_prog(src, True))
+    assert got.body[-1] == Call(Name('show'), [Name('arr'), Num('1')])
+    got = optimize_prog(src, inline_size=0)
+    assert got.body[-1].args[0] == Name('arr')
+    
+def test_arrays_passed_to_in_parameters_can_be_written():
+    src = '''
+    program test_program is
+        int arr[4];
+        global procedure set(int a[4] out)
+        begin
+            a[1] := 42;
+        end procedure;
+        global procedure mid(int b[4] in)
+        begin
+            set(b);
+        end procedure;
+    begin
+        arr[1] := 7;
+        mid(arr);
+        putInteger(arr[1]);
+    end program
+    '''
+    # mid passes its in array on to set's out parameter.
+    read = Call(Name('putInteger'), [Subscript(Name('arr'), Num('1'))])
+    for call_graph in [False, True]:
+        ast = parse_prog(src, True)
+        propagator = optimizer.ConstantPropagator(
+            call_graph=callgraph.CallGraph(ast) if call_graph else None)
+        assert propagator.walk(ast).body[-1] == read
+    got = optimizer.optimize_procedures(parse_prog(src, True),
+                                        pipeline=optimizer.parse_pipeline('propagate'))
+    assert got.body[-1] == read
+    
+# -- ScalarReplacer tests --
+
+def replace_scalars(src, max_length=optimizer.DEFAULT_ARRAY_BUDGET):
+    ast = parse_prog(src)
+    replacer = optimizer.ScalarReplacer(max_length)
+    replacer.walk_procedure(ast, ast)
+    return ast, replacer.modified_tree
+
+def test_small_arrays_are_replaced():
+    src = '''
+    program test_program is
+        int a[4];
+        float b[2];
+        int c;
+    begin
+        a[0] := 1;
+        a[2] := a[0] + 1;
+        b[1] := 2.0;
+        c := a[2];
+    end program
+    '''
+    ast, modified = replace_scalars(src)
+    assert modified
+    assert ast.decls == [VarDecl(False, 'int', Name('a.0'), None),
+                         VarDecl(False, 'int', Name('a.2'), None),
+                         VarDecl(False, 'float', Name('b.1'), None),
+                         VarDecl(False, 'int', Name('c'), None)]
+    assert ast.body == [Assign(Name('a.0'), Num('1')),
+                        Assign(Name('a.2'), BinaryOp('+', Name('a.0'), Num('1'))),
+                        Assign(Name('b.1'), Num('2.0')),
+                        Assign(Name('c'), Name('a.2'))]
+    
+def test_arrays_that_cant_be_replaced():
+    src = '''
+    program test_program is
+        int a[2];
+        int b[2];
+        int c[2];
+        int d[20];
+        int i;
+        procedure f(int x[2] in)
+        begin
+        end procedure;
+    begin
+        a[i] := 1;
+        b[2] := 1;
+        f(c);
+        d[0] := 1;
+    end program
+    '''
+    ast, modified = replace_scalars(src)
+    assert not modified
+    
+def test_scalar_replacement_after_propagation():
+    src = '''
+    program test_program is
+        int table[3];
+        int i;
+    begin
+        i := 0;
+        for (i := i + 1; i < 3)
+            table[i] := i * i;
+        end for;
+        putInteger(table[2]);
+    end program
+    '''
+    # Unrolling the loop makes every index a constant.
+    got = optimize_prog(src)
+    assert got.body == [Call(Name('putInteger'), [Num('4')])]
+    
 # -- DeadCodeEliminator tests --
 
 def check_elimination(src, expected_program):
@@ -560,6 +923,448 @@ def test_assignment_to_out_param():
     
     check_elimination(src, expected_program)
     
+def check_no_elimination(src):
+    got = optimizer.DeadCodeEliminator().walk(parse_prog(src, True))
+    expected = parse_prog(src, True)
+    assert got.body == expected.body
+    assert got.decls == [d for d in expected.decls
+                         if d not in parser.RUNTIME_DEFINITIONS or d in got.decls]
+    
+def test_assignment_read_by_later_assignment():
+    src = '''
+    program test_program is
+        int a;
+        int b;
+    begin
+        a := 1;
+        b := a + 1;
+        putInteger(b);
+    end program
+    '''
+    check_no_elimination(src)
+    
+def test_assignments_in_both_branches():
+    src = '''
+    program test_program is
+        int a;
+        int b;
+    begin
+        getInteger(a);
+        if (a > 3) then
+            b := 1;
+        else
+            b := 2;
+        end if;
+        putInteger(b);
+    end program
+    '''
+    check_no_elimination(src)
+    
+def test_loop_carried_assignment():
+    src = '''
+    program test_program is
+        int i;
+        int s;
+        int prev;
+    begin
+        s := 0;
+        prev := 0;
+        i := 0;
+        for(i := i + 1; i < 5)
+            s := s + prev;
+            prev := i;
+        end for;
+        putInteger(s);
+    end program
+    '''
+    check_no_elimination(src)
+    
+def test_out_argument_doesnt_kill_assignment():
+    # f might not write to its parameter, so the first assignment to a can
+    # still reach the put.
+    src = '''
+    program test_program is
+        int a;
+        procedure f(int x out)
+        begin
+            if (false) then
+                x := 1;
+            end if;
+        end procedure;
+    begin
+        a := 2;
+        f(a);
+        putInteger(a);
+    end program
+    '''
+    got = optimizer.DeadCodeEliminator().walk(parse_prog(src, True))
+    assert got.body[0] == Assign(Name('a'), Num('2'))
+    
+def test_global_assignment_in_procedure():
+    src = '''
+    program test_program is
+        global int g;
+        procedure f(int x in)
+        begin
+            g := x;
+        end procedure;
+    begin
+        f(1);
+        putInteger(g);
+    end program
+    '''
+    check_no_elimination(src)
+    
+# -- DeadStoreEliminator tests --
+
+def eliminate_stores(src, name):
+    ast = parse_prog(src, True)
+    procedure = find_procedure(ast, name)
+    optimizer.DeadStoreEliminator().walk_procedure(procedure, ast)
+    return procedure.body
+
+def test_overwritten_array_stores():
+    src = '''
+    program test_program is
+        global procedure f(int i in)
+            int a[8];
+        begin
+            a[i] := 1;
+            a[i + 1] := 2;
+            a[3] := 3;
+            a[i] := 4;
+            a[3] := 5;
+            putInteger(a[i]);
+            putInteger(a[i + 1]);
+            a[i] := 6;
+        end procedure;
+    begin
+        f(1);
+    end program
+    '''
+    body = eliminate_stores(src, 'f')
+    # a[3] might be the same element as a[i] or a[i + 1], so its stores stay.
+    assert [s.value for s in body if isinstance(s, Assign)] == [
+        Num('2'), Num('3'), Num('4'), Num('5')]
+    
+def test_stores_live_at_exit():
+    src = '''
+    program test_program is
+        global int g;
+        global procedure f(int x out)
+            int y;
+        begin
+            g := 1;
+            x := 1;
+            y := 1;
+            putInteger(1);
+            g := 2;
+            x := 2;
+            y := 2;
+        end procedure;
+        global procedure h(int z in)
+        begin
+            putInteger(g);
+        end procedure;
+        global procedure k(int x out)
+        begin
+            g := 3;
+            h(0);
+            g := 4;
+            x := 3;
+            getInteger(x);
+        end procedure;
+    begin
+        k(g);
+    end program
+    '''
+    body = eliminate_stores(src, 'f')
+    assert body[1:] == [Assign(Name('g'), Num('2')), Assign(Name('x'), Num('2'))]
+    body = eliminate_stores(src, 'k')
+    assert [s.value for s in body if isinstance(s, Assign)] == [Num('3'), Num('4')]
+
+# -- CopyPropagator tests --
+
+def propagate_copies(src, name=None, call_graph=False):
+    ast = parse_prog(src, True)
+    procedure = ast if name is None else find_procedure(ast, name)
+    graph = callgraph.CallGraph(ast) if call_graph else None
+    propagator = optimizer.CopyPropagator(graph)
+    propagator.walk_procedure(procedure, ast)
+    return procedure.body, propagator.modified_tree
+
+def test_copy_chains():
+    src = '''
+    program test_program is
+        int n;
+        int a;
+        int b;
+        int c;
+        float x;
+    begin
+        getInteger(n);
+        a := n;
+        b := a;
+        c := b + a;
+        putInteger(c);
+        x := n;
+        putFloat(x);
+        n := 1;
+        putInteger(b);
+    end program
+    '''
+    body, modified = propagate_copies(src)
+    assert modified
+    # The copies are left for the dead store eliminator. The float isn't a
+    # copy of the int, and the copies of n are killed when it changes.
+    assert body[2:5] == [Assign(Name('b'), Name('n')),
+                         Assign(Name('c'), BinaryOp('+', Name('n'), Name('n'))),
+                         Call(Name('putInteger'), [Name('c')])]
+    assert body[6] == Call(Name('putFloat'), [Name('x')])
+    assert body[8] == Call(Name('putInteger'), [Name('b')])
+
+def test_copies_in_branches_and_loops():
+    src = '''
+    program test_program is
+        int n;
+        int a;
+        int b;
+        int i;
+        int arr[4];
+    begin
+        getInteger(n);
+        a := n;
+        if (a > 0) then
+            b := a;
+            putInteger(b);
+        else
+            b := 0;
+        end if;
+        putInteger(b);
+        b := a;
+        i := 0;
+        for (i := i + 1; i < a)
+            arr[b] := i;
+            putInteger(b);
+            n := n + 1;
+        end for;
+    end program
+    '''
+    body, modified = propagate_copies(src)
+    assert modified
+    branch = body[2]
+    assert branch.test == BinaryOp('>', Name('n'), Num('0'))
+    assert branch.body[1] == Call(Name('putInteger'), [Name('n')])
+    # b only holds a copy on one of the paths to the join.
+    assert body[3] == Call(Name('putInteger'), [Name('b')])
+    # n changes in the loop, but a doesn't.
+    loop = body[6]
+    assert loop.test == BinaryOp('<', Name('i'), Name('a'))
+    assert loop.body[:2] == [Assign(Subscript(Name('arr'), Name('a')), Name('i')),
+                             Call(Name('putInteger'), [Name('a')])]
+
+def test_calls_kill_copies():
+    src = '''
+    program test_program is
+        global int g;
+        global procedure f(int y out)
+            int t;
+        begin
+            t := g;
+            h(1);
+            putInteger(t);
+            t := g;
+            k(1);
+            putInteger(t);
+            getInteger(y);
+            putInteger(t);
+        end procedure;
+        global procedure h(int x in)
+        begin
+            g := x;
+        end procedure;
+        global procedure k(int x in)
+        begin
+            putInteger(x);
+        end procedure;
+    begin
+        f(g);
+    end program
+    '''
+    body, modified = propagate_copies(src, 'f')
+    # Without a call graph, every call might write to the globals, and y might
+    # be an alias of one of them.
+    assert not modified
+    body, modified = propagate_copies(src, 'f', call_graph=True)
+    assert modified
+    # h writes to g, and getInteger writes to y, which might be g.
+    assert body[2] == Call(Name('putInteger'), [Name('t')])
+    assert body[5] == Call(Name('putInteger'), [Name('g')])
+    assert body[7] == Call(Name('putInteger'), [Name('t')])
+
+def test_calls_in_the_program_kill_copies_of_globals():
+    src = '''
+    program test_program is
+        global int g;
+        int x;
+        global procedure bump(int n in)
+        begin
+            g := n;
+        end procedure;
+        global procedure show(int n in)
+        begin
+            putInteger(n);
+        end procedure;
+    begin
+        g := 1;
+        x := g;
+        bump(5);
+        putInteger(x);
+        x := g;
+        show(2);
+        putInteger(x);
+    end program
+    '''
+    for call_graph in [False, True]:
+        body, modified = propagate_copies(src, call_graph=call_graph)
+        assert body[3] == Call(Name('putInteger'), [Name('x')])
+    # show doesn't write to g.
+    assert body[6] == Call(Name('putInteger'), [Name('g')])
+
+def test_copy_pipeline():
+    src = '''
+    program test_program is
+        global int g;
+        global procedure f(int x in, int y out)
+            int t;
+        begin
+            t := x;
+            g := t;
+            y := g;
+        end procedure;
+        int a;
+    begin
+        f(1, a);
+        putInteger(a);
+    end program
+    '''
+    ast = parse_prog(src, True)
+    optimizer.optimize_procedures(ast, pipeline=['copy', 'dse'])
+    assert find_procedure(ast, 'f').body == [Assign(Name('g'), Name('x')),
+                                             Assign(Name('y'), Name('x'))]
+
+# -- IfConverter tests --
+
+def convert_ifs(src, max_cost=optimizer.MAX_SPECULATED_COST):
+    ast = parse_prog(src, True)
+    converter = optimizer.IfConverter(max_cost)
+    converter.walk_procedure(ast, ast)
+    return ast.body, converter.modified_tree
+
+def test_small_ifs_become_selects():
+    src = '''
+    program test_program is
+        int x;
+        int m;
+        int n;
+        bool b;
+    begin
+        getInteger(x);
+        if (x < m) then m := x; else m := 0 - x; end if;
+        if (x > 5) then n := n + x * 2; end if;
+        if (x == 3) then b := true; end if;
+        for (x := x + 1; x < 10)
+            if (x > m) then m := x; end if;
+        end for;
+    end program
+    '''
+    body, modified = convert_ifs(src)
+    assert modified
+    assert body[1] == Assign(Name('m'), Select(BinaryOp('<', Name('x'), Name('m')), Name('x'),
+                                               BinaryOp('-', Num('0'), Name('x'))))
+    assert body[1].value.node_type == tokens.INT
+    # A missing branch keeps the variable's value.
+    assert body[2] == Assign(Name('n'), Select(BinaryOp('>', Name('x'), Num('5')),
+                                               BinaryOp('+', Name('n'),
+                                                        BinaryOp('*', Name('x'), Num('2'))),
+                                               Name('n')))
+    assert body[3] == Assign(Name('b'), Select(BinaryOp('==', Name('x'), Num('3')), Num('true'),
+                                               Name('b')))
+    assert body[3].value.node_type == tokens.BOOL
+    assert body[4].body == [Assign(Name('m'), Select(BinaryOp('>', Name('x'), Name('m')),
+                                                     Name('x'), Name('m')))]
+
+def test_nested_ifs_become_selects():
+    src = '''
+    program test_program is
+        int x;
+        int m;
+    begin
+        getInteger(x);
+        if (x < 0) then
+            if (x < (0 - 10)) then m := 0 - 10; else m := x; end if;
+        else
+            m := 0;
+        end if;
+    end program
+    '''
+    body, modified = convert_ifs(src)
+    assert modified
+    inner = Select(BinaryOp('<', Name('x'), BinaryOp('-', Num('0'), Num('10'))),
+                   BinaryOp('-', Num('0'), Num('10')), Name('x'))
+    assert body[1] == Assign(Name('m'), Select(BinaryOp('<', Name('x'), Num('0')), inner,
+                                               Num('0')))
+
+def test_ifs_that_arent_converted():
+    src = '''
+    program test_program is
+        int x;
+        int m;
+        int n;
+        float f;
+        bool b;
+        int a[4];
+    begin
+        getInteger(x);
+        if (x > 0) then m := n / x; end if;
+        if (x > 0) then m := a[x]; end if;
+        if (x > 0) then b := b & true; end if;
+        if (x > 0) then m := x; n := x; end if;
+        if (x > 0) then m := x; else n := x; end if;
+        if (x > 0) then f := 1.5; end if;
+        if (x > 0) then putInteger(x); end if;
+        if (x > 0) then a[0] := x; end if;
+        if (x > 0) then m := x * x * x; else m := x * x; end if;
+    end program
+    '''
+    body, modified = convert_ifs(src)
+    # Division by a variable might trap, the index might be out of bounds, and
+    # boolean operators check their operands. The last If is too costly.
+    assert not modified
+    assert all(isinstance(statement, If) for statement in body[1:])
+    body, modified = convert_ifs(src, max_cost=20)
+    assert modified
+    assert isinstance(body[-1].value, Select)
+
+def test_if_conversion_pipeline():
+    src = '''
+    program test_program is
+        int x;
+        int m;
+    begin
+        getInteger(x);
+        m := 7;
+        if (x < m) then m := x; end if;
+        putInteger(m);
+    end program
+    '''
+    ast = parse_prog(src, True)
+    optimizer.optimize_procedures(ast)
+    # Ifs are converted after the other passes, so m's value isn't propagated
+    # into the Select.
+    assert ast.body[1:3] == [Assign(Name('m'), Num('7')),
+                             Assign(Name('m'), Select(BinaryOp('<', Name('x'), Num('7')),
+                                                      Name('x'), Name('m')))]
 
 # -- Functional tests --
 
@@ -694,9 +1499,9 @@ def test_O1():
           Assign(
             target=Name('c'),
             value=BinaryOp(
-              op='*',
+              op='<<',
               left=Name('b'),
-              right=Num('4'))),
+              right=Num('2'))),
           If(
             test=BinaryOp(
               op='>',
@@ -731,4 +1536,1006 @@ def test_O2():
     
 
     
+    
+# -- Fixed-point driver tests --
 
+def optimize_prog(src, max_iterations=optimizer.DEFAULT_ITERATION_BUDGET,
+                  unroll_factor=optimizer.DEFAULT_UNROLL_FACTOR,
+                  inline_size=optimizer.DEFAULT_INLINE_SIZE):
+    return optimizer.optimize_procedures(parse_prog(src, True), max_iterations,
+                                         unroll_factor=unroll_factor,
+                                         inline_size=inline_size)
+
+def test_propagation_chain():
+    src = '''
+    program test_program is
+        int a;
+        int b;
+        int c;
+    begin
+        a := 1;
+        b := a + 1;
+        c := b * 3;
+        putInteger(c);
+    end program
+    '''
+    got = optimize_prog(src)
+    assert [d.name for d in got.decls] == [Name('putInteger')]
+    assert got.body == [Call(Name('putInteger'), [Num('6')])]
+    
+def test_unreachable_procedures():
+    src = '''
+    program test_program is
+        procedure f(int x in)
+            procedure h(int y in)
+            begin
+                h(y);
+            end procedure;
+        begin
+            h(x);
+        end procedure;
+    begin
+    end program
+    '''
+    assert optimize_prog(src).decls == []
+    
+def test_unwritten_out_param_summary():
+    # f never writes to x, so its value is propagated past the call.
+    src = '''
+    program test_program is
+        int a;
+        procedure f(int x out)
+        begin
+        end procedure;
+    begin
+        a := 2;
+        f(a);
+        putInteger(a);
+    end program
+    '''
+    got = optimize_prog(src)
+    assert got.body[-1] == Call(Name('putInteger'), [Num('2')])
+    
+def test_global_assigned_in_procedure():
+    src = '''
+    program test_program is
+        global int g;
+        global int unused;
+        procedure f(int x in)
+        begin
+            g := x;
+        end procedure;
+    begin
+        f(1);
+        putInteger(g);
+    end program
+    '''
+    got = optimize_prog(src, inline_size=0)
+    assert [d.name for d in got.decls] == [Name('putInteger'), Name('g'), Name('f')]
+    assert got.decls[2].body == [Assign(Name('g'), Name('x'))]
+    
+def test_globals_summary():
+    # f writes to h and reads g, so only h is invalidated by the calls, and h
+    # is overwritten before it's read again. f might not write to h, so the
+    # last store to it stays.
+    src = '''
+    program test_program is
+        global int g;
+        global int h;
+        procedure f(int x in)
+        begin
+            h := g + x;
+        end procedure;
+    begin
+        g := 1;
+        h := 2;
+        g := 3;
+        f(1);
+        putInteger(g);
+        h := 4;
+        f(2);
+        putInteger(h);
+    end program
+    '''
+    got = optimize_prog(src, inline_size=0)
+    assert got.body == [Assign(Name('g'), Num('3')),
+                        Call(Name('f'), [Num('1')]),
+                        Call(Name('putInteger'), [Num('3')]),
+                        Assign(Name('h'), Num('4')),
+                        Call(Name('f'), [Num('2')]),
+                        Call(Name('putInteger'), [Name('h')])]
+    
+def test_iteration_budget():
+    src = '''
+    program test_program is
+        int a;
+    begin
+        a := 1;
+        putInteger(a);
+    end program
+    '''
+    assert optimize_prog(src, max_iterations=0).body == parse_prog(src, True).body
+    assert optimize_prog(src, max_iterations=1).body != parse_prog(src, True).body
+    
+def test_ssa_propagation_through_branches():
+    # The tree passes forget everything assigned in a branch, but both
+    # definitions of b reaching the call are the same constant.
+    src = '''
+    program test_program is
+        int a;
+        int b;
+    begin
+        getInteger(a);
+        if (a < 1) then
+            b := 1;
+        else
+            b := 1;
+        end if;
+        putInteger(b + 1);
+    end program
+    '''
+    got = optimize_prog(src)
+    assert got.body[-1] == Call(Name('putInteger'), [Num('2')])
+    assert Name('b') not in [d.name for d in got.decls]
+    
+def test_constant_branch_is_pruned():
+    src = '''
+    program test_program is
+        int debug;
+        int a;
+        int b;
+    begin
+        debug := 0;
+        getInteger(a);
+        if (debug == 1) then
+            putInteger(a);
+            b := 7;
+        else
+            b := 3;
+        end if;
+        putInteger(b);
+    end program
+    '''
+    got = optimize_prog(src)
+    assert got.body == [Call(Name('getInteger'), [Name('a')]),
+                        Call(Name('putInteger'), [Num('3')])]
+    
+def test_constant_through_loop():
+    # The branch in the loop is never taken, so b is still 0 after the loop.
+    src = '''
+    program test_program is
+        int debug;
+        int b;
+        int i;
+    begin
+        debug := 0;
+        b := 0;
+        i := 0;
+        for (i := i + 1; i < 10)
+            if (debug > 0) then
+                b := b + 1;
+            end if;
+        end for;
+        putInteger(b);
+    end program
+    '''
+    got = optimize_prog(src)
+    assert got.body[-1] == Call(Name('putInteger'), [Num('0')])
+    assert Name('debug') not in [d.name for d in got.decls]
+    
+def test_loop_that_never_runs():
+    src = '''
+    program test_program is
+        int i;
+    begin
+        i := 5;
+        for (i := i + 1; i < 3)
+            putInteger(i);
+        end for;
+    end program
+    '''
+    assert optimize_prog(src).body == []
+    
+def test_bool_literal_tests_are_pruned():
+    src = '''
+    program test_program is
+        int i;
+    begin
+        if (true) then
+            putInteger(1);
+        else
+            putInteger(2);
+        end if;
+        for (i := i; false)
+            putInteger(3);
+        end for;
+    end program
+    '''
+    got = optimizer.DeadCodeEliminator().walk(parse_prog(src, True))
+    assert got.body == [Call(Name('putInteger'), [Num('1')])]
+    
+def find_procedure(program, name):
+    return next(d for d in program.decls if d.name == Name(name))
+    
+def test_common_subexpressions():
+    src = '''
+    program test_program is
+        global procedure f(int a in, int b in)
+            int x;
+        begin
+            x := (a + b) * 2;
+            if (a < b) then
+                putInteger(b + a);
+            end if;
+            putInteger(x);
+        end procedure;
+    begin
+        f(1, 2);
+        f(3, 4);
+    end program
+    '''
+    procedure = find_procedure(optimize_prog(src, inline_size=0), 'f')
+    temporary = procedure.decls[-1].name
+    assert procedure.body[:2] == [
+        Assign(temporary, BinaryOp('+', Name('a'), Name('b'))),
+        Assign(Name('x'), BinaryOp('<<', temporary, Num('1')))]
+    assert procedure.body[2].body == [Call(Name('putInteger'), [temporary])]
+    
+def test_repeated_array_reads():
+    src = '''
+    program test_program is
+        global procedure kernel(int array[4] in, int result[4] out, int n in)
+            int i;
+        begin
+            for (i := i + 1; i < n)
+                result[i] := array[i] * array[i];
+            end for;
+        end procedure;
+        int a[4];
+        int r[4];
+    begin
+        kernel(a, r, 4);
+    end program
+    '''
+    procedure = find_procedure(optimize_prog(src, inline_size=0), 'kernel')
+    temporary = procedure.decls[-1].name
+    read = Subscript(Name('array'), Name('i'))
+    assert procedure.body[0].body == [
+        Assign(temporary, read),
+        Assign(Subscript(Name('result'), Name('i')), BinaryOp('*', temporary, temporary))]
+    
+def test_stores_and_calls_kill_expressions():
+    src = '''
+    program test_program is
+        global procedure f(int a[2] out, int i in, int j in)
+            int x;
+        begin
+            putInteger(a[i] + 1);
+            a[j] := 5;
+            putInteger(a[i] + 1);
+            getInteger(x);
+            putInteger(a[i] + 1);
+        end procedure;
+        int a[2];
+    begin
+        f(a, 0, 1);
+        f(a, 1, 0);
+    end program
+    '''
+    procedure = find_procedure(optimize_prog(src, inline_size=0), 'f')
+    expression = BinaryOp('+', Subscript(Name('a'), Name('i')), Num('1'))
+    assert procedure.body[0::2] == [Call(Name('putInteger'), [expression])] * 3
+    
+def test_repeated_store_indexes():
+    src = '''
+    program test_program is
+        global procedure f(int x in)
+            int a[8];
+        begin
+            a[x + 1] := 1;
+            a[x + 1] := 2;
+            putInteger(a[x + 1]);
+        end procedure;
+    begin
+        f(1);
+        f(2);
+    end program
+    '''
+    procedure = find_procedure(optimize_prog(src, inline_size=0), 'f')
+    index = procedure.body[0].target
+    # The first store is overwritten, so it's removed as well.
+    assert procedure.body == [Assign(index, BinaryOp('+', Name('x'), Num('1'))),
+                              Assign(Subscript(Name('a'), index), Num('2')),
+                              Call(Name('putInteger'), [Subscript(Name('a'), index)])]
+    
+def test_loop_invariants_are_hoisted():
+    src = '''
+    program test_program is
+        global procedure f(int a[4] in, int n in, int k in)
+            int i;
+            int x;
+            int s;
+        begin
+            s := 0;
+            for (i := i + k * 2; i < n)
+                x := n * k;
+                s := s + a[i] * x + (n - k);
+            end for;
+            putInteger(s);
+        end procedure;
+        int a[4];
+    begin
+        f(a, 4, 1);
+        f(a, 3, 2);
+    end program
+    '''
+    procedure = find_procedure(optimize_prog(src), 'f')
+    loop = procedure.body[-2]
+    hoisted = procedure.body[1:-2]
+    assert [s.value for s in hoisted] == [
+        BinaryOp('*', Name('n'), Name('k')),
+        BinaryOp('-', Name('n'), Name('k')),
+        BinaryOp('<<', Name('k'), Num('1'))]
+    x, difference, step = [s.target for s in hoisted]
+    assert loop.assignment.value == BinaryOp('+', Name('i'), step)
+    assert loop.body == [
+        Assign(Name('s'), BinaryOp('+', BinaryOp('+', Name('s'),
+            BinaryOp('*', Subscript(Name('a'), Name('i')), x)), difference))]
+    
+def test_loop_variant_memory_isnt_hoisted():
+    src = '''
+    program test_program is
+        global int g;
+        global int a[4];
+        global procedure f()
+            int i;
+        begin
+            i := 0;
+            for (i := i + 1; i < 4)
+                putInteger(a[0] + g * 2);
+                getInteger(g);
+            end for;
+            i := 0;
+            for (i := i + 1; i < 4)
+                putInteger(a[1] + 1);
+                a[i & 3] := 0;
+            end for;
+        end procedure;
+    begin
+        f();
+    end program
+    '''
+    procedure = find_procedure(optimize_prog(src, unroll_factor=1, inline_size=0), 'f')
+    first, second = [s for s in procedure.body if isinstance(s, For)]
+    # Only the second loop stores to the array.
+    load = procedure.body[1]
+    assert load.value == Subscript(Name('a'), Num('0'))
+    assert first.body[0] == Call(Name('putInteger'), [
+        BinaryOp('+', load.target, BinaryOp('<<', Name('g'), Num('1')))])
+    assert second.body[0] == Call(Name('putInteger'), [
+        BinaryOp('+', Subscript(Name('a'), Num('1')), Num('1'))])
+    
+def test_loads_are_only_hoisted_from_loops_that_run():
+    src = '''
+    program test_program is
+        global procedure f(int a[4] in, int k in, int n in)
+            int i;
+        begin
+            i := 0;
+            for (i := i + 1; i < 4)
+                putInteger(a[k]);
+            end for;
+            for (i := i + 1; i < n)
+                putInteger(a[k + 1]);
+            end for;
+        end procedure;
+        int a[4];
+    begin
+        f(a, 0, 4);
+        f(a, 1, 3);
+    end program
+    '''
+    procedure = find_procedure(optimize_prog(src, unroll_factor=1), 'f')
+    assert procedure.body[1].value == Subscript(Name('a'), Name('k'))
+    first, second = [s for s in procedure.body if isinstance(s, For)]
+    assert first.body == [Call(Name('putInteger'), [procedure.body[1].target])]
+    # The index is still moved out of the second loop, but not the load.
+    assert isinstance(second.body[0].args[0], Subscript)
+    
+def test_induction_variable_products_are_reduced():
+    src = '''
+    program test_program is
+        global procedure f(int k in)
+            int j;
+            int s;
+        begin
+            s := 0;
+            j := 1;
+            for (j := j + 2; j < 8)
+                s := s + j * k;
+            end for;
+            putInteger(s);
+            putInteger(j);
+        end procedure;
+    begin
+        f(3);
+        f(5);
+    end program
+    '''
+    procedure = find_procedure(optimize_prog(src, unroll_factor=1), 'f')
+    loop = next(s for s in procedure.body if isinstance(s, For))
+    # j is still read after the loop, so it's kept.
+    assert loop.assignment == Assign(Name('j'), BinaryOp('+', Name('j'), Num('2')))
+    product, increment = loop.body
+    assert product.value.op == '+' and isinstance(product.value.right, Name)
+    reduced = product.value.right
+    step = increment.value.right
+    assert increment == Assign(reduced, BinaryOp('+', reduced, step))
+    # The new variable starts at 1 * k and goes up by 2 * k, which are
+    # simplified.
+    assert [s.value for s in procedure.body if isinstance(s, Assign) and
+            s.target in (reduced, step)] == [Name('k'), BinaryOp('<<', Name('k'), Num('1'))]
+    
+def test_induction_variable_is_eliminated():
+    src = '''
+    program test_program is
+        global procedure f(int a[16] in)
+            int i;
+            int s;
+        begin
+            s := 0;
+            i := 0;
+            for (i := i + 1; i < 8)
+                s := s + a[i * 2];
+            end for;
+            putInteger(s);
+        end procedure;
+        int a[16];
+    begin
+        f(a);
+    end program
+    '''
+    procedure = find_procedure(optimize_prog(src, unroll_factor=1, inline_size=0), 'f')
+    loop = next(s for s in procedure.body if isinstance(s, For))
+    offset = loop.assignment.target
+    assert loop.assignment == Assign(offset, BinaryOp('+', offset, Num('2')))
+    assert loop.test == BinaryOp('<', offset, Num('16'))
+    assert loop.body == [Assign(Name('s'), BinaryOp('+', Name('s'), Subscript(Name('a'), offset)))]
+    assert Name('i') not in [d.name for d in procedure.decls]
+    
+def test_induction_variable_with_unknown_bound_is_kept():
+    src = '''
+    program test_program is
+        global procedure f(int a[16] in, int n in)
+            int i;
+            int s;
+        begin
+            s := 0;
+            i := 0;
+            for (i := i + 1; i < n)
+                s := s + a[i * 2];
+            end for;
+            putInteger(s);
+        end procedure;
+        int a[16];
+    begin
+        f(a, 4);
+        f(a, 8);
+    end program
+    '''
+    procedure = find_procedure(optimize_prog(src), 'f')
+    loop = next(s for s in procedure.body if isinstance(s, For))
+    assert loop.test == BinaryOp('<', Name('i'), Name('n'))
+    offset = loop.body[1].target
+    assert loop.body == [
+        Assign(Name('s'), BinaryOp('+', Name('s'), Subscript(Name('a'), offset))),
+        Assign(offset, BinaryOp('+', offset, Num('2')))]
+    
+def test_constant_loop_is_fully_unrolled():
+    src = '''
+    program test_program is
+        int i;
+    begin
+        i := 0;
+        for (i := i + 1; i < 3)
+            putInteger(i * 2);
+        end for;
+    end program
+    '''
+    got = optimize_prog(src)
+    assert got.body == [Call(Name('putInteger'), [Num('0')]),
+                        Call(Name('putInteger'), [Num('2')]),
+                        Call(Name('putInteger'), [Num('4')])]
+    
+def test_loop_is_partially_unrolled():
+    src = '''
+    program test_program is
+        int a[16];
+        int i;
+    begin
+        i := 15;
+        for (i := i - 1; i >= 5)
+            a[i] := a[i - 1];
+        end for;
+    end program
+    '''
+    ast = parse_prog(src, True)
+    unroller = optimizer.LoopUnroller(factor=4)
+    unroller.walk_procedure(ast, ast)
+    assert unroller.modified_tree
+    original = parse_prog(src, True).body[1]
+    step = original.assignment
+    loop = ast.body[1]
+    # The loop runs 11 times, so the unrolled loop runs twice and the last 3
+    # iterations follow it.
+    assert loop.test == BinaryOp('>', Name('i'), Num('7'))
+    assert loop.assignment == step
+    assert loop.body == original.body + [step] + original.body + [step] + original.body + [step] + original.body
+    assert ast.body[2:] == 3 * (original.body + [step])
+    
+def test_loops_with_unknown_trip_counts_arent_unrolled():
+    src = '''
+    program test_program is
+        int i;
+        int n;
+    begin
+        getInteger(n);
+        i := 0;
+        for (i := i + 1; i < n)
+            putInteger(i);
+        end for;
+        getInteger(i);
+        for (i := i + 1; i < 3)
+            putInteger(i);
+        end for;
+        i := 0;
+        for (i := i + 1; i < 3)
+            i := i * 2;
+        end for;
+    end program
+    '''
+    ast = parse_prog(src, True)
+    unroller = optimizer.LoopUnroller()
+    unroller.walk_procedure(ast, ast)
+    assert not unroller.modified_tree
+    assert ast == parse_prog(src, True)
+    
+def make_profile(*entries):
+    '''Return a Profile with the count of each (kind, token, count) entry.'''
+    return profiling.Profile(collections.Counter(
+        dict(((kind,) + profiling.location(token), count) for kind, token, count in entries)))
+    
+def test_unrolling_with_profile():
+    src = '''
+    program test_program is
+        int a[16];
+        int i;
+    begin
+        i := 0;
+        for (i := i + 1; i < 3)
+            putInteger(i * 2);
+        end for;
+        i := 15;
+        for (i := i - 1; i >= 5)
+            a[i] := a[i - 1];
+        end for;
+    end program
+    '''
+    ast = parse_prog(src, True)
+    cold, hot = ast.body[1], ast.body[3]
+    profile = make_profile((profiling.ITERATION, cold.token, 0),
+                           (profiling.ITERATION, hot.token, 11))
+    unroller = optimizer.LoopUnroller(factor=4, profile=profile)
+    unroller.walk_procedure(ast, ast)
+    assert unroller.modified_tree
+    original = parse_prog(src, True).body[3]
+    step = original.assignment
+    # The loop that never ran is left alone, and the hot loop is unrolled
+    # five times instead of four, which leaves one iteration after it.
+    assert ast.body[1] == cold
+    loop = ast.body[3]
+    assert loop.test == BinaryOp('>', Name('i'), Num('5'))
+    assert loop.body == (original.body + [step]) * 4 + original.body
+    assert ast.body[4:] == original.body + [step]
+    
+def test_adjacent_loops_are_fused():
+    src = '''
+    program test_program is
+        int a[8];
+        int b[8];
+        int i;
+        int j;
+    begin
+        i := 0;
+        for (i := i + 1; i < 8)
+            a[i] := i;
+        end for;
+        j := 0;
+        for (j := j + 1; j < 8)
+            b[j] := a[j] * 2;
+        end for;
+        i := 0;
+        for (i := i + 1; i < 8)
+            putInteger(b[i]);
+        end for;
+    end program
+    '''
+    ast = parse_prog(src, True)
+    fuser = optimizer.LoopFuser()
+    fuser.walk_procedure(ast, ast)
+    assert fuser.modified_tree
+    first, second, third = [s for s in parse_prog(src, True).body if isinstance(s, For)]
+    assert ast.body == [
+        Assign(Name('i'), Num('0')),
+        Assign(Name('j'), Num('0')),
+        For(first.assignment, first.test,
+            first.body + second.body + [second.assignment] + third.body)]
+    
+def test_dependent_loops_arent_fused():
+    src = '''
+    program test_program is
+        int a[9];
+        int i;
+        int s;
+    begin
+        s := 0;
+        i := 0;
+        for (i := i + 1; i < 7)
+            a[i + 1] := i;
+        end for;
+        i := 0;
+        for (i := i + 1; i < 7)
+            s := s + a[i + 2];
+        end for;
+        i := 0;
+        for (i := i + 1; i < 7)
+            a[i] := s;
+        end for;
+        i := 0;
+        for (i := i + 1; i < 6)
+            putInteger(a[i]);
+        end for;
+        i := 0;
+        for (i := i + 1; i < 6)
+            putInteger(i);
+        end for;
+    end program
+    '''
+    ast = parse_prog(src, True)
+    fuser = optimizer.LoopFuser()
+    fuser.walk_procedure(ast, ast)
+    # Each loop reads something that the loop before it writes on a later
+    # iteration, has a different trip count, or makes calls like it.
+    assert not fuser.modified_tree
+    assert ast == parse_prog(src, True)
+    
+def test_loops_passing_arrays_to_in_parameters_arent_fused():
+    src = '''
+    program test_program is
+        int a[4];
+        int i;
+        int s;
+        global procedure set(int x[4] out, int k in)
+        begin
+            x[k] := 42;
+        end procedure;
+        global procedure mid(int y[4] in, int k in)
+        begin
+            set(y, k);
+        end procedure;
+    begin
+        s := 0;
+        i := 0;
+        for (i := i + 1; i < 4)
+            mid(a, 3 - i);
+        end for;
+        i := 0;
+        for (i := i + 1; i < 4)
+            s := s + a[i];
+        end for;
+        putInteger(s);
+    end program
+    '''
+    ast = parse_prog(src, True)
+    fuser = optimizer.LoopFuser()
+    fuser.walk_procedure(ast, ast)
+    # mid writes to a through set, so the second loop reads elements that
+    # the first one writes on later iterations.
+    assert not fuser.modified_tree
+    
+def inline_prog(src):
+    ast = parse_prog(src, True)
+    inliner = optimizer.Inliner(callgraph.CallGraph(ast))
+    inliner.walk_procedure(ast, ast)
+    return ast, inliner.modified_tree
+    
+def test_procedures_are_inlined():
+    src = '''
+    program test_program is
+        int b;
+        int c;
+        int arr[2];
+        global procedure f(int x in, int y out, int a[2] in)
+        begin
+            y := x + a[1];
+        end procedure;
+    begin
+        f(b + 1, c, arr);
+        f(b, c, arr);
+    end program
+    '''
+    ast, modified = inline_prog(src)
+    assert modified
+    # The expression passed by value is copied to a new variable, but the
+    # local variable can be used directly.
+    assert ast.body == [
+        Assign(Name('f.1.x'), BinaryOp('+', Name('b'), Num('1'))),
+        Assign(Name('c'), BinaryOp('+', Name('f.1.x'), Subscript(Name('arr'), Num('1')))),
+        Assign(Name('c'), BinaryOp('+', Name('b'), Subscript(Name('arr'), Num('1'))))]
+    assert ast.decls[-1] == VarDecl(False, 'int', Name('f.1.x'), None)
+    
+def test_returns_are_removed():
+    body = parse_prog('''
+    program test_program is
+        int n;
+        int r;
+    begin
+        if (n < 0) then
+            r := 1;
+            return;
+        end if;
+        if (n < 5) then
+            if (n == 2) then
+                return;
+            end if;
+            r := 2;
+        end if;
+        putInteger(n);
+    end program
+    ''', True).body
+    first, second, call = copy_tree(body)
+    nested = second.body[0]
+    # The call can't run after the nested return, so it's copied into both
+    # branches of the second If.
+    assert optimizer.remove_returns(body) == ([
+        If(first.test, first.body[:1], [
+            If(second.test, [If(nested.test, [], [second.body[1], call])], [call])])], False)
+    
+def test_inlining_with_profile():
+    src = '''
+    program test_program is
+        int b;
+        int c;
+        global procedure f(int x in, int y out)
+        begin
+            y := x + 1;
+        end procedure;
+        global procedure g(int x in, int y out)
+            int z;
+        begin
+            z := x;
+            z := z * x + 1;
+            z := z * x + 1;
+            z := z * x + 1;
+            z := z * x + 1;
+            z := z * x + 1;
+            z := z * x + 1;
+            y := z;
+        end procedure;
+    begin
+        f(b, c);
+        f(c, b);
+        g(b, c);
+        g(c, b);
+    end program
+    '''
+    ast, modified = inline_prog(src)
+    assert ast.body[2:] == parse_prog(src, True).body[2:]
+    ast = parse_prog(src, True)
+    calls = ast.body
+    profile = make_profile((profiling.CALL, calls[0].func.token, 0),
+                           (profiling.CALL, calls[1].func.token, 1),
+                           (profiling.CALL, calls[2].func.token, 100),
+                           (profiling.CALL, calls[3].func.token, 100))
+    inliner = optimizer.Inliner(callgraph.CallGraph(ast), profile=profile)
+    inliner.walk_procedure(ast, ast)
+    assert inliner.modified_tree
+    # The call that never ran isn't inlined, and g is too large to inline at
+    # both call sites without a profile, but they're hot.
+    assert ast.body[0] == Call(Name('f'), [Name('b'), Name('c')])
+    assert ast.body[1] == Assign(Name('b'), BinaryOp('+', Name('c'), Num('1')))
+    assert not any(isinstance(statement, Call) for statement in ast.body[1:])
+    
+def test_procedures_that_cant_be_inlined():
+    src = '''
+    program test_program is
+        global int g;
+        global procedure countdown(int n in)
+        begin
+            if (n > 0) then
+                countdown(n - 1);
+            end if;
+        end procedure;
+        global procedure outer(int n in)
+            procedure inner(int m in)
+            begin
+                putInteger(m);
+            end procedure;
+        begin
+            inner(n);
+        end procedure;
+        global procedure set(int x out)
+        begin
+            x := g + 1;
+        end procedure;
+        global procedure find(int a[3] in, int x out)
+            int i;
+        begin
+            i := 0;
+            for (i := i + 1; i < 3)
+                if (a[i] == 0) then
+                    x := i;
+                    return;
+                end if;
+            end for;
+        end procedure;
+        int a[3];
+        int x;
+    begin
+        countdown(3);
+        outer(2);
+        set(g);
+        find(a, x);
+    end program
+    '''
+    ast, modified = inline_prog(src)
+    assert not modified
+    assert ast == parse_prog(src, True)
+    
+def test_tail_recursion_becomes_loop():
+    src = '''
+    program test_program is
+        int r;
+        global procedure f(int n in, int acc in, int result out)
+        begin
+            if (n < 2) then
+                result := acc;
+                return;
+            end if;
+            f(n - 1, acc * n, result);
+        end procedure;
+    begin
+        f(5, 1, r);
+    end program
+    '''
+    ast = parse_prog(src, True)
+    procedure = find_procedure(ast, 'f')
+    eliminator = optimizer.TailRecursionEliminator(callgraph.CallGraph(ast))
+    eliminator.walk_procedure(procedure, ast)
+    assert eliminator.modified_tree
+    flag = Name('f.recurse')
+    test = parse_prog(src, True).decls[-1].body[0].test
+    # acc's argument reads n, so it's computed before n changes.
+    assert procedure.body == [
+        Assign(flag, Num('true')),
+        For(Assign(flag, flag), flag, [
+            Assign(flag, Num('false')),
+            If(test, [Assign(Name('result'), Name('acc'))], [
+                Assign(Name('acc.next'), BinaryOp('*', Name('acc'), Name('n'))),
+                Assign(Name('n'), BinaryOp('-', Name('n'), Num('1'))),
+                Assign(Name('acc'), Name('acc.next')),
+                Assign(flag, Num('true'))])])]
+    assert procedure.decls == [VarDecl(False, 'bool', flag, None),
+                               VarDecl(False, 'int', Name('acc.next'), None)]
+    
+# -- Pass manager tests --
+
+def test_parse_pipeline():
+    assert optimizer.parse_pipeline('sccp, propagate,dce,') == ['sccp', 'propagate', 'dce']
+    assert optimizer.parse_pipeline(optimizer.DEFAULT_PIPELINE)[-2:] == ['reduce', 'ifconv']
+    
+@raises(ValueError)
+def test_unknown_pass():
+    optimizer.parse_pipeline('sccp,mem2reg')
+    
+def test_custom_pipeline():
+    src = '''
+    program test_program is
+        int a;
+        int b;
+    begin
+        a := 3;
+        b := a * 4;
+        putInteger(b);
+    end program
+    '''
+    # The multiply is only folded, since strength reduction isn't in the pipeline.
+    got = optimizer.optimize_tree(parse_prog(src, True), 0,
+                                  pipeline=optimizer.parse_pipeline('propagate'))
+    assert got.body[1] == Assign(Name('b'), Num('12'))
+    got = optimizer.optimize_tree(parse_prog(src, True), 0,
+                                  pipeline=optimizer.parse_pipeline('reduce'))
+    assert got.body[1] == Assign(Name('b'), BinaryOp('<<', Name('a'), Num('2')))
+    
+def test_analyses_are_cached():
+    src = '''
+    program test_program is
+        int a;
+    begin
+        a := 1;
+        putInteger(a);
+    end program
+    '''
+    ast = parse_prog(src, True)
+    manager = optimizer.PassManager(ast, [])
+    graph = manager.get('callgraph')
+    cfg = manager.get('cfg', ast)
+    assert manager.get('callgraph') is graph
+    assert manager.get('cfg', ast) is cfg
+    
+    # Folding preserves the call graph but not the CFG.
+    ast.body[1].args[0] = BinaryOp('+', Num('1'), Num('2'))
+    assert manager.run_pass('fold', ast)
+    assert manager.get('callgraph') is graph
+    assert manager.get('cfg', ast) is not cfg
+    
+    # SSA form is destroyed before passes that walk the tree.
+    manager.get('ssa', ast)
+    manager.run_pass('dce', ast)
+    assert ('ssa', id(ast)) not in manager.cache
+    assert ast.body[-1] == Call(Name('putInteger'), [Num('3')])
+    
+def test_liveness_is_cached():
+    src = '''
+    program test_program is
+        int a;
+    begin
+        a := 1;
+        a := 2;
+        putInteger(a);
+    end program
+    '''
+    ast = parse_prog(src, True)
+    manager = optimizer.PassManager(ast, [])
+    liveness = manager.get('liveness', ast)
+    assert manager.get('liveness', ast) is liveness
+    assert liveness.graph is manager.get('cfg', ast)
+    
+    # Dead store elimination uses the cached liveness, which is only
+    # invalidated if it removes a store.
+    assert manager.run_pass('dse', ast)
+    assert ast.body[0] == Assign(Name('a'), Num('2'))
+    assert manager.get('liveness', ast) is not liveness
+    liveness = manager.get('liveness', ast)
+    assert not manager.run_pass('dse', ast)
+    assert manager.get('liveness', ast) is liveness
+    
+    # Destroying SSA form changes the variables.
+    manager.get('ssa', ast)
+    manager.run_pass('dce', ast)
+    assert ('liveness', id(ast)) not in manager.cache
+    
+def test_pipelines_with_expression_arguments():
+    src = '''
+    program test_program is
+        int r;
+        procedure count(int n in, int acc out)
+        begin
+            if (n < 1) then
+                acc := 7;
+            else
+                count(n - 1, acc);
+            end if;
+        end procedure;
+    begin
+        count(2 + 3, r);
+        count(-r, r);
+        putInteger(r);
+    end program
+    '''
+    # Tail recursion elimination assigns to n, which the calls pass
+    # expressions to.
+    for pipeline in ['tre', optimizer.DEFAULT_PIPELINE]:
+        got = optimizer.optimize_procedures(parse_prog(src, True),
+                                            pipeline=optimizer.parse_pipeline(pipeline))
+        assert got.body[-1].func == Name('putInteger')
@@ -0,0 +1,94 @@
+import collections
+import os
+import tempfile
+
+from nose.tools import raises
+
+from ececompiler import scanner
+from ececompiler import parser
+from ececompiler import profiling
+
+def write_profile(text):
+    fd, filename = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    return filename
+
+def read_profile(text):
+    filename = write_profile(text)
+    try:
+        return profiling.read_profile(filename)
+    finally:
+        os.remove(filename)
+
+def test_read_profile():
+    profile = read_profile('''
+if 3 4 10
+then 3 4 2
+
+call 5 8 7
+if 3 4 5
+''')
+    assert profile.counts == {('if', 3, 4): 15, ('then', 3, 4): 2, ('call', 5, 8): 7}
+    assert profile.max_count == 15
+
+def test_empty_profile():
+    profile = read_profile('')
+    assert profile.max_count == 0
+    assert profile.counts == {}
+
+def test_invalid_entries():
+    for text in ['if 3 4', 'if 3 4 5 6', 'if 3 four 5', 'if 3 4 5.0', 'else 3 4 5']:
+        yield check_invalid_entry, text
+
+@raises(profiling.ProfileError)
+def check_invalid_entry(text):
+    read_profile('call 1 1 1\n' + text)
+
+@raises(profiling.ProfileError)
+def test_missing_profile():
+    filename = write_profile('')
+    os.remove(filename)
+    profiling.read_profile(filename)
+
+def test_counts():
+    src = '''
+    program test_program is
+        int i;
+    begin
+        if (i < 1) then
+            i := 1;
+        end if;
+        for (i := i + 1; i < 10)
+            putInteger(i);
+        end for;
+        if (i < 1) then
+            i := 1;
+        end if;
+    end program
+    '''
+    ast = parser.parse_tokens(scanner.tokenize_string(src), include_runtime=True)
+    first, loop, second = ast.body
+    call = loop.body[0]
+    profile = profiling.Profile(collections.Counter({
+        (profiling.IF,) + profiling.location(first.token): 10,
+        (profiling.THEN,) + profiling.location(first.token): 3,
+        (profiling.ITERATION,) + profiling.location(loop.token): 1000,
+        (profiling.CALL,) + profiling.location(call.func.token): 0}))
+    assert profile.branch_counts(first) == (3, 7)
+    assert profile.iteration_count(loop) == 1000
+    assert profile.call_count(call) == 0
+    # Statements that weren't in the instrumented program have no counts.
+    assert profile.branch_counts(second) is None
+    assert profile.count(profiling.IF, None) is None
+
+def test_hot_and_cold():
+    profile = profiling.Profile(collections.Counter({('iteration', 1, 1): 1000}))
+    assert profile.is_hot(1000)
+    assert profile.is_hot(10)
+    assert not profile.is_hot(9)
+    assert not profile.is_hot(0)
+    assert not profile.is_hot(None)
+    assert profile.is_cold(0)
+    assert not profile.is_cold(1)
+    assert not profile.is_cold(None)
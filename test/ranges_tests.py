@@ -0,0 +1,193 @@
+from ececompiler import scanner
+from ececompiler import parser
+from ececompiler import typechecker
+from ececompiler import callgraph
+from ececompiler import ranges
+
+from ececompiler.syntaxtree import *
+
+def parse_prog(src):
+    ast = parser.parse_tokens(scanner.tokenize_string(src), include_runtime=True)
+    assert typechecker.tree_is_valid(ast)
+    return ast
+
+def checked_nodes(body, decls, types):
+    '''Return the nodes of some types in a program body whose checks can't be removed.'''
+    src = '''
+    program test_program is
+        %s
+    begin
+        %s
+    end program
+    ''' % (decls, body)
+    ast = parse_prog(src)
+    redundant = ranges.find_redundant_checks(ast, callgraph.CallGraph(ast))
+    checked = []
+    def visit(node):
+        if isinstance(node, types) and id(node) not in redundant:
+            if isinstance(node, Subscript) or node.node_type == 'bool':
+                checked.append(node)
+        if isinstance(node, Node):
+            for field in node:
+                visit(field)
+        elif isinstance(node, list):
+            for child in node:
+                visit(child)
+    visit(ast.body)
+    return checked
+
+def checked_operators(body, decls='bool a; bool b; int i; int j;'):
+    '''Return the boolean operators in a program body whose checks can't be removed.'''
+    return checked_nodes(body, decls, (BinaryOp, UnaryOp))
+
+def checked_subscripts(body, decls='int i; int j; int n; int a[10];'):
+    '''Return the subscripts in a program body whose bounds checks can't be removed.'''
+    return checked_nodes(body, decls, Subscript)
+
+def test_expression_range():
+    assert ranges.expression_range(Num('true'), {}) == (1, 1)
+    assert ranges.expression_range(Num('1.5'), {}) == ranges.FULL_RANGE
+    expression = BinaryOp('+', Name('i'), Num('2'))
+    assert ranges.expression_range(expression, {Name('i'): (0, 3)}) == (2, 5)
+    assert ranges.expression_range(expression, {}) == ranges.FULL_RANGE
+    expression = BinaryOp('&', Name('i'), Num('1'))
+    assert ranges.expression_range(expression, {}) == (0, 1)
+    expression = Select(Name('j'), Num('1'), Name('i'))
+    assert ranges.expression_range(expression, {Name('i'): (4, 6)}) == (1, 6)
+
+def test_literals_and_comparisons():
+    assert checked_operators('''
+        a := true & (i < j);
+        b := not (a | false);
+        putBool(b);
+    ''') == []
+
+def test_unknown_operands():
+    # getBool can return any int, and so can uninitialized variables.
+    checked = checked_operators('''
+        getBool(a);
+        b := a & true;
+        putBool(b);
+        putBool(true | i);
+    ''')
+    assert checked == [BinaryOp('&', Name('a'), Num('true')), BinaryOp('|', Num('true'), Name('i'))]
+
+def test_checked_operands_are_boolean():
+    # The check on the first operator aborts the program if a isn't 0 or 1.
+    checked = checked_operators('''
+        getBool(a);
+        b := a | false;
+        putBool(b & true);
+    ''')
+    assert checked == [BinaryOp('|', Name('a'), Num('false'))]
+
+def test_branches_join():
+    checked = checked_operators('''
+        if (i < j) then
+            a := true;
+            b := false;
+        else
+            a := false;
+        end if;
+        putBool(a & true);
+        putBool(b & true);
+    ''')
+    assert checked == [BinaryOp('&', Name('b'), Num('true'))]
+
+def test_loop():
+    checked = checked_operators('''
+        a := true;
+        i := 1;
+        for (j := 0; j < 10)
+            a := not a;
+            i := i + 1;
+            j := j + 1;
+        end for;
+        putBool(a & true);
+        putBool(i & true);
+    ''')
+    assert checked == [BinaryOp('&', Name('i'), Num('true'))]
+
+def test_calls():
+    checked = checked_operators('''
+        a := true;
+        b := true;
+        c := true;
+        f(b);
+        putBool(a & true);
+        putBool(b & true);
+        putBool(c & true);
+    ''', decls='''
+        global bool a;
+        bool b;
+        global bool c;
+        procedure f(bool x out)
+        begin
+            a := 2;
+            x := 2;
+        end procedure;
+    ''')
+    assert checked == [BinaryOp('&', Name('a'), Num('true')),
+                       BinaryOp('&', Name('b'), Num('true'))]
+
+def test_constant_indexes():
+    checked = checked_subscripts('''
+        a[0] := 1;
+        a[9] := a[0];
+        a[10] := 1;
+        i := -1;
+        putInteger(a[i]);
+    ''')
+    assert checked == [Subscript(Name('a'), Num('10')), Subscript(Name('a'), Name('i'))]
+
+def test_loop_bounds():
+    checked = checked_subscripts('''
+        i := 0;
+        for (i := i + 1; i < 10)
+            a[i] := a[i] + 1;
+        end for;
+        getInteger(n);
+        j := 0;
+        for (j := j + 1; j < n)
+            a[j] := 0;
+        end for;
+        j := 0;
+        for (j := j + 1; j < n & j < 10)
+            a[j] := 0;
+        end for;
+    ''')
+    assert checked == [Subscript(Name('a'), Name('j'))]
+
+def test_branch_bounds():
+    checked = checked_subscripts('''
+        getInteger(i);
+        if (i >= 0 & i <= 9) then
+            putInteger(a[i]);
+        else
+            putInteger(a[i]);
+        end if;
+        if (i < 1 | i > 10) then
+            putInteger(a[i - 1]);
+        else
+            putInteger(a[i - 1]);
+        end if;
+    ''')
+    assert checked == [Subscript(Name('a'), Name('i')),
+                       Subscript(Name('a'), BinaryOp('-', Name('i'), Num('1')))]
+
+def test_array_lengths():
+    src = '''
+    program test_program is
+        global int a[4];
+        int b[2];
+        procedure f(int b[8] in)
+            int a;
+        begin
+        end procedure;
+    begin
+    end program
+    '''
+    ast = parse_prog(src)
+    procedure = [d for d in ast.decls if isinstance(d, ProcDecl) and d.name == Name('f')][0]
+    assert ranges.array_lengths(ast, ast) == {Name('a'): 4, Name('b'): 2}
+    assert ranges.array_lengths(procedure, ast) == {Name('b'): 8}
@@ -0,0 +1,138 @@
+import os
+import re
+import StringIO
+
+from ececompiler import scanner
+from ececompiler import parser
+from ececompiler import typechecker
+from ececompiler import codegenerator
+from ececompiler import regalloc
+
+def allocate(lines, depths=None, calls=None, register_count=regalloc.REGISTER_COUNT):
+    '''Allocate the registers of a list of lines, and return the allocator.'''
+    if depths is None:
+        depths = [0] * len(lines)
+    allocator = regalloc.RegisterAllocator(lines, depths, calls or {}, register_count)
+    allocator.allocate()
+    return allocator
+
+def test_temporaries_share_registers():
+    allocator = allocate(['f:',
+                          '$1 = MM[1];',
+                          '$2 = $1 + 1;',
+                          '$3 = $2 * 2;',
+                          'MM[1] = $3;',
+                          'return 0;'])
+    assert allocator.render(1) == ['f:',
+                                   'R1 = MM[1];',
+                                   'R1 = R1 + 1;',
+                                   'R1 = R1 * 2;',
+                                   'MM[1] = R1;',
+                                   'return 0;']
+    assert allocator.used_registers == 2
+    assert (allocator.frame_slots, allocator.shared_slots) == (0, 0)
+
+def test_dead_assignments_are_removed():
+    allocator = allocate(['f:',
+                          '$1 = MM[1]; /* a */',
+                          '$1 = 5;',
+                          '$2 = $1;',
+                          'MM[2] = $2;',
+                          'return 0;'])
+    # Copies between variables that share a register disappear too.
+    assert allocator.render(1) == ['f:', 'R1 = 5;', 'MM[2] = R1;', 'return 0;']
+
+def test_values_live_around_loops():
+    allocator = allocate(['f:',
+                          '$1 = MM[1];',
+                          '$2 = 0;',
+                          'loop:',
+                          '$2 = $2 + $1;',
+                          'if ($2 < 10) goto loop;',
+                          'MM[2] = $2;',
+                          'return 0;'], depths=[0, 0, 0, 1, 1, 1, 0, 0])
+    assert allocator.intervals[1].end == 5
+    assert allocator.intervals[1].location != allocator.intervals[2].location
+    assert allocator.intervals[2].cost == 1 + 10 + 10 + 1
+
+LOOP = ['f:',
+        '$2 = MM[2];',
+        '$1 = MM[1];',
+        'MM[4] = $1;',
+        'MM[5] = $1;',
+        'loop:',
+        '$2 = $2 + 1;',
+        'if ($2 < 10) goto loop;',
+        'MM[3] = $1 + $2;',
+        'return 0;']
+
+def test_spills_are_weighted_by_loop_depth():
+    # Without loops, $2 is used the least for its length, so it's spilled.
+    allocator = allocate(LOOP, register_count=1)
+    assert allocator.render(1)[1:4] == ['S[0] = MM[2];', 'R1 = MM[1];', 'MM[4] = R1;']
+    # Inside of a loop, it's used much more than $1 is.
+    allocator = allocate(LOOP, depths=[0, 0, 0, 0, 0, 1, 1, 1, 0, 0], register_count=1)
+    assert allocator.render(1)[1:4] == ['R1 = MM[2];', 'S[0] = MM[1];', 'MM[4] = S[0];']
+    assert allocator.shared_slots == 1
+
+CALL = ['f:',
+        '$1 = MM[1];',
+        'MM[SP + 1] = FP;',
+        'goto g;',
+        'ret:',
+        'MM[2] = $1;',
+        'return 0;']
+
+def test_registers_are_saved_around_calls():
+    allocator = allocate(CALL, calls={'ret': None})
+    assert allocator.render(3) == ['f:',
+                                   'R1 = MM[1];',
+                                   'MM[SP + 1] = FP;',
+                                   '    MM[FP + 3] = R1;',
+                                   'goto g;',
+                                   'ret:',
+                                   '    R1 = MM[FP + 3];',
+                                   'MM[2] = R1;',
+                                   'return 0;']
+    assert allocator.frame_slots == 1
+
+def test_registers_the_callee_doesnt_use_arent_saved():
+    allocator = allocate(CALL, calls={'ret': 2})
+    assert allocator.intervals[1].location == 2
+    assert not any('MM[FP' in line for line in allocator.render(3))
+    assert allocator.frame_slots == 0
+    # If all of the registers might be overwritten, the cheapest is used.
+    allocator = allocate(CALL, calls={'ret': 2}, register_count=1)
+    assert allocator.intervals[1].location == 1
+
+def test_values_live_across_calls_in_loops_are_spilled_to_the_frame():
+    allocator = allocate(CALL, depths=[0, 0, 1, 1, 1, 0, 0], calls={'ret': None})
+    assert allocator.render(3)[1] == 'MM[FP + 3] = MM[1];'
+    assert allocator.frame_slots == 1
+
+def test_comments_are_not_rewritten():
+    allocator = allocate(['f:', '$1 = MM[1]; /* $1 */', 'MM[2] = $1;', 'return 0;'])
+    assert allocator.render(1)[1] == 'R1 = MM[1]; /* $1 */'
+
+def test_generated_code_uses_the_register_count():
+    path = os.path.join(os.path.dirname(__file__), 'test_program.src')
+    ast = parser.parse_tokens(scanner.tokenize_file(path), include_runtime=True)
+    assert typechecker.tree_is_valid(ast)
+    output = StringIO.StringIO()
+    codegenerator.output_code(ast, output, register_count=2)
+    code = output.getvalue()
+    assert 'int R0, R1, R2;' in code
+    assert not re.search(r'\bR([3-9]|\d\d)\b|\$\d', code)
+
+def test_every_interval_is_spilled_without_registers():
+    allocator = allocate(LOOP, register_count=0)
+    assert not any(re.search(r'\bR\d', line) for line in allocator.render(1))
+    assert allocator.used_registers == 1
+    path = os.path.join(os.path.dirname(__file__), 'test_program.src')
+    ast = parser.parse_tokens(scanner.tokenize_file(path), include_runtime=True)
+    assert typechecker.tree_is_valid(ast)
+    output = StringIO.StringIO()
+    codegenerator.output_code(ast, output, register_count=0)
+    code = output.getvalue()
+    assert 'int R0;' in code
+    assert not re.search(r'\bR[1-9]|\$\d', code)
@@ -0,0 +1,203 @@
+from ececompiler import scanner
+from ececompiler import parser
+from ececompiler import typechecker
+from ececompiler import controlflow
+from ececompiler import ssa
+
+from ececompiler.syntaxtree import *
+
+def parse_prog(src):
+    ast = parser.parse_tokens(scanner.tokenize_string(src), include_runtime=True)
+    assert typechecker.tree_is_valid(ast)
+    return ast
+
+PROGRAM_TEMPLATE = '''
+program test_program is
+    %s
+begin
+    %s
+end program
+'''
+
+DECLS = 'int a; int b; int t; int x; int y; int i;'
+
+def build_body(body, decls=DECLS):
+    ast = parse_prog(PROGRAM_TEMPLATE % (decls, body))
+    return ssa.SSAForm(controlflow.ControlFlowGraph(ast), ast)
+
+def test_versions():
+    form = build_body('''
+        a := 1;
+        a := a + 1;
+        putInteger(a);
+    ''')
+    first, second, call = form.procedure.body
+    assert form.procedure.body == [
+        Assign(Name('a.1'), Num('1')),
+        Assign(Name('a.2'), BinaryOp('+', Name('a.1'), Num('1'))),
+        Call(Name('putInteger'), [Name('a.2')])]
+    assert form.definitions[Name('a.1')] is first
+    assert form.definitions[Name('a')] is None
+    assert form.uses[Name('a.1')] == [second]
+    assert form.uses[Name('a.2')] == [call]
+    assert form.origins[Name('a.2')] == Name('a')
+
+def test_versions_skip_existing_names():
+    form = build_body('''
+        a := 1;
+        putInteger(a);
+    ''')
+    # A variable that destroy named after a version of a.
+    form.add_version(Name('a.2'), Name('a.2'), None)
+    assert form.new_version(Name('a'), None) == Name('a.3')
+
+def test_phi_at_join():
+    form = build_body('''
+        if (a < 1) then
+            b := 1;
+        else
+            b := 2;
+        end if;
+        putInteger(b);
+    ''')
+    join = form.graph.entry.successors[0].successors[0]
+    body, orelse = join.predecessors
+    phi, = form.phis[join]
+    assert phi.variable == Name('b')
+    assert phi.args == [body.statements[0].target, orelse.statements[0].target]
+    assert join.statements == [Call(Name('putInteger'), [phi.target])]
+    assert form.definitions[phi.target] is phi
+    assert form.uses[phi.target] == [join.statements[0]]
+
+def test_phis_are_pruned():
+    form = build_body('''
+        if (a < 1) then
+            b := 1;
+        else
+            b := 2;
+        end if;
+        b := 3;
+        putInteger(b);
+    ''')
+    assert not any(form.phis.values())
+
+def test_loop_phis():
+    form = build_body('''
+        x := 0;
+        i := 0;
+        for (i := i + 1; i < 10)
+            x := x + i;
+        end for;
+        putInteger(x);
+    ''')
+    header = form.graph.entry.successors[0]
+    i_phi, x_phi = form.phis[header]
+    assert [i_phi.variable, x_phi.variable] == [Name('i'), Name('x')]
+    # The header's test reads the phi target.
+    assert header.test == BinaryOp('<', i_phi.target, Num('10'))
+    assert form.procedure.body[2].test is header.test
+    assert header in form.uses[i_phi.target]
+    # The loop's assignment defines the version that comes back to the header.
+    assert i_phi.args[1] == form.procedure.body[2].assignment.target
+
+def test_memory_variables():
+    src = '''
+    program test_program is
+        global int g;
+        procedure f(int x in, int y out, int z[2] in)
+            int a;
+            int b;
+            int c[2];
+        begin
+            getInteger(b);
+            a := x;
+            y := a;
+        end procedure;
+        int c[2];
+    begin
+        f(1, g, c);
+    end program
+    '''
+    ast = parse_prog(src)
+    procedure = ast.decls[-2]
+    assert ssa.find_variables(procedure, ast) == {
+        Name('a'): procedure.decls[0],
+        Name('x'): procedure.params[0].var_decl}
+    ssa.SSAForm(controlflow.ControlFlowGraph(procedure), ast)
+    assert procedure.body[1:] == [Assign(Name('a.1'), Name('x')),
+                                  Assign(Name('y'), Name('a.1'))]
+
+def test_round_trip():
+    body = '''
+        a := 1;
+        if (a < 1) then
+            b := 1;
+        else
+            b := a;
+        end if;
+        for (i := i + 1; i < b)
+            x := x + i;
+        end for;
+        putInteger(x);
+    '''
+    form = build_body(body)
+    original = parse_prog(PROGRAM_TEMPLATE % (DECLS, body))
+    form.destroy()
+    assert form.procedure == original
+
+def test_overlapping_versions():
+    form = build_body('''
+        a := 1;
+        b := a;
+        a := 2;
+        putInteger(b);
+        putInteger(a);
+    ''')
+    # Replace the read of b with a, like copy propagation would. The first
+    # version of a is now live at the second assignment, so it gets its own
+    # variable.
+    form.procedure.body[3].args[0] = Name('a.1')
+    form.destroy()
+    assert form.procedure.body == [
+        Assign(Name('a'), Num('1')),
+        Assign(Name('b'), Name('a')),
+        Assign(Name('a.2'), Num('2')),
+        Call(Name('putInteger'), [Name('a')]),
+        Call(Name('putInteger'), [Name('a.2')])]
+    assert form.procedure.decls[-1] == VarDecl(False, 'int', Name('a.2'), None)
+
+def test_swap_in_loop():
+    form = build_body('''
+        x := 1;
+        y := 2;
+        i := 0;
+        for (i := i + 1; i < 3)
+            t := x;
+            x := y;
+            y := t;
+        end for;
+        putInteger(x);
+        putInteger(y);
+    ''')
+    header = form.graph.entry.successors[0]
+    swap_t, swap_x, swap_y = header.successors[0].statements[:3]
+    # Copy propagate t and the new x, so that the phis for x and y read each
+    # other's targets.
+    swap_y.value = Name('x.2')
+    form.phis[header][1].args[1] = Name('y.2')
+    form.remove(swap_t)
+    form.remove(swap_x)
+    form.destroy()
+
+    loop = form.procedure.body[3]
+    assert loop.body == [Assign(Name('y.3'), Name('x')),
+                         Assign(Name('i'), BinaryOp('+', Name('i'), Num('1'))),
+                         Assign(Name('x'), Name('y'))]
+    assert loop.assignment == Assign(Name('y'), Name('y.3'))
+
+def test_sequentialize():
+    x, y, z, t = Name('x'), Name('y'), Name('z'), Name('t')
+    assert ssa.sequentialize([(x, y), (y, z)], None) == [(x, y), (y, z)]
+    assert ssa.sequentialize([(y, z), (x, y)], None) == [(x, y), (y, z)]
+    assert ssa.sequentialize([(x, x)], None) == []
+    assert ssa.sequentialize([(x, y), (y, x)], lambda n: t) == [(t, x), (x, y), (y, t)]
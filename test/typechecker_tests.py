@@ -491,3 +491,29 @@ def test_two_invalid_types_in_expression():
     end program
     '''
     yield check_program_is_invalid, src
+    
+def test_undefined_identifier_in_test():
+    src = '''
+    program test_program is
+        int x;
+    begin
+        if (y < 1) then
+            x := 1;
+        end if;
+    end program
+    '''
+    yield check_program_is_invalid, src
+    
+def test_test_node_type_annotation():
+    src = '''
+    program test_program is
+        float x;
+        int i;
+    begin
+        for (i := i + 1; x < 1.5)
+        end for;
+    end program
+    '''
+    ast = parser.parse_tokens(scanner.tokenize_string(src))
+    assert typechecker.tree_is_valid(ast)
+    assert ast.body[0].test.node_type == tokens.FLOAT